@@ -1,96 +1,232 @@
+import asyncio
 import logging
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, Optional
 
-# from nicepay_api import NicePayAPI
-# from greengo_api import GreengoAPI
-# from onlypays_api import OnlyPaysAPI
-# from pspware_api import PSPWareAPI
+from api.circuit_breaker import BreakerRegistry
+from api.deadline import Deadline
+from api.routing import GatewayRouter
 
 
 logger = logging.getLogger(__name__)
 
 class PaymentAPIManager:
 
-    def __init__(self, apis: List[Dict[str, Any]] = None):
+    def __init__(self, apis: List[Dict[str, Any]] = None, hedge_delay: Optional[float] = None,
+                 router: Optional[GatewayRouter] = None, breakers: Optional[BreakerRegistry] = None,
+                 attempt_share: float = 0.5, attempt_floor: float = 3.0):
         # Инициализация и регистрация апи
         self.apis = apis or []
+        # Без router провайдеры идут в порядке списка
+        self.router = router
+        # Провайдер с разомкнутым автоматом пропускается без сетевого запроса
+        self.breakers = breakers
+        # Доля оставшегося дедлайна на одну попытку у провайдера (но не меньше attempt_floor секунд)
+        self.attempt_share = attempt_share
+        self.attempt_floor = attempt_floor
+        # None или отрицательное значение - провайдеры опрашиваются строго по очереди
+        self.hedge_delay = hedge_delay
+        self._background = set()
 
-        # Добавляю NicePay API в список (по примеру остальных)
-        # self.apis.append({
-        #     "name": "NicePay",
-        #     "api": NicePayAPI(),
-        #     "pay_type_mapping": {}
-        # })
-
-        # Пример, если надо инициализировать остальные, можно раскомментировать
-        # self.apis.extend([
-        #    {"name": "Greengo", "api": GreengoAPI(), "pay_type_mapping": {}},
-        #    {"name": "OnlyPays", "api": OnlyPaysAPI(config.ONLYPAYS_API_ID, config.ONLYPAYS_SECRET_KEY, config.ONLYPAYS_PAYMENT_KEY), "pay_type_mapping": {}},
-        #    {"name": "PSPWare", "api": PSPWareAPI(), "pay_type_mapping": {}}
-        # ])
-
-    async def create_order(self, amount: int, payment_type: str, personal_id: str, is_sell_order: bool = False) -> Dict[str, Any]:
-        for api_config in self.apis:
-            api = api_config['api']
-            api_name = api_config['name']
-            pay_type_mapping = api_config.get('pay_type_mapping', {})
-            mapped_payment_type = pay_type_mapping.get(payment_type, payment_type)
+    @staticmethod
+    def _is_success(response: Dict[str, Any]) -> bool:
+        return bool(response.get('success') or response.get('resultCode') == '0000')
 
-            try:
-                if is_sell_order and api_name != 'OnlyPays':
-                    continue
+    def _candidates(self, is_sell_order: bool) -> List[Dict[str, Any]]:
+        if is_sell_order:
+            return [api_config for api_config in self.apis if api_config['name'] == 'OnlyPays']
+        return list(self.apis)
 
-                if api_name == 'Greengo':
-                    response = await api.create_order(
-                        payment_method=mapped_payment_type,
-                        wallet='',
-                        from_amount=str(amount)
-                    )
-                elif api_name == 'PSPWare':
-                    response = await api.create_order(
-                        amount=amount,
-                        pay_types=[mapped_payment_type],
-                        personal_id=personal_id
-                    )
-                elif api_name == 'NicePay':
-                    # Для NicePay используем personal_id == merchantOrderId, а payment_type - paymentMethod
-                    response = await api.create_payment(
-                        merchant_order_id=str(personal_id),
-                        amount=amount,
-                        payment_type=mapped_payment_type
-                    )
-                else:
-                    response = await api.create_order(
-                        amount=amount,
-                        payment_type=mapped_payment_type,
-                        personal_id=personal_id
-                    )
-
-                if response.get('success') or response.get('resultCode') == '0000':
-                    response['api_name'] = api_name
-                    if api_name == 'Greengo':
-                        response['data'] = {
-                            'id': response.get('order_id', personal_id),
-                            'requisite': response.get('requisite', ''),
-                            'owner': response.get('owner', 'Неизвестно'),
-                            'bank': response.get('bank', 'Неизвестно')
-                        }
-                    elif api_name == 'NicePay':
-                        # Вариант данных из response для NicePay по документации
-                        # Можно взять paymentUrl для оплаты, transactionId и т.п.
-                        response.setdefault('data', {})
-                        response['data']['id'] = response.get('merchantOrderId', personal_id) or response['data'].get('merchantOrderId', personal_id)
-                        response['data']['payment_url'] = response.get('paymentUrl') or response['data'].get('paymentUrl')
-                        response['data']['status'] = response.get('resultCode')
+    async def _create_with(self, api_config: Dict[str, Any], amount: int, payment_type: str,
+                           personal_id: str, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        api = api_config['api']
+        api_name = api_config['name']
+        pay_type_mapping = api_config.get('pay_type_mapping', {})
+        mapped_payment_type = pay_type_mapping.get(payment_type, payment_type)
+
+        if deadline is not None and deadline.expired:
+            return {'success': False, 'error': 'Истёк срок ожидания реквизитов', 'api_name': api_name, 'skipped': True}
+
+        breaker = self.breakers.get(api_name) if self.breakers is not None else None
+        if breaker is not None and not breaker.allow():
+            return {'success': False, 'error': f"{api_name}: circuit open", 'api_name': api_name, 'skipped': True}
+
+        attempt = deadline.slice(self.attempt_share, self.attempt_floor) if deadline is not None else None
+
+        started = time.monotonic()
+        try:
+            if api_name == 'Greengo':
+                response = await api.create_order(
+                    payment_method=mapped_payment_type,
+                    wallet='',
+                    from_amount=str(amount),
+                    deadline=attempt
+                )
+            elif api_name == 'PSPWare':
+                response = await api.create_order(
+                    amount=amount,
+                    pay_types=[mapped_payment_type],
+                    personal_id=personal_id,
+                    deadline=attempt
+                )
+            elif api_name == 'NicePay':
+                # Для NicePay используем personal_id == merchantOrderId, а payment_type - paymentMethod
+                response = await api.create_payment(
+                    merchant_order_id=str(personal_id),
+                    amount=amount,
+                    payment_type=mapped_payment_type,
+                    deadline=attempt
+                )
+            else:
+                response = await api.create_order(
+                    amount=amount,
+                    payment_type=mapped_payment_type,
+                    personal_id=personal_id,
+                    deadline=attempt
+                )
+        except asyncio.CancelledError:
+            # Отменённый запрос (проигравший hedge, остановка задачи) не должен держать пробу автомата
+            if breaker is not None:
+                breaker.release_probe()
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка при создании заказа через {api_name}: {e}")
+            self._record(api_name, payment_type, False, started)
+            if breaker is not None:
+                breaker.record_failure(str(e)[:80])
+            return {'success': False, 'error': str(e), 'api_name': api_name}
+
+        response['api_name'] = api_name
+        if not self._is_success(response) and not response.get('error') and attempt is not None and attempt.expired:
+            response['error'] = f"таймаут {attempt.budget:.1f} с"
+        self._record(api_name, payment_type, self._is_success(response), started)
+        if breaker is not None:
+            if self._is_success(response):
+                breaker.record_success()
+            else:
+                breaker.record_failure(str(response.get('error', response.get('resultDesc', '')))[:80])
+        if self._is_success(response):
+            if api_name == 'Greengo':
+                response['data'] = {
+                    'id': response.get('order_id', personal_id),
+                    'requisite': response.get('requisite', ''),
+                    'owner': response.get('owner', 'Неизвестно'),
+                    'bank': response.get('bank', 'Неизвестно')
+                }
+            elif api_name == 'NicePay':
+                # Вариант данных из response для NicePay по документации
+                # Можно взять paymentUrl для оплаты, transactionId и т.п.
+                response.setdefault('data', {})
+                response['data']['id'] = response.get('merchantOrderId', personal_id) or response['data'].get('merchantOrderId', personal_id)
+                response['data']['payment_url'] = response.get('paymentUrl') or response['data'].get('paymentUrl')
+                response['data']['status'] = response.get('resultCode')
+        else:
+            logger.warning(f"{api_name} не смог создать заказ: {response.get('error', response.get('resultDesc', 'Нет описания'))}")
+        return response
+
+    def _record(self, api_name: str, payment_type: str, ok: bool, started: float):
+        if self.router is not None:
+            self.router.record(api_name, payment_type, ok, time.monotonic() - started)
+
+    async def create_order(self, amount: int, payment_type: str, personal_id: str, is_sell_order: bool = False,
+                           hedge_delay: Optional[float] = None, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        if hedge_delay is None:
+            hedge_delay = self.hedge_delay
+        candidates = self._candidates(is_sell_order)
+        if self.router is not None:
+            candidates = self.router.rank(candidates, payment_type)
+
+        if hedge_delay is None or hedge_delay < 0:
+            for api_config in candidates:
+                if deadline is not None and deadline.expired:
+                    break
+                response = await self._create_with(api_config, amount, payment_type, personal_id, deadline)
+                if self._is_success(response):
                     return response
-                else:
-                    logger.warning(f"{api_name} не смог создать заказ: {response.get('error', response.get('resultDesc', 'Нет описания'))}")
+            return {'success': False, 'error': 'Все платежные API не сработали', 'api_name': None}
 
-            except Exception as e:
-                logger.error(f"Ошибка при создании заказа через {api_name}: {e}")
+        return await self._create_hedged(candidates, amount, payment_type, personal_id, hedge_delay, deadline)
+
+    async def _create_hedged(self, candidates: List[Dict[str, Any]], amount: int, payment_type: str,
+                             personal_id: str, hedge_delay: float,
+                             deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """Следующий провайдер стартует параллельно по таймеру или при ошибке; побеждает первый успех"""
+        queue = iter(candidates)
+        pending = set()
 
+        def launch_next() -> bool:
+            api_config = next(queue, None)
+            if api_config is None:
+                return False
+            pending.add(asyncio.create_task(
+                self._create_with(api_config, amount, payment_type, personal_id, deadline)
+            ))
+            return True
+
+        has_more = launch_next()
+        winner = None
+        try:
+            while pending and winner is None:
+                timeout = hedge_delay if has_more else None
+                if deadline is not None:
+                    timeout = deadline.remaining() if timeout is None else min(timeout, deadline.remaining())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done and deadline is not None and deadline.expired:
+                    logger.warning(f"Заказ {personal_id}: истёк дедлайн {deadline.budget:.0f} с")
+                    break
+                if not done:
+                    logger.info(f"Заказ {personal_id}: ответа нет {hedge_delay} с, подключаю следующий API")
+                    has_more = launch_next()
+                    continue
+
+                failed = False
+                for task in done:
+                    pending.discard(task)
+                    response = task.result()
+                    if self._is_success(response) and winner is None:
+                        winner = response
+                    elif self._is_success(response):
+                        self._cancel_in_background(response)
+                    else:
+                        failed = True
+
+                if winner is None and (failed or not pending):
+                    has_more = launch_next()
+        finally:
+            # Проигравшие запросы не обрываем: заказ у провайдера мог уже создаться.
+            # Это верно и для отмены самого create_order - тогда лишними будут все созданные заказы
+            if pending:
+                self._track(asyncio.create_task(self._cancel_losers(pending)))
+
+        if winner is not None:
+            return winner
         return {'success': False, 'error': 'Все платежные API не сработали', 'api_name': None}
 
+    async def _cancel_losers(self, tasks):
+        for task in asyncio.as_completed(tasks):
+            response = await task
+            if self._is_success(response):
+                await self.cancel_duplicate(response)
+
+    def _cancel_in_background(self, response: Dict[str, Any]):
+        self._track(asyncio.create_task(self.cancel_duplicate(response)))
+
+    async def cancel_duplicate(self, response: Dict[str, Any]):
+        api_name = response.get('api_name')
+        order_id = (response.get('data') or {}).get('id')
+        if not order_id:
+            logger.warning(f"Лишний заказ {api_name} без id, отменить нельзя: {response}")
+            return
+        result = await self.cancel_order(str(order_id), api_name)
+        if self._is_success(result):
+            logger.info(f"Лишний заказ {order_id} в {api_name} отменён")
+        else:
+            logger.warning(f"Не удалось отменить лишний заказ {order_id} в {api_name}: {result.get('error')}")
+
+    def _track(self, task: asyncio.Task):
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
     async def get_order_status(self, order_id: str, api_name: str) -> Dict[str, Any]:
         api_config = next((api for api in self.apis if api['name'] == api_name), None)
         if not api_config:
@@ -111,6 +247,20 @@ class PaymentAPIManager:
             logger.error(f"Ошибка проверки статуса через {api_name}: {e}")
             return {'success': False, 'error': str(e), 'api_name': api_name}
 
+    async def get_order_statuses(self, order_ids: List[str], api_name: str) -> Dict[str, Any]:
+        """Статусы нескольких заявок одним запросом; пакетную проверку поддерживает только Greengo"""
+        api_config = next((api for api in self.apis if api['name'] == api_name), None)
+        if not api_config or api_name != 'Greengo':
+            return {'success': False, 'error': f"Пакетная проверка статусов через {api_name} недоступна"}
+
+        try:
+            response = await api_config['api'].check_order(order_ids)
+            response['api_name'] = api_name
+            return response
+        except Exception as e:
+            logger.error(f"Ошибка пакетной проверки статусов через {api_name}: {e}")
+            return {'success': False, 'error': str(e), 'api_name': api_name}
+
     async def cancel_order(self, order_id: str, api_name: str) -> Dict[str, Any]:
         api_config = next((api for api in self.apis if api['name'] == api_name), None)
         if not api_config:
@@ -136,9 +286,26 @@ class PaymentAPIManager:
         for api_config in self.apis:
             api = api_config['api']
             api_name = api_config['name']
+            breaker = self.breakers.get(api_name) if self.breakers is not None else None
+            if breaker is not None and not breaker.allow():
+                results[api_name] = {
+                    'success': False,
+                    'error': f"circuit open, повтор через {breaker.retry_in:.0f} с",
+                    'skipped': True
+                }
+                continue
             try:
                 response = await api.health_check()
                 results[api_name] = response
+            except asyncio.CancelledError:
+                if breaker is not None:
+                    breaker.release_probe()
+                raise
             except Exception as e:
-                results[api_name] = {'success': False, 'error': str(e)}
+                response = results[api_name] = {'success': False, 'error': str(e)}
+            if breaker is not None:
+                if self._is_success(response):
+                    breaker.record_success()
+                else:
+                    breaker.record_failure(f"health: {str(response.get('error', ''))[:70]}")
         return results
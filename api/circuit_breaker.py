@@ -0,0 +1,132 @@
+import html
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, NamedTuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class Transition(NamedTuple):
+    at: float
+    from_state: str
+    to_state: str
+    reason: str
+
+
+class CircuitBreaker:
+    """Размыкается после N ошибок подряд; после паузы пропускает одну пробную попытку"""
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30,
+                 history_size: int = 20):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.transitions: Deque[Transition] = deque(maxlen=history_size)
+
+    def _move(self, to_state: str, reason: str):
+        if to_state == self.state:
+            return
+        self.transitions.append(Transition(time.time(), self.state, to_state, reason))
+        log = logger.warning if to_state == OPEN else logger.info
+        log(f"Circuit breaker {self.name}: {self.state} -> {to_state} ({reason})")
+        self.state = to_state
+
+    @property
+    def retry_in(self) -> float:
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if self.retry_in > 0:
+                return False
+            self._move(HALF_OPEN, "cooldown elapsed")
+        # В полуоткрытом состоянии пропускаем ровно одну пробу
+        if self.probe_in_flight:
+            return False
+        self.probe_in_flight = True
+        return True
+
+    def release_probe(self):
+        """Проба прервана без результата (отмена) - следующий вызов снова сможет пробовать"""
+        self.probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.probe_in_flight = False
+        self._move(CLOSED, "probe succeeded" if self.state == HALF_OPEN else "success")
+
+    def record_failure(self, reason: str = ""):
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN:
+            self.opened_at = time.monotonic()
+            self._move(OPEN, f"probe failed: {reason}" if reason else "probe failed")
+        elif self.state == CLOSED and self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._move(OPEN, f"{self.failures} failures in a row")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'retry_in': self.retry_in,
+            'transitions': list(self.transitions),
+        }
+
+
+class BreakerRegistry:
+    """Автомат на каждого провайдера; создаётся при первом обращении"""
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = self._breakers[name] = CircuitBreaker(
+                name, failure_threshold=self.failure_threshold, cooldown=self.cooldown
+            )
+        return breaker
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: breaker.snapshot() for name, breaker in self._breakers.items()}
+
+
+def format_breakers(snapshot: Dict[str, Dict[str, Any]], history: int = 3) -> str:
+    icons = {CLOSED: "🟢", HALF_OPEN: "🟡", OPEN: "🔴"}
+    text = ""
+    for name, state in snapshot.items():
+        text += f"{icons.get(state['state'], '⚪️')} {name}: <b>{state['state']}</b>"
+        if state['state'] == OPEN:
+            text += f", повтор через {state['retry_in']:.0f}с"
+        elif state['failures']:
+            text += f", ошибок подряд: {state['failures']}"
+        text += "\n"
+        for transition in state['transitions'][-history:]:
+            moment = time.strftime('%H:%M:%S', time.localtime(transition.at))
+            text += f"    {moment} {transition.from_state} → {transition.to_state} ({html.escape(transition.reason)})\n"
+    return text
+
+
+gateway_breakers = BreakerRegistry(
+    failure_threshold=config.GATEWAY_BREAKER_FAILURES,
+    cooldown=config.GATEWAY_BREAKER_COOLDOWN,
+)
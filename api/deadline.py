@@ -0,0 +1,39 @@
+import time
+from typing import Optional
+
+import aiohttp
+
+from config import config
+
+
+class Deadline:
+    """Общий бюджет времени на получение реквизитов; каждая попытка берёт из него долю"""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def slice(self, share: float = 1.0, floor: float = 0.0) -> "Deadline":
+        # Доля остатка, но не меньше floor и не дальше общего дедлайна
+        remaining = self.remaining()
+        return Deadline(min(remaining, max(floor, remaining * share)))
+
+    def __repr__(self) -> str:
+        return f"Deadline(remaining={self.remaining():.1f}s of {self.budget:.0f}s)"
+
+
+def request_timeout(deadline: Optional[Deadline] = None) -> aiohttp.ClientTimeout:
+    """Таймаут одного HTTP-запроса к провайдеру: не больше GATEWAY_HTTP_TIMEOUT и остатка дедлайна"""
+    total = config.GATEWAY_HTTP_TIMEOUT
+    if deadline is not None:
+        total = min(total, deadline.remaining())
+    # Нулевой таймаут aiohttp трактует как "без ограничения"
+    total = max(total, 0.001)
+    return aiohttp.ClientTimeout(total=total, connect=min(total, config.GATEWAY_HTTP_CONNECT_TIMEOUT))
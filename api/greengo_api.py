@@ -1,6 +1,8 @@
 import logging
-import aiohttp
+from typing import Optional
 from config import config
+from api.transport import gateway_transport
+from api.deadline import Deadline, request_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +16,8 @@ class GreengoAPI:
         }
 
 
-    async def create_order(self, payment_method: str, wallet: str, from_amount: str):
+    async def create_order(self, payment_method: str, wallet: str, from_amount: str,
+                           deadline: Optional[Deadline] = None):
         url = f"{self.base_url}/order/create"
         data = {
             "payment_method": payment_method,
@@ -22,11 +25,11 @@ class GreengoAPI:
             "from_amount": from_amount
         }
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers) as response:
-                    result = await response.json()
-                    logger.info(f"Greengo create_order ответ: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, headers=self.headers, timeout=request_timeout(deadline)) as response:
+                result = await response.json()
+                logger.info(f"Greengo create_order ответ: {result}")
+                return result
         except Exception as e:
             logger.error(f"Greengo create_order ошибка: {e}")
             return {"success": False, "error": str(e)}
@@ -35,11 +38,11 @@ class GreengoAPI:
     async def get_directions(self):
         url = f"{self.base_url}/directions"
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=self.headers) as response:
-                    result = await response.json()
-                    logger.info(f"Greengo get_directions ответ: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.get(url, headers=self.headers, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"Greengo get_directions ответ: {result}")
+                return result
         except Exception as e:
             logger.error(f"Greengo get_directions ошибка: {e}")
             return {"success": False, "error": str(e)}
@@ -49,11 +52,11 @@ class GreengoAPI:
         url = f"{self.base_url}/order/check"
         data = {"order_id": order_ids}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers) as response:
-                    result = await response.json()
-                    logger.info(f"Greengo check_order ответ: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, headers=self.headers, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"Greengo check_order ответ: {result}")
+                return result
         except Exception as e:
             logger.error(f"Greengo check_order ошибка: {e}")
             return {"success": False, "error": str(e)}
@@ -63,11 +66,11 @@ class GreengoAPI:
         url = f"{self.base_url}/order/cancel"
         data = {"order_id": order_ids}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data, headers=self.headers) as response:
-                    result = await response.json()
-                    logger.info(f"Greengo cancel_order ответ: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, headers=self.headers, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"Greengo cancel_order ответ: {result}")
+                return result
         except Exception as e:
             logger.error(f"Greengo cancel_order ошибка: {e}")
             return {"success": False, "error": str(e)}
\ No newline at end of file
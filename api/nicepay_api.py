@@ -1,8 +1,10 @@
 import logging
 import hashlib
 import time
-import aiohttp
+from typing import Optional
 from config import config
+from api.transport import gateway_transport
+from api.deadline import Deadline, request_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +25,8 @@ class NicePayAPI:
         return hashlib.sha256(token_string.encode("utf-8")).hexdigest()
 
     async def create_payment(self, merchant_order_id: str, amount: int, currency: str = "IDR",
-                             payment_type: str = "01", description: str = "") -> dict:
+                             payment_type: str = "01", description: str = "",
+                             deadline: Optional[Deadline] = None) -> dict:
         url = f"{self.base_url}/payment/request"
         timestamp = int(time.time() * 1000)
         params = {
@@ -40,11 +43,11 @@ class NicePayAPI:
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params, headers=headers) as resp:
-                    result = await resp.json()
-                    logger.info(f"NicePay create_payment response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=params, headers=headers, timeout=request_timeout(deadline)) as resp:
+                result = await resp.json()
+                logger.info(f"NicePay create_payment response: {result}")
+                return result
         except Exception as e:
             logger.error(f"NicePay create_payment error: {e}")
             return {"success": False, "error": str(e)}
@@ -62,11 +65,11 @@ class NicePayAPI:
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params, headers=headers) as resp:
-                    result = await resp.json()
-                    logger.info(f"NicePay get_payment_status response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=params, headers=headers, timeout=request_timeout()) as resp:
+                result = await resp.json()
+                logger.info(f"NicePay get_payment_status response: {result}")
+                return result
         except Exception as e:
             logger.error(f"NicePay get_payment_status error: {e}")
             return {"success": False, "error": str(e)}
@@ -84,11 +87,11 @@ class NicePayAPI:
         headers = {"Content-Type": "application/json", "Accept": "application/json"}
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=params, headers=headers) as resp:
-                    result = await resp.json()
-                    logger.info(f"NicePay cancel_payment response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=params, headers=headers, timeout=request_timeout()) as resp:
+                result = await resp.json()
+                logger.info(f"NicePay cancel_payment response: {result}")
+                return result
         except Exception as e:
             logger.error(f"NicePay cancel_payment error: {e}")
             return {"success": False, "error": str(e)}
@@ -1,7 +1,9 @@
 # api/onlypays_api.py
 import logging
-import aiohttp
+from typing import Optional
 from config import config
+from api.transport import gateway_transport
+from api.deadline import Deadline, request_timeout
 
 logger = logging.getLogger(__name__)
 
@@ -14,7 +16,8 @@ class OnlyPaysAPI:
     
     # ... остальной код без изменений ...
     
-    async def create_order(self, amount: int, payment_type: str, personal_id: str = None, trans: bool = False):
+    async def create_order(self, amount: int, payment_type: str, personal_id: str = None, trans: bool = False,
+                           deadline: Optional[Deadline] = None):
         url = f"{self.base_url}/get_requisite"
         data = {
             "api_id": self.api_id,
@@ -30,11 +33,11 @@ class OnlyPaysAPI:
             data["trans"] = True
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays create_order response (sum {amount}): {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout(deadline)) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays create_order response (sum {amount}): {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays create_order error: {e}")
             return {"success": False, "error": str(e)}
@@ -48,11 +51,11 @@ class OnlyPaysAPI:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays get_status response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays get_status response: {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays get_status error: {e}")
             return {"success": False, "error": str(e)}
@@ -66,11 +69,11 @@ class OnlyPaysAPI:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays cancel_order response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays cancel_order response: {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays cancel_order error: {e}")
             return {"success": False, "error": str(e)}
@@ -86,11 +89,11 @@ class OnlyPaysAPI:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays get_balance response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays get_balance response: {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays get_balance error: {e}")
             return {"success": False, "error": str(e)}
@@ -113,11 +116,11 @@ class OnlyPaysAPI:
             data["personal_id"] = personal_id
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays create_payout response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays create_payout response: {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays create_payout error: {e}")
             return {"success": False, "error": str(e)}
@@ -134,11 +137,11 @@ class OnlyPaysAPI:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as response:
-                    result = await response.json()
-                    logger.info(f"OnlyPays payout_status response: {result}")
-                    return result
+            session = await gateway_transport.session()
+            async with session.post(url, json=data, timeout=request_timeout()) as response:
+                result = await response.json()
+                logger.info(f"OnlyPays payout_status response: {result}")
+                return result
         except Exception as e:
             logger.error(f"OnlyPays payout_status error: {e}")
             return {"success": False, "error": str(e)}
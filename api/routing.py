@@ -0,0 +1,115 @@
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Sample(NamedTuple):
+    at: float
+    ok: bool
+    latency: float
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ProviderWindow:
+    """Скользящее окно результатов одного провайдера для одного payment_type"""
+
+    def __init__(self, size: int, max_age: float):
+        self.max_age = max_age
+        self.samples: Deque[Sample] = deque(maxlen=size)
+
+    def add(self, ok: bool, latency: float):
+        self.samples.append(Sample(time.monotonic(), ok, latency))
+
+    def prune(self):
+        if self.max_age <= 0:
+            return
+        border = time.monotonic() - self.max_age
+        while self.samples and self.samples[0].at < border:
+            self.samples.popleft()
+
+    @property
+    def last_at(self) -> float:
+        return self.samples[-1].at if self.samples else 0.0
+
+
+class GatewayRouter:
+    """Упорядочивает провайдеров по ожидаемому времени до получения реквизитов"""
+
+    def __init__(self, window_size: int = 50, window_seconds: float = 900,
+                 explore_rate: float = 0.05, prior_latency: float = 5.0):
+        self.window_size = window_size
+        self.window_seconds = window_seconds
+        self.explore_rate = explore_rate
+        self.prior_latency = prior_latency
+        self.explorations = 0
+        self._windows: Dict[Tuple[str, str], ProviderWindow] = {}
+
+    def _window(self, api_name: str, payment_type: str) -> ProviderWindow:
+        key = (api_name, payment_type)
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = ProviderWindow(self.window_size, self.window_seconds)
+        return window
+
+    def record(self, api_name: str, payment_type: str, ok: bool, latency: float):
+        self._window(api_name, payment_type).add(ok, latency)
+
+    def score(self, api_name: str, payment_type: str) -> Dict[str, Any]:
+        window = self._window(api_name, payment_type)
+        window.prune()
+        samples = list(window.samples)
+        successes = [sample.latency for sample in samples if sample.ok]
+        # Сглаживание Лапласа: без данных провайдер считается "50 на 50"
+        success_ratio = (len(successes) + 1) / (len(samples) + 2)
+        p50 = percentile(successes, 0.5)
+        p90 = percentile(successes, 0.9)
+        if p50 is None:
+            # Неудачи тоже стоят времени: берём их латентность, пока нет успешных замеров
+            p50 = percentile([sample.latency for sample in samples], 0.5) or self.prior_latency
+            p90 = max(p50, self.prior_latency)
+        # Успешная попытка стоит p50; каждая ожидаемая неудачная - до p90
+        expected = p50 + (1 - success_ratio) / success_ratio * p90
+        return {
+            'api_name': api_name,
+            'payment_type': payment_type,
+            'samples': len(samples),
+            'success_ratio': success_ratio,
+            'p50': p50,
+            'p90': p90,
+            'expected': expected,
+        }
+
+    def rank(self, candidates: List[Dict[str, Any]], payment_type: str) -> List[Dict[str, Any]]:
+        if len(candidates) < 2:
+            return list(candidates)
+
+        # sorted стабилен: при равных оценках сохраняется порядок из конфигурации
+        ranked = sorted(candidates, key=lambda api: self.score(api['name'], payment_type)['expected'])
+
+        if self.explore_rate > 0 and random.random() < self.explore_rate:
+            # Дольше всех не проверявшийся провайдер идёт первым, чтобы восстановившийся снова получил трафик
+            probe = min(ranked[1:], key=lambda api: self._window(api['name'], payment_type).last_at)
+            ranked.remove(probe)
+            ranked.insert(0, probe)
+            self.explorations += 1
+            logger.info(f"Routing exploration: {probe['name']} ({payment_type}) поставлен первым")
+
+        return ranked
+
+    def scoreboard(self) -> List[Dict[str, Any]]:
+        rows = [self.score(api_name, payment_type) for api_name, payment_type in list(self._windows)]
+        return sorted(
+            (row for row in rows if row['samples']),
+            key=lambda row: (row['payment_type'], row['expected'])
+        )
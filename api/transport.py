@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayTransport:
+    """Общая ClientSession платёжных API: keep-alive, лимиты на хост и кэш DNS"""
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 10,
+                 keepalive_timeout: float = 30, dns_ttl: int = 300):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    connector = aiohttp.TCPConnector(
+                        limit=self.limit,
+                        limit_per_host=self.limit_per_host,
+                        keepalive_timeout=self.keepalive_timeout,
+                        ttl_dns_cache=self.dns_ttl,
+                        use_dns_cache=True,
+                    )
+                    self._session = aiohttp.ClientSession(connector=connector)
+                    logger.info(
+                        f"Gateway HTTP session opened (limit={self.limit}, per host={self.limit_per_host})"
+                    )
+        return self._session
+
+    async def start(self):
+        await self.session()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Gateway HTTP session closed")
+        self._session = None
+
+
+gateway_transport = GatewayTransport(
+    limit=config.GATEWAY_HTTP_LIMIT,
+    limit_per_host=config.GATEWAY_HTTP_LIMIT_PER_HOST,
+    keepalive_timeout=config.GATEWAY_HTTP_KEEPALIVE,
+    dns_ttl=config.GATEWAY_HTTP_DNS_TTL,
+)
@@ -6,6 +6,20 @@ load_dotenv()
 class Config:
     BOT_TOKEN = os.getenv("BOT_TOKEN")
     BOT_MODE = os.getenv("BOT_MODE", 'polling')
+    USE_WEBHOOK = os.getenv("USE_WEBHOOK", "false").lower() == "true"
+    WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+    WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+    # Кластер (BOT_MODE=cluster): супервизор на WEBHOOK_PORT и воркеры на CLUSTER_BASE_PORT + номер
+    CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", os.cpu_count() or 2))
+    CLUSTER_BASE_PORT = int(os.getenv("CLUSTER_BASE_PORT", 8100))
+    CLUSTER_SETTINGS_TTL = float(os.getenv("CLUSTER_SETTINGS_TTL", 5))
+    # Задаются супервизором; фоновые задачи выполняет только воркер 0
+    WORKER_INDEX = int(os.getenv("WORKER_INDEX", 0))
+    WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))
+    IS_LEADER = WORKER_INDEX == 0
     ONLYPAYS_API_ID = os.getenv("ONLYPAYS_API_ID")
     ONLYPAYS_SECRET_KEY = os.getenv("ONLYPAYS_SECRET_KEY")
     ONLYPAYS_PAYMENT_KEY = os.getenv("ONLYPAYS_PAYMENT_KEY")
@@ -14,12 +28,98 @@ class Config:
     GREENGO_API_SECRET = os.getenv("GREENGO_API_SECRET")
     NICEPAY_MERCHANT_KEY = os.getenv("NICEPAY_MERCHANT_KEY")
     NICEPAY_MERCHANT_TOKEN_KEY = os.getenv("NICEPAY_MERCHANT_TOKEN_KEY")
+    GATEWAY_HTTP_LIMIT = int(os.getenv("GATEWAY_HTTP_LIMIT", 100))
+    GATEWAY_HTTP_LIMIT_PER_HOST = int(os.getenv("GATEWAY_HTTP_LIMIT_PER_HOST", 10))
+    GATEWAY_HTTP_KEEPALIVE = float(os.getenv("GATEWAY_HTTP_KEEPALIVE", 30))
+    GATEWAY_HTTP_DNS_TTL = int(os.getenv("GATEWAY_HTTP_DNS_TTL", 300))
+    # Через сколько секунд без ответа подключать следующий API; -1 - строго по очереди
+    PAYMENT_HEDGE_DELAY = float(os.getenv("PAYMENT_HEDGE_DELAY", 3))
+    REQUISITES_RETRY_DELAY = float(os.getenv("REQUISITES_RETRY_DELAY", 10))
+    # Запас к SLA, на который заявка остаётся закреплена за попыткой (HTTP-ответ может прийти чуть позже)
+    REQUISITES_CLAIM_MARGIN = float(os.getenv("REQUISITES_CLAIM_MARGIN", 30))
+    ROUTING_WINDOW_SIZE = int(os.getenv("ROUTING_WINDOW_SIZE", 50))
+    ROUTING_WINDOW_SECONDS = float(os.getenv("ROUTING_WINDOW_SECONDS", 900))
+    ROUTING_EXPLORE_RATE = float(os.getenv("ROUTING_EXPLORE_RATE", 0.05))
+    ROUTING_PRIOR_LATENCY = float(os.getenv("ROUTING_PRIOR_LATENCY", 5))
+    GATEWAY_BREAKER_FAILURES = int(os.getenv("GATEWAY_BREAKER_FAILURES", 5))
+    GATEWAY_BREAKER_COOLDOWN = float(os.getenv("GATEWAY_BREAKER_COOLDOWN", 30))
+    GATEWAY_HTTP_TIMEOUT = float(os.getenv("GATEWAY_HTTP_TIMEOUT", 20))
+    GATEWAY_HTTP_CONNECT_TIMEOUT = float(os.getenv("GATEWAY_HTTP_CONNECT_TIMEOUT", 5))
+    GATEWAY_ATTEMPT_SHARE = float(os.getenv("GATEWAY_ATTEMPT_SHARE", 0.5))
+    GATEWAY_ATTEMPT_MIN = float(os.getenv("GATEWAY_ATTEMPT_MIN", 3))
+    # Жёсткий SLA на выдачу реквизитов; в админке переопределяется настройкой requisites_sla_seconds
+    REQUISITES_SLA_SECONDS = int(os.getenv("REQUISITES_SLA_SECONDS", 60))
+    # Сверка статусов заявок с провайдерами: интервал растёт от MIN до MAX, пока статус не меняется
+    RECONCILE_TICK = float(os.getenv("RECONCILE_TICK", 5))
+    RECONCILE_MIN_INTERVAL = float(os.getenv("RECONCILE_MIN_INTERVAL", 15))
+    RECONCILE_MAX_INTERVAL = float(os.getenv("RECONCILE_MAX_INTERVAL", 120))
+    RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", 20))
+    RECONCILE_MAX_AGE = float(os.getenv("RECONCILE_MAX_AGE", 86400))
+    # Очередь задач в БД (получение реквизитов): параллелизм, опрос, аренда и потолок backoff.
+    # Аренда продлевается каждые JOB_LEASE / 3 секунд, пока задача выполняется
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", 4))
+    JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+    JOB_LEASE = float(os.getenv("JOB_LEASE", 120))
+    JOB_RETRY_MAX = float(os.getenv("JOB_RETRY_MAX", 300))
+    REQUISITES_MAX_ATTEMPTS = int(os.getenv("REQUISITES_MAX_ATTEMPTS", 3))
+    # Приём callback-ов провайдеров: ответ сразу, обработка из очереди пулом воркеров
+    PAYMENT_QUEUE_SIZE = int(os.getenv("PAYMENT_QUEUE_SIZE", 1000))
+    PAYMENT_WORKERS = int(os.getenv("PAYMENT_WORKERS", 4))
+    # Проверка callback-ов: общий токен в ?token= и/или подпись провайдера; без них маршрут не поднимается
+    PAYMENT_WEBHOOK_TOKEN = os.getenv("PAYMENT_WEBHOOK_TOKEN", "")
+    PAYMENT_SIGNATURE_HEADER = os.getenv("PAYMENT_SIGNATURE_HEADER", "X-Signature")
+    ONLYPAYS_CALLBACK_SECRET = os.getenv("ONLYPAYS_CALLBACK_SECRET", "")
+    PSPWARE_CALLBACK_SECRET = os.getenv("PSPWARE_CALLBACK_SECRET", "")
+    GREENGO_CALLBACK_SECRET = os.getenv("GREENGO_CALLBACK_SECRET", "")
+    # Сколько последних ключей (провайдер, id, статус) держать в памяти для отсева повторов
+    PAYMENT_DEDUP_CACHE = int(os.getenv("PAYMENT_DEDUP_CACHE", 10000))
+    # Отдельный HTTP-сервер для callback-ов в режиме polling (в webhook-режиме они на том же приложении)
+    PAYMENT_WEBHOOK_HOST = os.getenv("PAYMENT_WEBHOOK_HOST", "127.0.0.1")
+    PAYMENT_WEBHOOK_PORT = int(os.getenv("PAYMENT_WEBHOOK_PORT", 8080))
+    RATE_REFRESH_INTERVAL = float(os.getenv("RATE_REFRESH_INTERVAL", 30))
+    RATE_MAX_AGE = float(os.getenv("RATE_MAX_AGE", 300))
+    RATE_FETCH_TIMEOUT = float(os.getenv("RATE_FETCH_TIMEOUT", 10))
+    RATE_SOURCES = [name.strip() for name in os.getenv("RATE_SOURCES", "coingecko,blockchain,cryptocompare,binance").split(",") if name.strip()]
+    RATE_COINGECKO_URL = os.getenv("RATE_COINGECKO_URL", "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=rub")
+    RATE_BLOCKCHAIN_URL = os.getenv("RATE_BLOCKCHAIN_URL", "https://blockchain.info/ticker")
+    RATE_CRYPTOCOMPARE_URL = os.getenv("RATE_CRYPTOCOMPARE_URL", "https://min-api.cryptocompare.com/data/price?fsym=BTC&tsyms=RUB")
+    RATE_BINANCE_URL = os.getenv("RATE_BINANCE_URL", "https://api.binance.com/api/v3/ticker/price?symbol=BTCRUB")
+    RATE_SOURCE_TIMEOUT = float(os.getenv("RATE_SOURCE_TIMEOUT", 5))
+    RATE_OUTLIER_PCT = float(os.getenv("RATE_OUTLIER_PCT", 3))
+    RATE_MIN_SOURCES = int(os.getenv("RATE_MIN_SOURCES", 2))
+    QUOTE_TTL = float(os.getenv("QUOTE_TTL", 300))
+    # Telegram: ~30 сообщений/с на бота и 1 сообщение/с в один чат
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+    BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", 1))
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+    BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", 100))
+    BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+    BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
     DATABASE_URL = os.getenv("DATABASE_URL", "oswaldo_exchanger.db")
+    DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 4))
+    DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+    DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+    DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 16384))
+    DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", 256))
+    DB_WAL_AUTOCHECKPOINT = int(os.getenv("DB_WAL_AUTOCHECKPOINT", 1000))
+    DB_CHECKPOINT_INTERVAL = float(os.getenv("DB_CHECKPOINT_INTERVAL", 30))
+    DB_CHECKPOINT_WAL_MB = float(os.getenv("DB_CHECKPOINT_WAL_MB", 4))
+    DB_CHECKPOINT_TRUNCATE_MB = float(os.getenv("DB_CHECKPOINT_TRUNCATE_MB", 64))
+    DB_SETTINGS_TTL = float(os.getenv("DB_SETTINGS_TTL", 0))
+    # sqlite - состояния FSM переживают перезапуск; memory - прежнее поведение
+    FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+    FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1))
+    FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 10000))
     ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", 0))
     ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", 0))
     OPERATOR_CHAT_ID = int(os.getenv("OPERATOR_CHAT_ID", 0))
     REVIEWS_CHANNEL_ID = int(os.getenv("REVIEWS_CHANNEL_ID", 0))
     CAPTCHA_ENABLED = os.getenv("CAPTCHA_ENABLED", "true").lower() == "true"
+    CAPTCHA_POOL_SIZE = int(os.getenv("CAPTCHA_POOL_SIZE", 32))
+    CAPTCHA_POOL_WORKERS = int(os.getenv("CAPTCHA_POOL_WORKERS", 2))
+    CAPTCHA_SESSION_TTL = int(os.getenv("CAPTCHA_SESSION_TTL", 600))
+    # Сохранять незавершённые капчи в БД при остановке и поднимать при старте
+    CAPTCHA_SESSION_SPILL = os.getenv("CAPTCHA_SESSION_SPILL", "true").lower() == "true"
     MIN_AMOUNT = int(os.getenv("MIN_AMOUNT", 1000))
     MAX_AMOUNT = int(os.getenv("MAX_AMOUNT", 500000))
     BOT_USERNAME = os.getenv("BOT_USERNAME", "OswbitExchanger_bot")
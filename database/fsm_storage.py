@@ -0,0 +1,159 @@
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import config
+from database import queries
+from database.models import Database
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("state", "data")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM в таблице fsm_states: горячие ключи в памяти, запись в БД отложенная и пакетная"""
+
+    def __init__(self, db: Database, flush_interval: float = 1.0, max_cached: int = 10000):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_cached = max_cached
+        self.flushes = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self._closed = False
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        name = self._key(key)
+        entry = self._entries.get(name)
+        if entry is not None:
+            self._entries.move_to_end(name)
+            return entry
+        async with self.db.reader() as db:
+            async with db.execute(queries.FSM_STATE, (name,)) as cursor:
+                row = await cursor.fetchone()
+        # Пока ждали БД, ключ мог появиться в памяти - он свежее
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = _Entry(row['state'], json.loads(row['data'])) if row else _Entry()
+            self._entries[name] = entry
+            self._evict()
+        return entry
+
+    def _evict(self):
+        # Вытесняем только записанные в БД ключи; грязные ждут сброса, только что загруженный остаётся
+        if len(self._entries) <= self.max_cached:
+            return
+        for name in list(self._entries)[:-1]:
+            if len(self._entries) <= self.max_cached:
+                break
+            if name not in self._dirty:
+                del self._entries[name]
+
+    def _touch(self, key: StorageKey):
+        self._dirty.add(self._key(key))
+        if not self._closed and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Все изменения за интервал (в т.ч. несколько update_data в одном апдейте) уходят одной транзакцией
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if not self._dirty:
+                return
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            names, self._dirty = self._dirty, set()
+            upserts, deletes = [], []
+            for name in list(names):
+                entry = self._entries.get(name)
+                if entry is None or (entry.state is None and not entry.data):
+                    deletes.append((name,))
+                    continue
+                try:
+                    data = json.dumps(entry.data, ensure_ascii=False)
+                except (TypeError, ValueError) as e:
+                    # Повтор не поможет: ключ живёт только в памяти, пока данные не станут сериализуемыми
+                    logger.error(f"FSM data for {name} is not JSON serializable, not persisted: {e}")
+                    names.discard(name)
+                    continue
+                upserts.append((name, entry.state, data))
+            try:
+                async with self.db.writer() as db:
+                    if upserts:
+                        await db.executemany('''
+                            INSERT OR REPLACE INTO fsm_states (key, state, data, updated_at)
+                            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ''', upserts)
+                    if deletes:
+                        await db.executemany('DELETE FROM fsm_states WHERE key = ?', deletes)
+                    await db.commit()
+                self.flushes += 1
+            except asyncio.CancelledError:
+                # Повторная запись идемпотентна: INSERT OR REPLACE последнего состояния
+                self._dirty |= names
+                raise
+            except Exception as e:
+                # Не теряем изменения: вернём ключи в очередь на следующий сброс
+                self._dirty |= names
+                logger.error(f"FSM flush failed ({len(names)} keys): {e}")
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._touch(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry.data = data.copy()
+        self._touch(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._entry(key)).data.copy()
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    if config.FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(
+        Database(config.DATABASE_URL),
+        flush_interval=config.FSM_FLUSH_INTERVAL,
+        max_cached=config.FSM_CACHE_SIZE,
+    )
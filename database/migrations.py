@@ -0,0 +1,398 @@
+import asyncio
+import logging
+import re
+import sys
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Tuple
+
+import aiosqlite
+
+from database import queries
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[aiosqlite.Connection], Awaitable[None]]
+
+
+async def _column_names(db: aiosqlite.Connection, table: str) -> List[str]:
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+
+async def _add_column(db: aiosqlite.Connection, table: str, column: str, definition: str):
+    if column not in await _column_names(db, table):
+        await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+async def _baseline_schema(db: aiosqlite.Connection):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER UNIQUE NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            phone_number TEXT,
+            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_blocked BOOLEAN DEFAULT FALSE,
+            referral_code TEXT,
+            referred_by INTEGER,
+            total_operations INTEGER DEFAULT 0,
+            total_amount REAL DEFAULT 0
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            onlypays_id TEXT,
+            pspware_id TEXT,
+            amount_rub REAL NOT NULL,
+            amount_btc REAL,
+            btc_address TEXT NOT NULL,
+            rate REAL NOT NULL,
+            total_amount REAL NOT NULL,
+            payment_type TEXT NOT NULL,
+            status TEXT DEFAULT 'waiting',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP,
+            requisites TEXT,
+            is_problematic BOOLEAN DEFAULT FALSE,
+            operator_notes TEXT,
+            personal_id TEXT
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS captcha_sessions (
+            user_id INTEGER PRIMARY KEY,
+            answer TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS referral_bonuses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            status TEXT DEFAULT 'pending'
+        )
+    ''')
+
+
+async def _users_referral_count(db: aiosqlite.Connection):
+    await _add_column(db, "users", "referral_count", "INTEGER DEFAULT 0")
+
+
+async def _access_path_indexes(db: aiosqlite.Connection):
+    # get_user_orders: WHERE user_id = ? ORDER BY created_at DESC
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders (user_id, created_at)')
+    # Списки заявок в админке: WHERE status = ? ORDER BY created_at DESC (покрывающий)
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_status_created
+        ON orders (status, created_at, user_id, total_amount, personal_id)
+    ''')
+    # Последние заявки без фильтра
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at)')
+    # get_statistics: WHERE DATE(created_at) = DATE('now')
+    await db.execute('''
+        CREATE INDEX IF NOT EXISTS idx_orders_created_date
+        ON orders (DATE(created_at), status, total_amount)
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_personal_id ON orders (personal_id)')
+
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users (referred_by)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_registration_date ON users (registration_date)')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_users_total_operations ON users (total_operations)')
+
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_reviews_user_created ON reviews (user_id, created_at)')
+
+
+async def _quotes(db: aiosqlite.Connection):
+    # Котировка неизменяема: id выдаётся один раз, переоценка создаёт новую строку
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS quotes (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            direction TEXT NOT NULL,
+            rate REAL NOT NULL,
+            commission_percentage REAL NOT NULL,
+            amount_rub REAL NOT NULL,
+            amount_btc REAL NOT NULL,
+            total_amount REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_quotes_expires ON quotes (expires_at)')
+    await _add_column(db, "orders", "quote_id", "TEXT")
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_orders_quote_id ON orders (quote_id)')
+
+
+async def _broadcasts(db: aiosqlite.Connection):
+    # last_user_id - граница, до которой (включительно) рассылка уже обработана
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            audience TEXT NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            text TEXT,
+            progress_message_id INTEGER,
+            status TEXT DEFAULT 'running',
+            last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)')
+
+
+async def _fsm_states(db: aiosqlite.Connection):
+    # key: bot_id:chat_id:user_id:thread_id:destiny; data - JSON
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+async def _cluster_state(db: aiosqlite.Connection):
+    # Значения, которые лидер кластера публикует для остальных воркеров; updated_at - unix time
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cluster_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+
+async def _order_provider_columns(db: aiosqlite.Connection):
+    # Колонки, которые код уже пишет (update_order, реквизиты Greengo), но которых не было в схеме
+    await _add_column(db, "orders", "greengo_id", "TEXT")
+    await _add_column(db, "orders", "received_sum", "REAL")
+    await _add_column(db, "orders", "note", "TEXT")
+    # Частичный индекс: сверка статусов ходит только по ожидающим оплаты заявкам
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_waiting ON orders (created_at) WHERE status = 'waiting'")
+
+
+async def _provider_id_indexes(db: aiosqlite.Connection):
+    # Callback провайдера может нести только его собственный id заявки
+    for column in ("onlypays_id", "pspware_id", "greengo_id"):
+        await db.execute(f"CREATE INDEX IF NOT EXISTS idx_orders_{column} ON orders ({column})")
+
+
+async def _payment_events(db: aiosqlite.Connection):
+    # Журнал callback-ов провайдеров только на добавление; уникальный ключ отсекает повторы
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS payment_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            provider TEXT NOT NULL,
+            provider_order_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            order_id INTEGER,
+            received_sum REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_payment_events_key
+        ON payment_events (provider, provider_order_id, status)
+    ''')
+
+
+async def _jobs(db: aiosqlite.Connection):
+    # run_at и lease_until - unix time: задачи переживают перезапуск процесса
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            run_at REAL NOT NULL,
+            lease_until REAL,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (run_at) WHERE status = 'pending'")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (lease_until) WHERE status = 'running'")
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, updated_at)')
+
+
+async def _jobs_dedup_key(db: aiosqlite.Connection):
+    # Не больше одной незавершённой задачи на ключ (например, реквизиты одной заявки)
+    await _add_column(db, "jobs", "dedup_key", "TEXT")
+    await db.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_key ON jobs (dedup_key)
+        WHERE status IN ('pending', 'running')
+    ''')
+
+
+async def _order_nicepay_id(db: aiosqlite.Connection):
+    # merchantOrderId заявки в NicePay: по нему callback отличают от проигравших параллельных запросов
+    await _add_column(db, "orders", "nicepay_id", "TEXT")
+    await db.execute('''
+        UPDATE orders SET nicepay_id = personal_id
+        WHERE requisites LIKE '%(NicePay)%' AND onlypays_id IS NULL AND pspware_id IS NULL AND greengo_id IS NULL
+    ''')
+
+
+async def _order_requisites_claim(db: aiosqlite.Connection):
+    # Попытка задачи, которой принадлежит запрос реквизитов заявки у провайдера
+    await _add_column(db, "orders", "requisites_job_id", "INTEGER")
+    await _add_column(db, "orders", "requisites_attempt", "INTEGER")
+
+
+async def _order_requisites_claimed_until(db: aiosqlite.Connection):
+    # До какого момента попытка может ещё ждать ответа провайдера (конец SLA + запас)
+    await _add_column(db, "orders", "requisites_claimed_until", "REAL")
+
+
+# Номера версий только растут; применённая миграция никогда не меняется
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline schema", _baseline_schema),
+    Migration(2, "users.referral_count", _users_referral_count),
+    Migration(3, "access path indexes", _access_path_indexes),
+    Migration(4, "quotes", _quotes),
+    Migration(5, "broadcasts", _broadcasts),
+    Migration(6, "fsm_states", _fsm_states),
+    Migration(7, "cluster_state", _cluster_state),
+    Migration(8, "order provider columns", _order_provider_columns),
+    Migration(9, "provider id indexes", _provider_id_indexes),
+    Migration(10, "payment_events", _payment_events),
+    Migration(11, "jobs", _jobs),
+    Migration(12, "jobs.dedup_key", _jobs_dedup_key),
+    Migration(13, "orders.nicepay_id", _order_nicepay_id),
+    Migration(14, "orders.requisites_job_id", _order_requisites_claim),
+    Migration(15, "orders.requisites_claimed_until", _order_requisites_claimed_until),
+]
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute("PRAGMA user_version") as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> int:
+    """Применяет недостающие миграции, каждую в своей транзакции"""
+    current = await get_schema_version(db)
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+        try:
+            await db.execute("BEGIN IMMEDIATE")
+            await migration.apply(db)
+            await db.execute(f"PRAGMA user_version = {migration.version}")
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.error(f"Migration {migration.version} ({migration.name}) failed")
+            raise
+        current = migration.version
+        logger.info(f"Applied migration {migration.version}: {migration.name}")
+    return current
+
+
+# Горячие запросы, которые обязаны идти по индексу: те же строки, что выполняет код, с примерами параметров
+HOT_QUERIES: Dict[str, Tuple[str, tuple]] = {
+    "get_user_orders": (queries.USER_ORDERS, (1, 5)),
+    "orders_by_status": (queries.ORDERS_BY_STATUS, ("completed", 10)),
+    "pending_orders": (queries.PENDING_ORDERS, ()),
+    "recent_orders": (queries.RECENT_ORDERS, ()),
+    "completed_volume": (queries.COMPLETED_VOLUME, ()),
+    "today_orders": (queries.TODAY_ORDERS, ()),
+    "today_volume": (queries.TODAY_VOLUME, ()),
+    "order_search": (queries.ORDER_SEARCH, ("1", "1")),
+    "waiting_orders": (queries.WAITING_ORDERS, ("-86400 seconds",)),
+    **{
+        f"order_by_{column}": (queries.ORDER_BY_PROVIDER_ID.format(column=column), ("1",))
+        for column in ("onlypays_id", "pspware_id", "greengo_id")
+    },
+    "referral_count": (queries.REFERRAL_COUNT, (1,)),
+    "find_user_by_username": (queries.USER_BY_USERNAME, ("user",)),
+    "recent_users": (queries.RECENT_USERS, ()),
+    **{
+        f"broadcast_recipients_{audience}": (queries.RECIPIENTS_PAGE.format(predicate=predicate), (0, 500))
+        for audience, predicate in queries.BROADCAST_AUDIENCES.items()
+    },
+    "last_review": (queries.LAST_REVIEW, (1,)),
+    "get_quote": (queries.GET_QUOTE, ("q",)),
+    "expired_quotes": (queries.DELETE_EXPIRED_QUOTES, (0,)),
+    "unfinished_broadcasts": (queries.UNFINISHED_BROADCASTS, ()),
+    "fsm_state": (queries.FSM_STATE, ("1:1:1::default",)),
+    "cluster_value": (queries.CLUSTER_VALUE, ("btc_rate",)),
+    "payment_event": (queries.DELETE_PAYMENT_EVENT, ("onlypays", "1", "finished")),
+    "due_jobs": (queries.DUE_JOBS.format(kinds="?"), (0, "requisites", 1)),
+    "expired_leases": (queries.EXPIRED_LEASES.format(kinds="?"), (0, "requisites", 1)),
+    "jobs_by_status": (queries.JOBS_BY_STATUS, ("dead", 10)),
+    "active_job_by_key": (queries.ACTIVE_JOB_BY_KEY, ("requisites:1",)),
+}
+
+_FULL_SCAN = re.compile(r'^SCAN (\w+)$')
+
+
+async def find_full_scans(db: aiosqlite.Connection) -> List[Tuple[str, str]]:
+    """EXPLAIN QUERY PLAN по HOT_QUERIES; возвращает (запрос, шаг плана) для полных сканов"""
+    problems = []
+    for name, (query, params) in HOT_QUERIES.items():
+        async with db.execute(f"EXPLAIN QUERY PLAN {query}", params) as cursor:
+            for row in await cursor.fetchall():
+                detail = row[3]
+                if _FULL_SCAN.match(detail.strip()):
+                    problems.append((name, detail))
+    return problems
+
+
+async def _check(db_path: str) -> int:
+    async with aiosqlite.connect(db_path) as db:
+        await migrate(db)
+        problems = await find_full_scans(db)
+    for name, detail in problems:
+        print(f"FULL SCAN in {name}: {detail}")
+    if not problems:
+        print(f"OK: {len(HOT_QUERIES)} hot queries use indexes")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    # python -m database.migrations [db_path]
+    from config import config
+    sys.exit(asyncio.run(_check(sys.argv[1] if len(sys.argv) > 1 else config.DATABASE_URL)))
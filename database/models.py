@@ -1,113 +1,100 @@
 from asyncio.log import logger
-import aiosqlite
+import asyncio
 import json
+import time
+import aiosqlite
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-import config
+from typing import Optional, List, Dict, Any, AsyncIterator, Iterable, Tuple
+from config import config
+from database.pool import ConnectionPool, StorageProfile
+from database import queries
+from database.migrations import migrate, find_full_scans
+from database.settings_cache import SettingsCache, encode_setting
 import os
 
+# Условия отбора получателей рассылки по аудиториям из админки
+BROADCAST_AUDIENCES: Dict[str, str] = queries.BROADCAST_AUDIENCES
+
+# Переходы статуса заявки: новый статус -> статусы, из которых в него можно попасть.
+# waiting -> waiting - получение реквизитов: статус тот же, меняются поля заявки.
+# Оплата, подтверждённая провайдером, важнее локальной отмены (поздний платёж);
+# из processing/problem в paid_by_client переводит только оператор.
+ORDER_TRANSITIONS: Dict[str, Tuple[str, ...]] = {
+    "waiting": ("waiting",),
+    "paid_by_client": ("waiting", "cancelled", "processing", "problem"),
+    "processing": ("waiting", "paid_by_client", "problem"),
+    "problem": ("waiting", "paid_by_client", "processing"),
+    "completed": ("paid_by_client", "processing", "problem"),
+    "cancelled": ("waiting", "paid_by_client", "processing", "problem"),
+}
+
+# Поля заявки, которые можно менять (status - только через transition_order)
+ORDER_FIELDS = (
+    'onlypays_id', 'pspware_id', 'greengo_id', 'nicepay_id', 'requisites',
+    'personal_id', 'received_sum', 'note', 'operator_notes',
+    'btc_address', 'completed_at', 'is_problematic'
+)
+
 class Database:
+    # Пулы и кэш настроек общие для всех экземпляров с одним путём к БД
+    _pools: Dict[str, ConnectionPool] = {}
+    _settings_caches: Dict[str, SettingsCache] = {}
+    _settings_locks: Dict[str, asyncio.Lock] = {}
+
     def __init__(self, db_path: str):
         self.db_path = db_path
 
-    async def get_commission_percentage(self):
-        return await self.get_setting("commission_percentage", float(os.getenv('COMMISSION_PERCENT', '20.0')))
+    @property
+    def pool(self) -> ConnectionPool:
+        pool = self._pools.get(self.db_path)
+        if pool is None:
+            pool = ConnectionPool(
+                self.db_path,
+                readers=config.DB_READ_POOL_SIZE,
+                profile=StorageProfile.from_config(config)
+            )
+            self._pools[self.db_path] = pool
+        return pool
 
-    async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY,
-                    user_id INTEGER UNIQUE NOT NULL,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    phone_number TEXT,
-                    registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_blocked BOOLEAN DEFAULT FALSE,
-                    referral_code TEXT,
-                    referred_by INTEGER,
-                    total_operations INTEGER DEFAULT 0,
-                    total_amount REAL DEFAULT 0
-                )
-            ''')
+    @property
+    def settings(self) -> SettingsCache:
+        cache = self._settings_caches.get(self.db_path)
+        if cache is None:
+            cache = SettingsCache(ttl=config.DB_SETTINGS_TTL)
+            self._settings_caches[self.db_path] = cache
+        return cache
 
-            await self._migrate_users_table(db)
+    @property
+    def _settings_lock(self) -> asyncio.Lock:
+        return self._settings_locks.setdefault(self.db_path, asyncio.Lock())
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS orders (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    onlypays_id TEXT,
-                    pspware_id TEXT,
-                    amount_rub REAL NOT NULL,
-                    amount_btc REAL,
-                    btc_address TEXT NOT NULL,
-                    rate REAL NOT NULL,
-                    total_amount REAL NOT NULL,
-                    payment_type TEXT NOT NULL,
-                    status TEXT DEFAULT 'waiting',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    completed_at TIMESTAMP,
-                    requisites TEXT,
-                    is_problematic BOOLEAN DEFAULT FALSE,
-                    operator_notes TEXT,
-                    personal_id TEXT
-                )
-            ''')
+    def reader(self):
+        return self.pool.reader()
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT NOT NULL
-                )
-            ''')
+    def writer(self):
+        return self.pool.writer()
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS captcha_sessions (
-                    user_id INTEGER PRIMARY KEY,
-                    answer TEXT NOT NULL,
-                    attempts INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+    async def close(self):
+        await self.pool.close()
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS referral_bonuses (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    amount REAL NOT NULL,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
+    async def get_commission_percentage(self):
+        return await self.get_setting("commission_percentage", float(os.getenv('COMMISSION_PERCENT', '20.0')))
 
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS reviews (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    status TEXT DEFAULT 'pending'
-                )
-            ''')
+    async def init_db(self):
+        await self.pool.open()
+        async with self.writer() as db:
+            version = await migrate(db)
+        logger.info(f"Database schema version: {version}")
 
-            await db.commit()
+        async with self.reader() as db:
+            for query_name, detail in await find_full_scans(db):
+                logger.warning(f"Hot query '{query_name}' does a full scan: {detail}")
 
-    async def _migrate_users_table(self, db):
-        cursor = await db.execute("PRAGMA table_info(users)")
-        columns = await cursor.fetchall()
-        column_names = [col[1] for col in columns]
-        
-        if 'referral_count' not in column_names:
-            await db.execute('ALTER TABLE users ADD COLUMN referral_count INTEGER DEFAULT 0')
-        
-        await db.commit()
+        await self.reload_settings()
 
     async def add_user(self, user_id: int, username: str = None, 
                       first_name: str = None, last_name: str = None) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             try:
                 await db.execute('''
                     INSERT INTO users (user_id, username, first_name, last_name)
@@ -116,11 +103,11 @@ class Database:
                 await db.commit()
                 return True
             except aiosqlite.IntegrityError:
+                await db.rollback()
                 return False
 
     async def get_user(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.reader() as db:
             async with db.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
@@ -132,24 +119,49 @@ class Database:
         fields = ', '.join([f"{key} = ?" for key in kwargs.keys()])
         values = list(kwargs.values()) + [user_id]
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute(f'UPDATE users SET {fields} WHERE user_id = ?', values)
             await db.commit()
 
     async def create_order(self, user_id: int, amount_rub: float, amount_btc: float,
-                        btc_address: str, rate: float, total_amount: float, payment_type: str) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
+                        btc_address: str, rate: float, total_amount: float, payment_type: str,
+                        quote_id: str = None) -> int:
+        async with self.writer() as db:
             cursor = await db.execute('''
-                INSERT INTO orders (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type))
+                INSERT INTO orders (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type, quote_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, amount_rub, amount_btc, btc_address, rate, total_amount, payment_type, quote_id))
             await db.commit()
             return cursor.lastrowid
 
+    async def create_quote(self, id: str, user_id: int, direction: str, rate: float,
+                           commission_percentage: float, amount_rub: float, amount_btc: float,
+                           total_amount: float, expires_at: float):
+        async with self.writer() as db:
+            await db.execute('''
+                INSERT INTO quotes (id, user_id, direction, rate, commission_percentage,
+                                    amount_rub, amount_btc, total_amount, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (id, user_id, direction, rate, commission_percentage, amount_rub, amount_btc, total_amount, expires_at))
+            await db.commit()
+
+    async def get_quote(self, quote_id: str) -> Optional[Dict]:
+        async with self.reader() as db:
+            async with db.execute(queries.GET_QUOTE, (quote_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def delete_expired_quotes(self, before: float) -> int:
+        """Удаляет истёкшие котировки, на которые не ссылается ни одна заявка"""
+        async with self.writer() as db:
+            cursor = await db.execute(queries.DELETE_EXPIRED_QUOTES, (before,))
+            await db.commit()
+            return cursor.rowcount
+
 
 
     async def get_order_total_amount(self, order_id: int) -> Optional[float]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.reader() as db:
             async with db.execute('SELECT total_amount FROM orders WHERE id = ?', (order_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
@@ -159,14 +171,13 @@ class Database:
 
 
     async def get_order(self, order_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.reader() as db:
             async with db.execute('SELECT * FROM orders WHERE id = ?', (order_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def save_review(self, user_id: int, text: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             current_time = datetime.now().isoformat()
             
             cursor = await db.execute(
@@ -177,18 +188,15 @@ class Database:
             return cursor.lastrowid
 
     async def get_last_review_time(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute(
-                'SELECT created_at FROM reviews WHERE user_id = ? ORDER BY created_at DESC LIMIT 1',
-                (user_id,)
-            ) as cursor:
+        async with self.reader() as db:
+            async with db.execute(queries.LAST_REVIEW, (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 if row:
                     return datetime.fromisoformat(row[0])
                 return None
 
     async def update_review_status(self, review_id: int, status: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute(
                 'UPDATE reviews SET status = ? WHERE id = ?',
                 (status, review_id)
@@ -198,36 +206,125 @@ class Database:
 
 
 
-    async def update_order(self, order_id: int, **kwargs):
-        """Обновление заявки в базе данных"""
-        if not kwargs:
-            return
+    async def claim_order_requisites(self, order_id: int, job_id: int, attempt: int, until: float) -> bool:
+        """Закрепляет запрос реквизитов заявки за попыткой задачи до момента until.
 
-        # Разрешённые для обновления поля (добавлен received_sum)
-        allowed_fields = [
-            'onlypays_id', 'pspware_id', 'status', 'requisites',
-            'personal_id', 'received_sum', 'note', 'operator_notes',
-            'btc_address', 'completed_at', 'is_problematic'
-        ]
+        Захват держится, пока попытка его не снимет или не наступит until, даже если аренду
+        задачи уже перехватили: прежняя попытка может ещё ждать провайдера. until - граница,
+        дальше которой её запрос к провайдеру идти не может.
+        """
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                UPDATE orders SET requisites_job_id = ?, requisites_attempt = ?, requisites_claimed_until = ?
+                WHERE id = ? AND status = 'waiting' AND requisites IS NULL
+                  AND (requisites_claimed_until IS NULL OR requisites_claimed_until < ?)
+            ''', (job_id, attempt, until, order_id, time.time()))
+            await db.commit()
+            return cursor.rowcount == 1
+
+    async def release_order_requisites(self, order_id: int, job_id: int, attempt: int):
+        """Снимает захват, если он ещё принадлежит этой попытке"""
+        async with self.writer() as db:
+            await db.execute('''
+                UPDATE orders SET requisites_claimed_until = NULL
+                WHERE id = ? AND requisites_job_id = ? AND requisites_attempt = ?
+            ''', (order_id, job_id, attempt))
+            await db.commit()
 
+    async def find_order_id(self, provider_column: str, provider_order_id: str) -> Optional[int]:
+        """id заявки по id у провайдера (onlypays_id / pspware_id / greengo_id)"""
+        if provider_column not in ('onlypays_id', 'pspware_id', 'greengo_id'):
+            raise ValueError(f"unknown provider column {provider_column}")
+        async with self.reader() as db:
+            async with db.execute(
+                queries.ORDER_BY_PROVIDER_ID.format(column=provider_column), (str(provider_order_id),)
+            ) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    async def record_payment_event(self, provider: str, provider_order_id: str, status: str,
+                                   order_id: Optional[int] = None, received_sum: Optional[float] = None) -> bool:
+        """Записывает событие провайдера; False - такое (provider, provider_order_id, status) уже было"""
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO payment_events (provider, provider_order_id, status, order_id, received_sum)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (provider, str(provider_order_id), status, order_id, received_sum))
+            await db.commit()
+            return cursor.rowcount == 1
+
+    async def delete_payment_event(self, provider: str, provider_order_id: str, status: str):
+        async with self.writer() as db:
+            await db.execute(queries.DELETE_PAYMENT_EVENT, (provider, str(provider_order_id), status))
+            await db.commit()
+
+    async def get_waiting_orders(self, max_age: float) -> List[Dict]:
+        """Ожидающие оплаты заявки с id у провайдера, не старше max_age секунд"""
+        async with self.reader() as db:
+            async with db.execute(queries.WAITING_ORDERS, (f"-{int(max_age)} seconds",)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    @staticmethod
+    def _order_set_clause(fields: Dict[str, Any]) -> Tuple[List[str], List[Any]]:
         set_clause = []
         values = []
-
-        for field, value in kwargs.items():
-            if field in allowed_fields:
+        for field, value in fields.items():
+            if field in ORDER_FIELDS:
                 set_clause.append(f"{field} = ?")
                 values.append(value)
             else:
                 logger.warning(f"Attempt to update forbidden field '{field}' in orders table ignored")
+        return set_clause, values
+
+    async def update_order(self, order_id: int, **kwargs):
+        """Обновление полей заявки; статус меняется только через transition_order"""
+        if not kwargs:
+            return
+
+        set_clause, values = self._order_set_clause(kwargs)
 
         if set_clause:
             values.append(order_id)
             query = f"UPDATE orders SET {', '.join(set_clause)} WHERE id = ?"
 
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self.writer() as db:
                 await db.execute(query, tuple(values))
                 await db.commit()
 
+    async def transition_order(self, order_id: int, status: str, expected: Optional[Iterable[str]] = None,
+                               **fields) -> Optional[Dict]:
+        """Переход заявки в status одним UPDATE ... RETURNING.
+
+        expected сужает ORDER_TRANSITIONS[status] для конкретного пути (например, отмена
+        провайдером только из waiting). Возвращает обновлённую заявку или None, если
+        заявки нет или её текущий статус не допускает переход - из двух одновременных
+        переходов проходит только первый.
+        """
+        allowed = ORDER_TRANSITIONS.get(status)
+        if allowed is None:
+            raise ValueError(f"unknown order status {status}")
+        sources = [source for source in (expected or allowed) if source in allowed]
+        if not sources:
+            raise ValueError(f"no allowed transition to {status} from {tuple(expected)}")
+
+        set_clause, values = self._order_set_clause(fields)
+        set_clause.insert(0, "status = ?")
+        values.insert(0, status)
+        if status == "completed" and "completed_at" not in fields:
+            set_clause.append("completed_at = CURRENT_TIMESTAMP")
+        values.append(order_id)
+        values.extend(sources)
+        query = (
+            f"UPDATE orders SET {', '.join(set_clause)} "
+            f"WHERE id = ? AND status IN ({', '.join('?' * len(sources))}) RETURNING *"
+        )
+
+        async with self.writer() as db:
+            async with db.execute(query, tuple(values)) as cursor:
+                row = await cursor.fetchone()
+            await db.commit()
+        return dict(row) if row else None
+
 
 
 
@@ -235,11 +332,8 @@ class Database:
         """
         Получение последних заявок пользователя с сортировкой по дате создания
         """
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('''
-                SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
-            ''', (user_id, limit)) as cursor:
+        async with self.reader() as db:
+            async with db.execute(queries.USER_ORDERS, (user_id, limit)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
@@ -247,62 +341,252 @@ class Database:
 
 
 
+    async def reload_settings(self):
+        async with self._settings_lock:
+            async with self.reader() as db:
+                async with db.execute('SELECT key, value FROM settings') as cursor:
+                    rows = await cursor.fetchall()
+            self.settings.replace(rows)
+
+    async def _refresh_settings(self):
+        try:
+            await self.reload_settings()
+        except Exception as e:
+            logger.error(f"Settings refresh error: {e}")
+        finally:
+            self.settings.refreshing = False
+
+    async def ensure_settings(self) -> SettingsCache:
+        settings = self.settings
+        if not settings.loaded:
+            await self.reload_settings()
+        elif settings.stale and not settings.refreshing:
+            # Отдаём текущее значение, обновление идёт в фоне
+            settings.refreshing = True
+            asyncio.create_task(self._refresh_settings())
+        return settings
+
     async def get_setting(self, key: str, default: Any = None) -> Any:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT value FROM settings WHERE key = ?', (key,)) as cursor:
-                row = await cursor.fetchone()
-                if row:
-                    try:
-                        return json.loads(row[0])
-                    except:
-                        return row[0]
-                return default
+        settings = await self.ensure_settings()
+        return settings.get(key, default)
 
     async def set_setting(self, key: str, value: Any):
-        if isinstance(value, (dict, list)):
-            value = json.dumps(value)
-        else:
-            value = str(value)
-        
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute('''
                 INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)
-            ''', (key, value))
+            ''', (key, encode_setting(value)))
             await db.commit()
+        self.settings.put(key, value)
+
+    async def iter_recipients(self, audience: str, after_user_id: int = 0,
+                              chunk_size: int = 500) -> AsyncIterator[List[int]]:
+        """Получатели рассылки страницами по user_id (keyset): память не растёт с числом пользователей"""
+        predicate = BROADCAST_AUDIENCES[audience]
+        while True:
+            # Соединение берётся на одну страницу и не держится, пока идёт отправка
+            async with self.reader() as db:
+                async with db.execute(
+                    queries.RECIPIENTS_PAGE.format(predicate=predicate), (after_user_id, chunk_size)
+                ) as cursor:
+                    page = [row[0] for row in await cursor.fetchall()]
+            if not page:
+                return
+            yield page
+            if len(page) < chunk_size:
+                return
+            after_user_id = page[-1]
+
+    async def count_recipients(self, audience: str, after_user_id: int = 0) -> int:
+        predicate = BROADCAST_AUDIENCES[audience]
+        async with self.reader() as db:
+            async with db.execute(
+                f'SELECT COUNT(*) FROM users WHERE {predicate} AND user_id > ?', (after_user_id,)
+            ) as cursor:
+                return (await cursor.fetchone())[0]
 
-    async def get_all_users(self) -> List[int]:
-        async with aiosqlite.connect(self.db_path) as db:
-            async with db.execute('SELECT user_id FROM users WHERE is_blocked = FALSE') as cursor:
-                rows = await cursor.fetchall()
-                return [row[0] for row in rows]
+    async def create_broadcast(self, audience: str, admin_chat_id: int, from_chat_id: Optional[int],
+                               message_id: Optional[int], text: Optional[str],
+                               progress_message_id: Optional[int]) -> int:
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                INSERT INTO broadcasts (audience, admin_chat_id, from_chat_id, message_id, text, progress_message_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (audience, admin_chat_id, from_chat_id, message_id, text, progress_message_id))
+            await db.commit()
+            return cursor.lastrowid
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        async with self.reader() as db:
+            async with db.execute('SELECT * FROM broadcasts WHERE id = ?', (broadcast_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
 
-    async def create_captcha_session(self, user_id: int, answer: str):
-        async with aiosqlite.connect(self.db_path) as db:
+    async def get_unfinished_broadcasts(self) -> List[Dict]:
+        async with self.reader() as db:
+            async with db.execute(queries.UNFINISHED_BROADCASTS) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int, failed: int,
+                                      total: int):
+        async with self.writer() as db:
             await db.execute('''
-                INSERT OR REPLACE INTO captcha_sessions (user_id, answer, attempts)
-                VALUES (?, ?, 0)
-            ''', (user_id, answer))
+                UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, total = ? WHERE id = ?
+            ''', (last_user_id, sent, failed, total, broadcast_id))
+            await db.commit()
+
+    async def finish_broadcast(self, broadcast_id: int, status: str):
+        async with self.writer() as db:
+            await db.execute(
+                'UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?',
+                (status, broadcast_id)
+            )
+            await db.commit()
+
+    async def save_captcha_sessions(self, rows: List[tuple]):
+        """rows: (user_id, answer, attempts, created_at)"""
+        async with self.writer() as db:
+            await db.executemany('''
+                INSERT OR REPLACE INTO captcha_sessions (user_id, answer, attempts, created_at)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+            await db.commit()
+
+    async def take_captcha_sessions(self, ttl: float, shard: Optional[int] = None,
+                                    shards: int = 1) -> List[Dict]:
+        """Забирает непросроченные сессии капчи и удаляет их; в кластере - только сессии своего воркера"""
+        condition, params = '', ()
+        if shard is not None and shards > 1:
+            condition, params = ' AND user_id % ? = ?', (shards, shard)
+        async with self.writer() as db:
+            async with db.execute(
+                'SELECT * FROM captcha_sessions WHERE created_at > datetime("now", ?)' + condition,
+                (f"-{int(ttl)} seconds",) + params
+            ) as cursor:
+                rows = [dict(row) for row in await cursor.fetchall()]
+            await db.execute('DELETE FROM captcha_sessions WHERE 1 = 1' + condition, params)
+            await db.commit()
+            return rows
+
+    async def set_cluster_value(self, key: str, value: Any):
+        async with self.writer() as db:
+            await db.execute(
+                'INSERT OR REPLACE INTO cluster_state (key, value, updated_at) VALUES (?, ?, ?)',
+                (key, encode_setting(value), time.time())
+            )
             await db.commit()
 
-    async def get_captcha_session(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute('SELECT * FROM captcha_sessions WHERE user_id = ?', (user_id,)) as cursor:
+    async def get_cluster_value(self, key: str) -> Optional[Dict]:
+        async with self.reader() as db:
+            async with db.execute(queries.CLUSTER_VALUE, (key,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
-    async def delete_captcha_session(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('DELETE FROM captcha_sessions WHERE user_id = ?', (user_id,))
+    async def enqueue_job(self, kind: str, payload: Dict[str, Any], max_attempts: int = 5,
+                          delay: float = 0, dedup_key: Optional[str] = None) -> Tuple[int, bool]:
+        """(id задачи, создана ли новая); при занятом dedup_key - id уже ожидающей или выполняющейся"""
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                INSERT OR IGNORE INTO jobs (kind, payload, max_attempts, run_at, dedup_key) VALUES (?, ?, ?, ?, ?)
+            ''', (kind, json.dumps(payload, ensure_ascii=False), max_attempts, time.time() + delay, dedup_key))
+            if cursor.rowcount == 1:
+                await db.commit()
+                return cursor.lastrowid, True
+            async with db.execute(queries.ACTIVE_JOB_BY_KEY, (dedup_key,)) as existing:
+                row = await existing.fetchone()
+            await db.commit()
+            return (row[0] if row else None), False
+
+    async def claim_jobs(self, kinds: List[str], limit: int, lease: float) -> List[Dict]:
+        """Берёт в работу до limit задач: созревшие pending и running с истёкшей арендой (упавший процесс)"""
+        if not kinds or limit <= 0:
+            return []
+        now = time.time()
+        placeholders = ', '.join('?' * len(kinds))
+        due = queries.DUE_JOBS.format(kinds=placeholders)
+        expired = queries.EXPIRED_LEASES.format(kinds=placeholders)
+        async with self.writer() as db:
+            async with db.execute(f'''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?,
+                                updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM ({due})
+                    UNION ALL
+                    SELECT id FROM ({expired})
+                    LIMIT ?
+                )
+                RETURNING *
+            ''', (now + lease, now, *kinds, limit, now, *kinds, limit, limit)) as cursor:
+                rows = await cursor.fetchall()
+            await db.commit()
+        return [dict(row) for row in rows]
+
+    async def _update_job(self, job_id: int, attempts: int, status: str, run_at: Optional[float] = None,
+                          error: Optional[str] = None, attempts_delta: int = 0) -> bool:
+        # attempts - номер попытки этого исполнителя: если аренду перехватили, запись не пройдёт
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                UPDATE jobs SET status = ?, run_at = COALESCE(?, run_at), last_error = COALESCE(?, last_error),
+                                attempts = attempts + ?, lease_until = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'running' AND attempts = ?
+            ''', (status, run_at, error, attempts_delta, job_id, attempts))
             await db.commit()
+            return cursor.rowcount == 1
+
+    async def renew_job(self, job_id: int, attempts: int, lease_until: float) -> bool:
+        """Продлевает аренду; False - задачу уже перехватил другой исполнитель"""
+        async with self.writer() as db:
+            cursor = await db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+                (lease_until, job_id, attempts)
+            )
+            await db.commit()
+            return cursor.rowcount == 1
+
+    async def finish_job(self, job_id: int, attempts: int) -> bool:
+        return await self._update_job(job_id, attempts, 'done')
+
+    async def retry_job(self, job_id: int, attempts: int, run_at: float, error: str) -> bool:
+        return await self._update_job(job_id, attempts, 'pending', run_at=run_at, error=error)
+
+    async def bury_job(self, job_id: int, attempts: int, error: str) -> bool:
+        return await self._update_job(job_id, attempts, 'dead', error=error)
+
+    async def release_job(self, job_id: int, attempts: int) -> bool:
+        """Возвращает прерванную остановкой задачу в очередь, не засчитывая попытку"""
+        return await self._update_job(job_id, attempts, 'pending', run_at=time.time(), attempts_delta=-1)
+
+    async def get_job_counts(self) -> Dict[str, int]:
+        async with self.reader() as db:
+            async with db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status') as cursor:
+                return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def get_jobs(self, status: str, limit: int = 10) -> List[Dict]:
+        async with self.reader() as db:
+            async with db.execute(queries.JOBS_BY_STATUS, (status, limit)) as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def requeue_dead_job(self, job_id: int, payload: Dict[str, Any]) -> bool:
+        """Возвращает задачу из dead-letter в очередь с новым запасом попыток.
+
+        False - задача уже не dead или по её dedup_key в очереди есть незавершённая.
+        """
+        async with self.writer() as db:
+            cursor = await db.execute('''
+                UPDATE jobs SET status = 'pending', attempts = 0, run_at = ?, payload = ?,
+                                updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'dead'
+                  AND NOT EXISTS (
+                      SELECT 1 FROM jobs AS active WHERE active.dedup_key = jobs.dedup_key
+                        AND active.status IN ('pending', 'running')
+                  )
+            ''', (time.time(), json.dumps(payload, ensure_ascii=False), job_id))
+            await db.commit()
+            return cursor.rowcount == 1
 
     async def update_referral_count(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             try:
-                async with db.execute(
-                    'SELECT COUNT(*) FROM users WHERE referred_by = ?', 
-                    (user_id,)
-                ) as cursor:
+                async with db.execute(queries.REFERRAL_COUNT, (user_id,)) as cursor:
                     count = (await cursor.fetchone())[0]
                     logger.info(f"Referral bonus for user {user_id}")
                 
@@ -313,19 +597,19 @@ class Database:
                 await db.commit()
                 return count
             except:
+                await db.rollback()
                 return 0
 
     async def get_referral_stats(self, user_id: int):
         """Получение статистики рефералов"""
         try:
             # Получаем количество рефералов
-            query1 = "SELECT COUNT(*) as count FROM users WHERE referred_by = ?"
-            result1 = await self.execute_query(query1, (user_id,))
+            result1 = await self.execute_query(queries.REFERRAL_COUNT, (user_id,))
             
             # execute_query возвращает список, берем первый элемент
             referral_count = 0
             if result1 and len(result1) > 0:
-                referral_count = result1[0]['count'] if 'count' in result1[0] else result1[0][0]
+                referral_count = next(iter(result1[0].values()))
             
             # Получаем баланс рефералов (можно добавить таблицу для этого)
             # Пока возвращаем 0, позже можно добавить логику расчета
@@ -343,7 +627,7 @@ class Database:
             }
 
     async def add_referral_bonus(self, user_id: int, amount: float):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.writer() as db:
             await db.execute('''
                 INSERT OR IGNORE INTO referral_bonuses 
                 (user_id, amount, created_at) 
@@ -352,8 +636,14 @@ class Database:
             await db.commit()
 
     async def execute_query(self, query: str, params: tuple = ()) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        # SELECT обслуживают читатели, всё остальное идёт через писателя
+        if query.lstrip()[:6].upper() == 'SELECT':
+            async with self.reader() as db:
+                async with db.execute(query, params) as cursor:
+                    rows = await cursor.fetchall()
+                    return [dict(row) for row in rows]
+
+        async with self.writer() as db:
             async with db.execute(query, params) as cursor:
                 rows = await cursor.fetchall()
                 await db.commit()
@@ -368,7 +658,7 @@ class Database:
         """
         Получение общей статистики системы
         """
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.reader() as db:
             # Общее количество пользователей
             async with db.execute('SELECT COUNT(*) FROM users') as cursor:
                 total_users = (await cursor.fetchone())[0]
@@ -382,15 +672,15 @@ class Database:
                 completed_orders = (await cursor.fetchone())[0]
 
             # Общий оборот: сумма total_amount по завершённым заявкам
-            async with db.execute('SELECT SUM(total_amount) FROM orders WHERE status = "completed"') as cursor:
+            async with db.execute(queries.COMPLETED_VOLUME) as cursor:
                 total_volume = (await cursor.fetchone())[0] or 0
 
             # Количество заявок, созданных сегодня (по created_at)
-            async with db.execute('SELECT COUNT(*) FROM orders WHERE DATE(created_at) = DATE("now")') as cursor:
+            async with db.execute(queries.TODAY_ORDERS) as cursor:
                 today_orders = (await cursor.fetchone())[0]
 
             # Общий оборот за сегодня по завершённым заявкам
-            async with db.execute('SELECT SUM(total_amount) FROM orders WHERE DATE(created_at) = DATE("now") AND status = "completed"') as cursor:
+            async with db.execute(queries.TODAY_VOLUME) as cursor:
                 today_volume = (await cursor.fetchone())[0] or 0
 
             completion_rate = (completed_orders / total_orders * 100) if total_orders > 0 else 0
@@ -434,8 +724,7 @@ class Database:
             await self.set_setting(f"chat_{chat_id}_title", chat_title)
 
     async def get_review(self, review_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.reader() as db:
             async with db.execute('SELECT * FROM reviews WHERE id = ?', (review_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
\ No newline at end of file
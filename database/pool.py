@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class StorageProfile:
+    """Параметры хранения SQLite: WAL, PRAGMA и пороги чекпоинтов"""
+    synchronous: str = "NORMAL"
+    busy_timeout_ms: int = 5000
+    cache_size_kb: int = 16384
+    mmap_size_mb: int = 256
+    wal_autocheckpoint: int = 1000
+    checkpoint_interval: float = 30.0
+    checkpoint_wal_mb: float = 4.0
+    checkpoint_truncate_mb: float = 64.0
+
+    @classmethod
+    def from_config(cls, config) -> "StorageProfile":
+        return cls(
+            synchronous=config.DB_SYNCHRONOUS,
+            busy_timeout_ms=config.DB_BUSY_TIMEOUT_MS,
+            cache_size_kb=config.DB_CACHE_SIZE_KB,
+            mmap_size_mb=config.DB_MMAP_SIZE_MB,
+            wal_autocheckpoint=config.DB_WAL_AUTOCHECKPOINT,
+            checkpoint_interval=config.DB_CHECKPOINT_INTERVAL,
+            checkpoint_wal_mb=config.DB_CHECKPOINT_WAL_MB,
+            checkpoint_truncate_mb=config.DB_CHECKPOINT_TRUNCATE_MB,
+        )
+
+    def pragmas(self) -> List[str]:
+        return [
+            f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}",
+            f"PRAGMA synchronous = {self.synchronous}",
+            f"PRAGMA cache_size = -{int(self.cache_size_kb)}",
+            f"PRAGMA mmap_size = {int(self.mmap_size_mb) * 1024 * 1024}",
+            "PRAGMA temp_store = MEMORY",
+        ]
+
+
+class ConnectionPool:
+    """Долгоживущие соединения SQLite: несколько читателей и один писатель"""
+
+    def __init__(self, db_path: str, readers: int = 4, profile: StorageProfile = None):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self.profile = profile or StorageProfile()
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._checkpointer: Optional["CheckpointScheduler"] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    @property
+    def wal_path(self) -> str:
+        return f"{self.db_path}-wal"
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path, timeout=self.profile.busy_timeout_ms / 1000)
+        conn.row_factory = aiosqlite.Row
+        for pragma in self.profile.pragmas():
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def open(self):
+        async with self._open_lock:
+            if self.is_open:
+                return
+            writer = await self._connect()
+            # journal_mode=WAL сохраняется в файле БД, достаточно выставить один раз
+            async with writer.execute("PRAGMA journal_mode = WAL") as cursor:
+                journal_mode = (await cursor.fetchone())[0]
+            await writer.execute(f"PRAGMA wal_autocheckpoint = {int(self.profile.wal_autocheckpoint)}")
+            readers = [await self._connect(readonly=True) for _ in range(self.readers_count)]
+            idle = asyncio.Queue()
+            for conn in readers:
+                idle.put_nowait(conn)
+            self._writer, self._readers, self._idle = writer, readers, idle
+            logger.info(
+                f"SQLite pool opened: {self.db_path} ({self.readers_count} readers + 1 writer, "
+                f"journal_mode={journal_mode})"
+            )
+
+    async def close(self):
+        await self.stop_checkpointer()
+        async with self._open_lock:
+            if not self.is_open:
+                return
+            async with self._write_lock:
+                writer, readers = self._writer, self._readers
+                self._writer, self._readers, self._idle = None, [], None
+                for conn in readers + [writer]:
+                    try:
+                        await conn.close()
+                    except Exception as e:
+                        logger.warning(f"Error closing SQLite connection: {e}")
+            logger.info(f"SQLite pool closed: {self.db_path}")
+
+    @asynccontextmanager
+    async def reader(self):
+        """Соединение только для чтения; возвращается в пул после использования"""
+        if not self.is_open:
+            await self.open()
+        idle = self._idle
+        conn = await idle.get()
+        try:
+            yield conn
+        finally:
+            idle.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Единственный писатель; запись сериализуется блокировкой"""
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+            except BaseException:
+                if conn.in_transaction:
+                    await conn.rollback()
+                raise
+
+    def wal_size(self) -> int:
+        try:
+            return os.path.getsize(self.wal_path)
+        except OSError:
+            return 0
+
+    def start_checkpointer(self):
+        if self._checkpointer is None:
+            self._checkpointer = CheckpointScheduler(self)
+        self._checkpointer.start()
+
+    async def stop_checkpointer(self):
+        if self._checkpointer is not None:
+            await self._checkpointer.stop()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "open": self.is_open,
+            "readers": self.readers_count,
+            "idle_readers": self._idle.qsize() if self._idle else 0,
+            "wal_size": self.wal_size(),
+        }
+        if self._checkpointer is not None:
+            stats.update(self._checkpointer.stats())
+        return stats
+
+
+class CheckpointScheduler:
+    """Фоновые чекпоинты WAL по порогу размера журнала"""
+
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.profile = pool.profile
+        self._task: Optional[asyncio.Task] = None
+        self._conn: Optional[aiosqlite.Connection] = None
+        self.checkpoints = 0
+        self.last_mode: Optional[str] = None
+        self.last_latency_ms: Optional[float] = None
+        self.last_result: Optional[tuple] = None
+        self.last_run_at: Optional[float] = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def _run(self):
+        passive_bytes = self.profile.checkpoint_wal_mb * 1024 * 1024
+        truncate_bytes = self.profile.checkpoint_truncate_mb * 1024 * 1024
+        while True:
+            await asyncio.sleep(self.profile.checkpoint_interval)
+            try:
+                size = self.pool.wal_size()
+                if size >= truncate_bytes:
+                    await self.checkpoint("TRUNCATE")
+                elif size >= passive_bytes:
+                    await self.checkpoint("PASSIVE")
+            except Exception as e:
+                logger.error(f"WAL checkpoint error: {e}")
+
+    async def checkpoint(self, mode: str = "PASSIVE") -> tuple:
+        # Отдельное соединение: PASSIVE не мешает ни читателям, ни писателю пула
+        if self._conn is None:
+            self._conn = await self.pool._connect()
+        wal_before = self.pool.wal_size()
+        started = time.perf_counter()
+        async with self._conn.execute(f"PRAGMA wal_checkpoint({mode})") as cursor:
+            result = tuple(await cursor.fetchone())
+        self.last_latency_ms = (time.perf_counter() - started) * 1000
+        self.last_mode = mode
+        self.last_result = result
+        self.last_run_at = time.time()
+        self.checkpoints += 1
+        logger.info(
+            f"WAL checkpoint {mode}: {self.last_latency_ms:.1f} ms, "
+            f"wal {wal_before} -> {self.pool.wal_size()} bytes, result={result}"
+        )
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "checkpoints": self.checkpoints,
+            "last_checkpoint_mode": self.last_mode,
+            "last_checkpoint_ms": self.last_latency_ms,
+            "last_checkpoint_result": self.last_result,
+            "last_checkpoint_at": self.last_run_at,
+        }
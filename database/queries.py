@@ -0,0 +1,73 @@
+"""SQL горячих запросов.
+
+Строки используются и в коде (models.py, fsm_storage.py, админка), и в HOT_QUERIES
+(migrations.py): EXPLAIN QUERY PLAN проверяет ровно те запросы, которые выполняет бот.
+Шаблоны с {...} подставляются через format перед выполнением.
+"""
+
+# Условия отбора получателей рассылки по аудиториям из админки
+BROADCAST_AUDIENCES = {
+    "all": "is_blocked = FALSE",
+    "active": "total_operations > 0",
+    "new": "registration_date > datetime('now', '-7 days')",
+    "traders": "total_operations >= 1",
+}
+
+# Заявки
+USER_ORDERS = 'SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC LIMIT ?'
+ORDERS_BY_STATUS = (
+    'SELECT id, user_id, total_amount, created_at, personal_id FROM orders '
+    'WHERE status = ? ORDER BY created_at DESC LIMIT ?'
+)
+PENDING_ORDERS = (
+    'SELECT id, user_id, total_amount, created_at, personal_id FROM orders '
+    'WHERE status IN ("waiting", "paid_by_client") ORDER BY created_at DESC'
+)
+RECENT_ORDERS = (
+    'SELECT id, user_id, total_amount, status, created_at, personal_id '
+    'FROM orders ORDER BY created_at DESC LIMIT 10'
+)
+ORDER_SEARCH = (
+    'SELECT id, user_id, amount_rub, amount_btc, btc_address, total_amount, status, '
+    'created_at, personal_id, payment_type, rate FROM orders WHERE id = ? OR personal_id = ?'
+)
+COMPLETED_VOLUME = 'SELECT SUM(total_amount) FROM orders WHERE status = "completed"'
+TODAY_ORDERS = 'SELECT COUNT(*) FROM orders WHERE DATE(created_at) = DATE("now")'
+TODAY_VOLUME = 'SELECT SUM(total_amount) FROM orders WHERE DATE(created_at) = DATE("now") AND status = "completed"'
+WAITING_ORDERS = '''
+    SELECT id, user_id, onlypays_id, pspware_id, greengo_id, total_amount, created_at
+    FROM orders
+    WHERE status = 'waiting' AND created_at > datetime('now', ?)
+      AND (onlypays_id IS NOT NULL OR pspware_id IS NOT NULL OR greengo_id IS NOT NULL)
+'''
+ORDER_BY_PROVIDER_ID = 'SELECT id FROM orders WHERE {column} = ?'
+
+# Пользователи
+REFERRAL_COUNT = 'SELECT COUNT(*) FROM users WHERE referred_by = ?'
+USER_BY_USERNAME = 'SELECT user_id FROM users WHERE username = ? COLLATE NOCASE'
+RECENT_USERS = (
+    'SELECT user_id, username, first_name, registration_date, total_operations '
+    'FROM users ORDER BY registration_date DESC LIMIT 10'
+)
+RECIPIENTS_PAGE = 'SELECT user_id FROM users WHERE {predicate} AND user_id > ? ORDER BY user_id LIMIT ?'
+LAST_REVIEW = 'SELECT created_at FROM reviews WHERE user_id = ? ORDER BY created_at DESC LIMIT 1'
+
+# Котировки, рассылки, FSM, состояние кластера
+GET_QUOTE = 'SELECT * FROM quotes WHERE id = ?'
+DELETE_EXPIRED_QUOTES = (
+    'DELETE FROM quotes WHERE expires_at < ? '
+    'AND NOT EXISTS (SELECT 1 FROM orders WHERE orders.quote_id = quotes.id)'
+)
+UNFINISHED_BROADCASTS = 'SELECT * FROM broadcasts WHERE status = "running" ORDER BY id'
+FSM_STATE = 'SELECT state, data FROM fsm_states WHERE key = ?'
+CLUSTER_VALUE = 'SELECT value, updated_at FROM cluster_state WHERE key = ?'
+
+# События провайдеров и очередь задач
+DELETE_PAYMENT_EVENT = 'DELETE FROM payment_events WHERE provider = ? AND provider_order_id = ? AND status = ?'
+DUE_JOBS = "SELECT id FROM jobs WHERE status = 'pending' AND run_at <= ? AND kind IN ({kinds}) ORDER BY run_at LIMIT ?"
+EXPIRED_LEASES = "SELECT id FROM jobs WHERE status = 'running' AND lease_until < ? AND kind IN ({kinds}) LIMIT ?"
+JOBS_BY_STATUS = (
+    'SELECT id, kind, payload, attempts, max_attempts, run_at, last_error, updated_at '
+    'FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?'
+)
+ACTIVE_JOB_BY_KEY = "SELECT id FROM jobs WHERE dedup_key = ? AND status IN ('pending', 'running')"
@@ -0,0 +1,93 @@
+import json
+import logging
+import time
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def _to_bool(value: Any) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes', 'on', 'enabled')
+    return bool(value)
+
+
+def _to_list(value: Any) -> list:
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    raise ValueError(f"not a list: {value!r}")
+
+
+# Типы известных настроек; остальные ключи отдаются как есть
+SETTING_TYPES: Dict[str, Callable[[Any], Any]] = {
+    "commission_percentage": float,
+    "min_amount": int,
+    "max_amount": int,
+    "captcha_enabled": _to_bool,
+    "welcome_message": str,
+    "admin_users": _to_list,
+    "operator_users": _to_list,
+    "admin_chats": _to_list,
+    "requisites_sla_seconds": int,
+}
+
+
+def decode_setting(raw: str) -> Any:
+    try:
+        return json.loads(raw)
+    except (TypeError, ValueError):
+        return raw
+
+
+def encode_setting(value: Any) -> str:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+class SettingsCache:
+    """Таблица settings целиком в памяти; запись идёт сквозь кэш"""
+
+    def __init__(self, ttl: float = 0):
+        self.ttl = ttl
+        self.version = 0
+        self.loaded_at = None
+        self.refreshing = False
+        self._values: Dict[str, Any] = {}
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    @property
+    def stale(self) -> bool:
+        return self.ttl > 0 and self.loaded and time.monotonic() - self.loaded_at >= self.ttl
+
+    def replace(self, rows):
+        values = {key: decode_setting(raw) for key, raw in rows}
+        if values != self._values:
+            self._values = values
+            self.version += 1
+        self.loaded_at = time.monotonic()
+
+    def put(self, key: str, value: Any):
+        self._values[key] = decode_setting(encode_setting(value))
+        self.version += 1
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self._values:
+            return default
+        value = self._values[key]
+        cast = SETTING_TYPES.get(key)
+        if cast is not None:
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                logger.warning(f"Setting '{key}' has unexpected value {value!r}, using default")
+                return default
+        # Наружу отдаём копии, чтобы вызывающий код не мутировал кэш
+        if isinstance(value, list):
+            return list(value)
+        if isinstance(value, dict):
+            return dict(value)
+        return value
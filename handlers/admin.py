@@ -1,6 +1,7 @@
+import html
+import json
 import logging
-from datetime import datetime, timedelta
-import aiosqlite
+from datetime import datetime
 import os
 import psutil
 from aiogram import Router, F
@@ -10,10 +11,15 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.enums import ChatType
+from database import queries
 from database.models import Database
 from keyboards.reply import ReplyKeyboards
 from config import config
 from api.pspware_api import PSPWareAPI
+from api.circuit_breaker import gateway_breakers, format_breakers
+from utils.crypto_rates import rate_service, rate_aggregator
+from utils.broadcast import broadcast_engine
+from utils.jobs import job_queue
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +37,15 @@ class AdminStates(StatesGroup):
     waiting_for_message_to_user = State()
     waiting_for_block_reason = State()
     waiting_for_order_id = State()
+    waiting_for_sla = State()
+
+# Кнопка админки -> аудитория в BROADCAST_AUDIENCES
+BROADCAST_ACTIONS = {
+    "broadcast_all": "all",
+    "broadcast_active": "active",
+    "broadcast_new": "new",
+    "broadcast_traders": "traders",
+}
 
 def normalize_bool(value):
     if isinstance(value, str):
@@ -98,6 +113,9 @@ def create_settings_panel():
         InlineKeyboardButton(text="💰 Лимиты сумм", callback_data="admin_change_limits"),
         InlineKeyboardButton(text="📝 Приветствие", callback_data="admin_change_welcome")
     )
+    builder.row(
+        InlineKeyboardButton(text="⏱ SLA реквизитов", callback_data="admin_change_sla")
+    )
     builder.row(
         InlineKeyboardButton(text="◀️ Назад", callback_data="admin_main_panel")
     )
@@ -169,6 +187,9 @@ def create_system_panel():
         InlineKeyboardButton(text="🧹 Очистить БД", callback_data="admin_cleanup_db"),
         InlineKeyboardButton(text="🔄 Обновить статистику", callback_data="admin_refresh_stats")
     )
+    builder.row(
+        InlineKeyboardButton(text="🧾 Очередь задач", callback_data="admin_jobs")
+    )
     builder.row(
         InlineKeyboardButton(text="◶️ Назад", callback_data="admin_main_panel")
     )
@@ -286,6 +307,7 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
             captcha_status = normalize_bool(await db.get_setting("captcha_enabled", config.CAPTCHA_ENABLED))
             min_amount = await db.get_setting("min_amount", config.MIN_AMOUNT)
             max_amount = await db.get_setting("max_amount", config.MAX_AMOUNT)
+            requisites_sla = await db.get_setting("requisites_sla_seconds", config.REQUISITES_SLA_SECONDS)
             
             status_text = "✅ Включена" if captcha_status else "❌ Отключена"
             
@@ -293,13 +315,14 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
                 f"⚙️ <b>Настройки системы</b>\n\n"
                 f"💸 Комиссия сервиса: {commission_percentage}%\n"
                 f"🤖 Капча: {status_text}\n"
-                f"💰 Лимиты: {min_amount:,} - {max_amount:,} ₽"
+                f"💰 Лимиты: {min_amount:,} - {max_amount:,} ₽\n"
+                f"⏱ SLA выдачи реквизитов: {requisites_sla} сек"
             )
             await callback.message.edit_text(text, reply_markup=create_settings_panel().as_markup(), parse_mode="HTML")
 
         elif action == "users_menu":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
+                async with db.reader() as database:
                     async with database.execute('SELECT COUNT(*) FROM users') as cursor:
                         total_users = (await cursor.fetchone())[0]
                     async with database.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1') as cursor:
@@ -362,12 +385,36 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
                 cpu_percent = process.cpu_percent()
                 
                 db_size = os.path.getsize(db.db_path) if os.path.exists(db.db_path) else 0
+                pool_stats = db.pool.stats()
+                checkpoint_ms = pool_stats.get('last_checkpoint_ms')
+                checkpoint_text = (
+                    f"{checkpoint_ms:.1f} мс ({pool_stats['last_checkpoint_mode']})"
+                    if checkpoint_ms is not None else "ещё не выполнялся"
+                )
+                breakers_text = format_breakers(gateway_breakers.snapshot(), history=1) or "нет данных\n"
+                rate_age = rate_service.age
+                rate_text = (
+                    f"{rate_service.rate:,.0f} ₽, обновлён {rate_age:.0f} с назад"
+                    if rate_age is not None else "ещё не получен"
+                )
+                for source in rate_aggregator.stats():
+                    source_rate = f"{source['rate']:,.0f} ₽" if source['rate'] else "—"
+                    latency = f"{source['latency'] * 1000:.0f} мс" if source['latency'] is not None else "—"
+                    staleness = f"{source['staleness']:.0f} с" if source['staleness'] is not None else "—"
+                    rate_text += (
+                        f"\n    {source['name']}: {source_rate}, {latency}, давность {staleness}"
+                        f"{', выброс' if source['rejected'] else ''}"
+                    )
                 
                 text = (
                     f"📊 <b>Системная информация</b>\n\n"
                     f"💾 Использование памяти: {memory_info.rss / 1024 / 1024:.1f} MB\n"
                     f"🖥 Нагрузка CPU: {cpu_percent:.1f}%\n"
                     f"💾 Размер БД: {db_size / 1024 / 1024:.1f} MB\n"
+                    f"📝 Размер WAL: {pool_stats['wal_size'] / 1024 / 1024:.1f} MB\n"
+                    f"🧷 Чекпоинт WAL: {checkpoint_text}, всего {pool_stats.get('checkpoints', 0)}\n"
+                    f"💱 Курс BTC: {rate_text}\n"
+                    f"🔌 Автоматы провайдеров:\n{breakers_text}"
                     f"🕐 Время работы: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n"
                     f"🔄 Обновлено: {datetime.now().strftime('%H:%M:%S')}"
                 )
@@ -381,6 +428,44 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
             except Exception as e:
                 await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
+        elif action in ("jobs", "jobs_requeue"):
+            try:
+                if action == "jobs_requeue":
+                    requeued, skipped = await job_queue.requeue_dead()
+                    await callback.answer(f"🔁 Возвращено в очередь: {requeued}, пропущено: {skipped}")
+                counts = await db.get_job_counts()
+                text = (
+                    f"🧾 <b>Очередь задач</b>\n\n"
+                    f"⏳ Ожидают: {counts.get('pending', 0)}\n"
+                    f"⚙️ Выполняются: {counts.get('running', 0)}\n"
+                    f"✅ Выполнены: {counts.get('done', 0)}\n"
+                    f"💀 Не выполнены: {counts.get('dead', 0)}\n"
+                )
+                for title, status in (("Ожидают", "pending"), ("Не выполнены", "dead")):
+                    jobs = await db.get_jobs(status, 5)
+                    if not jobs:
+                        continue
+                    text += f"\n<b>{title}:</b>\n"
+                    for job in jobs:
+                        payload = json.loads(job['payload'])
+                        target = f"заявка #{payload['order_id']}" if 'order_id' in payload else ""
+                        error = html.escape((job['last_error'] or "")[:80])
+                        text += (
+                            f"#{job['id']} {job['kind']} {target} | попыток {job['attempts']}/{job['max_attempts']}\n"
+                            f"{error + chr(10) if error else ''}"
+                        )
+
+                builder = InlineKeyboardBuilder()
+                if counts.get('dead'):
+                    builder.row(InlineKeyboardButton(text="🔁 Повторить невыполненные", callback_data="admin_jobs_requeue"))
+                builder.row(
+                    InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_jobs"),
+                    InlineKeyboardButton(text="◶️ Назад", callback_data="admin_system_menu")
+                )
+                await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode="HTML")
+            except Exception as e:
+                await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
+
         elif action == "view_logs":
             try:
                 log_files = []
@@ -405,11 +490,14 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "cleanup_db":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
+                async with db.writer() as database:
                     await database.execute('DELETE FROM orders WHERE status = "cancelled" AND created_at < datetime("now", "-30 days")')
                     await database.execute('DELETE FROM captcha_sessions WHERE created_at < datetime("now", "-1 day")')
-                    await database.execute('VACUUM')
+                    await database.execute('DELETE FROM jobs WHERE status = "done" AND updated_at < datetime("now", "-7 days")')
+                    # Котировки, истёкшие больше суток назад и не попавшие в заявки
+                    await database.execute(queries.DELETE_EXPIRED_QUOTES, (datetime.now().timestamp() - 86400,))
                     await database.commit()
+                    await database.execute('VACUUM')
                 
                 await callback.answer("✅ База данных очищена", show_alert=True)
                 await admin_callback_handler(callback.model_copy(update={"data": "admin_system_menu"}), state)
@@ -418,11 +506,8 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "recent_orders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, status, created_at, personal_id
-                        FROM orders ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
+                async with db.reader() as database:
+                    async with database.execute(queries.RECENT_ORDERS) as cursor:
                         orders = await cursor.fetchall()
                 
                 status_emoji_map = {
@@ -451,11 +536,8 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "pending_orders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status IN ("waiting", "paid_by_client") ORDER BY created_at DESC
-                    ''') as cursor:
+                async with db.reader() as database:
+                    async with database.execute(queries.PENDING_ORDERS) as cursor:
                         orders = await cursor.fetchall()
                 
                 if orders:
@@ -478,11 +560,8 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "completed_orders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "completed" ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
+                async with db.reader() as database:
+                    async with database.execute(queries.ORDERS_BY_STATUS, ("completed", 10)) as cursor:
                         orders = await cursor.fetchall()
                 
                 if orders:
@@ -502,11 +581,8 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "cancelled_orders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "cancelled" ORDER BY created_at DESC LIMIT 10
-                    ''') as cursor:
+                async with db.reader() as database:
+                    async with database.execute(queries.ORDERS_BY_STATUS, ("cancelled", 10)) as cursor:
                         orders = await cursor.fetchall()
                 
                 if orders:
@@ -526,11 +602,9 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "problem_orders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('''
-                        SELECT id, user_id, total_amount, created_at, personal_id
-                        FROM orders WHERE status = "problem" ORDER BY created_at DESC
-                    ''') as cursor:
+                async with db.reader() as database:
+                    # LIMIT -1 - все проблемные заявки
+                    async with database.execute(queries.ORDERS_BY_STATUS, ("problem", -1)) as cursor:
                         orders = await cursor.fetchall()
                 
                 if orders:
@@ -559,57 +633,50 @@ async def admin_callback_handler(callback: CallbackQuery, state: FSMContext):
 
         elif action == "broadcast_active":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE total_operations > 0') as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
+                users_count = await db.count_recipients(BROADCAST_ACTIONS["broadcast_active"])
                 
                 await callback.message.edit_text(
                     f"📤 <b>Рассылка активным пользователям</b>\n\n"
-                    f"Найдено активных пользователей: {len(users)}\n\n"
+                    f"Найдено активных пользователей: {users_count}\n\n"
                     "Отправьте сообщение для рассылки:",
                     parse_mode="HTML"
                 )
-                await state.update_data(action="broadcast_active", target_users=users)
+                await state.update_data(action="broadcast_active")
                 await state.set_state(AdminStates.waiting_for_broadcast_message)
             except Exception as e:
                 await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
         elif action == "broadcast_new":
             try:
-                week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE registration_date > ?', (week_ago,)) as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
+                users_count = await db.count_recipients(BROADCAST_ACTIONS["broadcast_new"])
                 
                 await callback.message.edit_text(
                     f"📤 <b>Рассылка новым пользователям</b>\n\n"
-                    f"Найдено новых пользователей (за неделю): {len(users)}\n\n"
+                    f"Найдено новых пользователей (за неделю): {users_count}\n\n"
                     "Отправьте сообщение для рассылки:",
                     parse_mode="HTML"
                 )
-                await state.update_data(action="broadcast_new", target_users=users)
+                await state.update_data(action="broadcast_new")
                 await state.set_state(AdminStates.waiting_for_broadcast_message)
             except Exception as e:
                 await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
         elif action == "broadcast_traders":
             try:
-                async with aiosqlite.connect(db.db_path) as database:
-                    async with database.execute('SELECT user_id FROM users WHERE total_operations >= 1') as cursor:
-                        users = [row[0] for row in await cursor.fetchall()]
+                users_count = await db.count_recipients(BROADCAST_ACTIONS["broadcast_traders"])
                 
                 await callback.message.edit_text(
                     f"📤 <b>Рассылка пользователям с операциями</b>\n\n"
-                    f"Найдено пользователей с операциями: {len(users)}\n\n"
+                    f"Найдено пользователей с операциями: {users_count}\n\n"
                     "Отправьте сообщение для рассылки:",
                     parse_mode="HTML"
                 )
-                await state.update_data(action="broadcast_traders", target_users=users)
+                await state.update_data(action="broadcast_traders")
                 await state.set_state(AdminStates.waiting_for_broadcast_message)
             except Exception as e:
                 await callback.answer(f"❌ Ошибка: {e}", show_alert=True)
 
-        elif action in ["toggle_captcha", "change_percentage", "change_limits", "change_welcome",
+        elif action in ["toggle_captcha", "change_percentage", "change_limits", "change_welcome", "change_sla",
                         "find_user", "message_user", "block_user", "unblock_user",
                         "add_admin", "remove_admin", "add_operator", "remove_operator",
                         "staff_list", "broadcast_all", "user_stats", "recent_users"]:
@@ -688,6 +755,25 @@ async def handle_settings_and_management(callback: CallbackQuery, state: FSMCont
         await state.update_data(action="change_welcome")
         await state.set_state(AdminStates.waiting_for_welcome_message)
     
+    elif action == "change_sla":
+        requisites_sla = await db.get_setting("requisites_sla_seconds", config.REQUISITES_SLA_SECONDS)
+        
+        builder = InlineKeyboardBuilder()
+        builder.row(
+            InlineKeyboardButton(text="❌ Отменить", callback_data="admin_settings")
+        )
+        
+        await callback.message.edit_text(
+            f"⏱ <b>SLA выдачи реквизитов</b>\n\n"
+            f"📊 Текущее значение: <b>{requisites_sla} сек</b>\n\n"
+            f"За это время бот опрашивает платёжные API, после чего сообщает клиенту об ошибке.\n"
+            f"Введите новое значение в секундах (от 10 до 600):",
+            reply_markup=builder.as_markup(),
+            parse_mode="HTML"
+        )
+        await state.update_data(action="change_sla")
+        await state.set_state(AdminStates.waiting_for_sla)
+    
     elif action in ["find_user", "message_user", "block_user", "unblock_user",
                     "add_admin", "remove_admin", "add_operator", "remove_operator"]:
         builder = InlineKeyboardBuilder()
@@ -714,7 +800,7 @@ async def handle_settings_and_management(callback: CallbackQuery, state: FSMCont
         await show_staff_list(callback)
     
     elif action == "broadcast_all":
-        users = await db.get_all_users()
+        users_count = await db.count_recipients(BROADCAST_ACTIONS["broadcast_all"])
         
         builder = InlineKeyboardBuilder()
         builder.row(
@@ -723,12 +809,12 @@ async def handle_settings_and_management(callback: CallbackQuery, state: FSMCont
         
         await callback.message.edit_text(
             f"📤 <b>Рассылка всем пользователям</b>\n\n"
-            f"Найдено пользователей: {len(users)}\n\n"
+            f"Найдено пользователей: {users_count}\n\n"
             f"Отправьте сообщение для рассылки:",
             reply_markup=builder.as_markup(),
             parse_mode="HTML"
         )
-        await state.update_data(action="broadcast_all", target_users=users)
+        await state.update_data(action="broadcast_all")
         await state.set_state(AdminStates.waiting_for_broadcast_message)
     
     elif action == "user_stats":
@@ -783,7 +869,7 @@ async def show_staff_list(callback: CallbackQuery):
 
 async def show_detailed_user_stats(callback: CallbackQuery):
     try:
-        async with aiosqlite.connect(db.db_path) as database:
+        async with db.reader() as database:
             async with database.execute('SELECT COUNT(*) FROM users') as cursor:
                 total_users = (await cursor.fetchone())[0]
             async with database.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1') as cursor:
@@ -818,11 +904,8 @@ async def show_detailed_user_stats(callback: CallbackQuery):
 
 async def show_recent_users(callback: CallbackQuery):
     try:
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute('''
-                SELECT user_id, username, first_name, registration_date, total_operations
-                FROM users ORDER BY registration_date DESC LIMIT 10
-            ''') as cursor:
+        async with db.reader() as database:
+            async with database.execute(queries.RECENT_USERS) as cursor:
                 rows = await cursor.fetchall()
         
         if not rows:
@@ -880,6 +963,23 @@ async def process_limits_change(message: Message, state: FSMContext):
     except ValueError:
         await message.answer("❌ Введите корректные числа")
 
+@router.message(AdminStates.waiting_for_sla)
+async def process_sla_change(message: Message, state: FSMContext):
+    try:
+        seconds = int(message.text)
+        if not 10 <= seconds <= 600:
+            await message.answer("❌ SLA должен быть от 10 до 600 секунд")
+            return
+        
+        await db.set_setting("requisites_sla_seconds", seconds)
+        await message.answer(f"✅ SLA выдачи реквизитов изменён на {seconds} сек")
+        
+        builder = create_main_admin_panel()
+        await message.answer("👑 <b>Панель администратора</b>", reply_markup=builder.as_markup(), parse_mode="HTML")
+        await state.clear()
+    except ValueError:
+        await message.answer("❌ Введите целое число секунд")
+
 @router.message(AdminStates.waiting_for_welcome_message)
 async def process_welcome_change(message: Message, state: FSMContext):
     try:
@@ -897,13 +997,8 @@ async def process_order_search(message: Message, state: FSMContext):
     try:
         order_id = message.text.strip()
         
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute('''
-                SELECT id, user_id, amount_rub, amount_btc, btc_address, total_amount, status, 
-                       created_at, personal_id, payment_type, rate
-                FROM orders 
-                WHERE id = ? OR personal_id = ?
-            ''', (order_id, order_id)) as cursor:
+        async with db.reader() as database:
+            async with database.execute(queries.ORDER_SEARCH, (order_id, order_id)) as cursor:
                 order = await cursor.fetchone()
         
         if not order:
@@ -1172,33 +1267,19 @@ async def process_block_reason(message: Message, state: FSMContext):
 @router.message(AdminStates.waiting_for_broadcast_message)
 async def process_broadcast_message(message: Message, state: FSMContext):
     data = await state.get_data()
-    action = data.get("action")
-    target_users = data.get("target_users", [])
-    
-    if not target_users and action == "broadcast_all":
-        target_users = await db.get_all_users()
+    audience = BROADCAST_ACTIONS.get(data.get("action"), "all")
     
     try:
-        sent_count = failed_count = 0
-        
-        await message.answer(f"📤 Начинаю рассылку для {len(target_users)} пользователей...")
-        
-        for user_id in target_users:
-            try:
-                await message.bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id
-                )
-                sent_count += 1
-            except Exception as e:
-                failed_count += 1
-                logger.error(f"Failed to send broadcast to {user_id}: {e}")
-        
+        # Рассылка идёт в фоне; прогресс обновляется в отдельном сообщении
+        broadcast_id = await broadcast_engine.start(
+            message.bot,
+            audience,
+            admin_chat_id=message.chat.id,
+            from_chat_id=message.chat.id,
+            message_id=message.message_id
+        )
         await message.answer(
-            f"✅ <b>Рассылка завершена!</b>\n\n"
-            f"📤 Отправлено: {sent_count}\n"
-            f"❌ Ошибок: {failed_count}",
+            f"✅ Рассылка #{broadcast_id} запущена в фоне. Прогресс - в сообщении выше.",
             parse_mode="HTML"
         )
         
@@ -1210,11 +1291,8 @@ async def process_broadcast_message(message: Message, state: FSMContext):
 
 async def find_user_by_username(username: str) -> int:
     try:
-        async with aiosqlite.connect(db.db_path) as database:
-            async with database.execute(
-                'SELECT user_id FROM users WHERE username = ? COLLATE NOCASE',
-                (username,)
-            ) as cursor:
+        async with db.reader() as database:
+            async with database.execute(queries.USER_BY_USERNAME, (username,)) as cursor:
                 row = await cursor.fetchone()
                 return row[0] if row else None
     except:
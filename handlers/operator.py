@@ -231,11 +231,10 @@ async def notify_client_order_completed(bot, order: dict):
 async def operator_sent_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='completed')
-        order = await db.get_order(order_id)
+        order = await db.transition_order(order_id, 'completed')
         if not order:
-            await callback.answer("Заявка не найдена")
-            logger.warning(f"Оператор {callback.from_user.id} пытался отметить несуществующую заявку #{order_id} как завершенную")
+            await callback.answer("Заявка не найдена или уже в другом статусе")
+            logger.warning(f"Оператор {callback.from_user.id} не смог завершить заявку #{order_id}: нет заявки или недопустимый статус")
             return
         display_id = order.get('personal_id', order_id)
         text_client = (
@@ -270,11 +269,10 @@ async def operator_sent_handler(callback: CallbackQuery):
 async def operator_mark_paid_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='paid_by_client')
-        order = await db.get_order(order_id)
+        order = await db.transition_order(order_id, 'paid_by_client')
         if not order:
-            await callback.answer("Заявка не найдена")
-            logger.warning(f"Оператор {callback.from_user.id} пытался пометить несуществующую заявку #{order_id} как оплачена")
+            await callback.answer("Заявка не найдена или уже в другом статусе")
+            logger.warning(f"Оператор {callback.from_user.id} не смог пометить заявку #{order_id} оплаченной: нет заявки или недопустимый статус")
             return
         await notify_operators_paid_order(callback.bot, order)
         await notify_client_payment_received(callback.bot, order)
@@ -298,9 +296,11 @@ async def operator_problem_handler(callback: CallbackQuery):
         return
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='problem')
-        order = await db.get_order(order_id)
-        display_id = order.get('personal_id', order_id) if order else order_id
+        order = await db.transition_order(order_id, 'problem')
+        if not order:
+            await callback.answer("Заявка не найдена или уже в другом статусе")
+            return
+        display_id = order.get('personal_id', order_id)
         admin_text = (
             f"⚠️ <b>ПРОБЛЕМНАЯ ЗАЯВКА</b>\n\n"
             f"🆔 Заявка: #{display_id}\n"
@@ -392,11 +392,12 @@ async def operator_cancel_handler(callback: CallbackQuery):
         return
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='cancelled')
-        order = await db.get_order(order_id)
-        if order:
-            await notify_client_order_cancelled(callback.bot, order)
-        display_id = order.get('personal_id', order_id) if order else order_id
+        order = await db.transition_order(order_id, 'cancelled')
+        if not order:
+            await callback.answer("Заявка не найдена или уже в другом статусе")
+            return
+        await notify_client_order_cancelled(callback.bot, order)
+        display_id = order.get('personal_id', order_id)
         await callback.message.edit_text(
             f"❌ <b>ЗАЯВКА ОТМЕНЕНА</b>\n\n"
             f"🆔 Заявка: #{display_id}\n"
@@ -2,7 +2,9 @@
 import logging
 import asyncio
 import os
+import time
 from datetime import datetime
+from typing import NamedTuple, Optional
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardButton
@@ -12,8 +14,13 @@ from database.models import Database
 from keyboards.reply import ReplyKeyboards
 from keyboards.inline import InlineKeyboards
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from utils.bitcoin import BitcoinAPI
-from utils.captcha import CaptchaGenerator
+from utils.bitcoin import BitcoinAPI, RATE_UNAVAILABLE_TEXT
+from utils.captcha import captcha_pool, captcha_sessions
+from utils.broadcast import broadcast_engine
+from utils.jobs import job_queue, PermanentJobError
+from utils.single_flight import SingleFlight
+from utils.reconciler import OrderReconciler, order_provider
+from webhook import PaymentIngestion, PaymentEventLog, configured_verifiers, order_owned_by
 from config import config
 from handlers.operator import (
     notify_operators_new_order,
@@ -27,6 +34,10 @@ from api.pspware_api import PSPWareAPI
 from api.greengo_api import GreengoAPI
 from api.nicepay_api import  NicePayAPI
 from api.api_manager import PaymentAPIManager
+from api.routing import GatewayRouter
+from api.circuit_breaker import gateway_breakers, format_breakers
+from api.deadline import Deadline
+from utils.quotes import QuoteService, quote_ttl_text
 
 
 
@@ -50,7 +61,12 @@ payment_api_manager = PaymentAPIManager([
     {"api": pspware_api, "name": "PSPWare", "pay_type_mapping": {"card": "c2c", "sbp": "sbp"}},
     {"api": greengo_api, "name": "Greengo", "pay_type_mapping": {"card": "card", "sbp": "sbp"}},
     {"api": nicepay_api, "name": "NicePay", "pay_type_mapping": {}}
-])
+], hedge_delay=config.PAYMENT_HEDGE_DELAY, router=GatewayRouter(
+    window_size=config.ROUTING_WINDOW_SIZE,
+    window_seconds=config.ROUTING_WINDOW_SECONDS,
+    explore_rate=config.ROUTING_EXPLORE_RATE,
+    prior_latency=config.ROUTING_PRIOR_LATENCY
+), breakers=gateway_breakers, attempt_share=config.GATEWAY_ATTEMPT_SHARE, attempt_floor=config.GATEWAY_ATTEMPT_MIN)
 
 class ExchangeStates(StatesGroup):
     waiting_for_amount = State()
@@ -62,6 +78,8 @@ class ExchangeStates(StatesGroup):
     waiting_for_note = State()
 
 db = Database(config.DATABASE_URL)
+quote_service = QuoteService(db, ttl=config.QUOTE_TTL)
+payment_events = PaymentEventLog(db, max_recent=config.PAYMENT_DEDUP_CACHE)
 
 
 
@@ -102,10 +120,10 @@ async def start_handler(message: Message, state: FSMContext):
     if not user:
         captcha_enabled = await db.get_setting("captcha_enabled", config.CAPTCHA_ENABLED)
         if captcha_enabled:
-            image_buffer, answer = CaptchaGenerator.generate_image_captcha()
-            await db.create_captcha_session(message.from_user.id, answer.upper())
+            image_bytes, answer = await captcha_pool.get()
+            captcha_sessions.create(message.from_user.id, answer.upper())
             captcha_photo = BufferedInputFile(
-                image_buffer.read(),
+                image_bytes,
                 filename="captcha.png"
             )
             await message.answer_photo(
@@ -130,14 +148,15 @@ async def captcha_handler(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Для использования бота пройдите проверку через /start")
         return
-    session = await db.get_captcha_session(message.from_user.id)
+    # Проверка капчи идёт только по памяти; в БД пишем лишь после успешного прохождения
+    session = captcha_sessions.get(message.from_user.id)
     if not session:
         await message.answer("Ошибка сессии. Попробуйте /start")
         return
-    user_answer = message.text.upper().strip()
-    correct_answer = session['answer'].upper().strip()
+    user_answer = (message.text or "").upper().strip()
+    correct_answer = session.answer.upper().strip()
     if user_answer == correct_answer:
-        await db.delete_captcha_session(message.from_user.id)
+        captcha_sessions.delete(message.from_user.id)
         await db.add_user(
             message.from_user.id,
             message.from_user.username,
@@ -162,24 +181,17 @@ async def captcha_handler(message: Message, state: FSMContext):
         await show_main_menu(message)
         await state.clear()
     else:
-        attempts = session['attempts'] + 1
+        attempts = captcha_sessions.increment(message.from_user.id)
         if attempts >= 3:
-            await db.delete_captcha_session(message.from_user.id)
+            captcha_sessions.delete(message.from_user.id)
             await message.answer("❌ Превышено количество попыток. Попробуйте /start снова.")
             await state.clear()
         else:
-            await db.execute_query(
-                'UPDATE captcha_sessions SET attempts = ? WHERE user_id = ?',
-                (attempts, message.from_user.id)
-            )
             try:
-                image_buffer, answer = CaptchaGenerator.generate_simple_image_captcha()
-                await db.execute_query(
-                    'UPDATE captcha_sessions SET answer = ? WHERE user_id = ?',
-                    (answer.upper(), message.from_user.id)
-                )
+                image_bytes, answer = await captcha_pool.get()
+                captcha_sessions.rotate(message.from_user.id, answer.upper())
                 captcha_photo = BufferedInputFile(
-                    image_buffer.read(),
+                    image_bytes,
                     filename="captcha.png"
                 )
                 await message.answer_photo(
@@ -211,6 +223,9 @@ async def buy_crypto_selected(callback: CallbackQuery, state: FSMContext):
             direction="rub_to_crypto"
         )
         btc_rate = await BitcoinAPI.get_btc_rate()
+        if not btc_rate:
+            await callback.answer(RATE_UNAVAILABLE_TEXT, show_alert=True)
+            return
         text = (
             f"💰 <b>Покупка Bitcoin</b>\n\n"
             f"📊 Текущий курс: {btc_rate:,.0f} ₽\n\n"
@@ -270,30 +285,27 @@ async def manual_amount_input(message: Message, state: FSMContext):
 
 async def process_amount_and_show_calculation(callback: CallbackQuery, state: FSMContext, 
                                             crypto: str, direction: str, amount: float):
-    btc_rate = await BitcoinAPI.get_btc_rate()
-    if direction == "rub_to_crypto":
-        rub_amount = amount
-        crypto_amount = BitcoinAPI.calculate_btc_amount(rub_amount, btc_rate)
-    else:
-        crypto_amount = amount
-        rub_amount = crypto_amount * btc_rate
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
+    quote = await quote_service.issue(callback.from_user.id, direction, amount)
+    if not quote:
+        await callback.answer(RATE_UNAVAILABLE_TEXT, show_alert=True)
+        return
     await state.update_data(
         crypto=crypto,
         direction=direction,
-        rub_amount=rub_amount,
-        crypto_amount=crypto_amount,
-        rate=btc_rate,
-        total_amount=total_amount
+        quote_id=quote.id,
+        rub_amount=quote.amount_rub,
+        crypto_amount=quote.amount_btc,
+        rate=quote.rate,
+        total_amount=quote.total_amount
     )
     operation_text = "Покупка" if direction == "rub_to_crypto" else "Продажа"
     text = (
         f"📊 <b>{operation_text} Bitcoin</b>\n\n"
-        f"💱 Курс: {btc_rate:,.0f} ₽\n"
-        f"💰 Сумма: {rub_amount:,.0f} ₽\n"
-        f"₿ Получите: {crypto_amount:.8f} BTC\n\n"
-        f"💸 <b>Итого: {total_amount:,.0f} ₽</b>\n\n"
+        f"💱 Курс: {quote.rate:,.0f} ₽\n"
+        f"💰 Сумма: {quote.amount_rub:,.0f} ₽\n"
+        f"₿ Получите: {quote.amount_btc:.8f} BTC\n\n"
+        f"💸 <b>Итого: {quote.total_amount:,.0f} ₽</b>\n"
+        f"{quote_ttl_text(quote)}\n\n"
         f"Выберите способ {'оплаты' if direction == 'rub_to_crypto' else 'получения'}:"
     )
     await callback.message.edit_text(
@@ -306,30 +318,27 @@ async def process_amount_and_show_calculation(callback: CallbackQuery, state: FS
 
 async def process_amount_and_show_calculation_for_message(message: Message, state: FSMContext,
                                                         crypto: str, direction: str, amount: float):
-    btc_rate = await BitcoinAPI.get_btc_rate()
-    if direction == "rub_to_crypto":
-        rub_amount = amount
-        crypto_amount = BitcoinAPI.calculate_btc_amount(rub_amount, btc_rate)
-    else:
-        crypto_amount = amount
-        rub_amount = crypto_amount * btc_rate
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
+    quote = await quote_service.issue(message.from_user.id, direction, amount)
+    if not quote:
+        await message.answer(RATE_UNAVAILABLE_TEXT)
+        return
     await state.update_data(
         crypto=crypto,
         direction=direction,
-        rub_amount=rub_amount,
-        crypto_amount=crypto_amount,
-        rate=btc_rate,
-        total_amount=total_amount
+        quote_id=quote.id,
+        rub_amount=quote.amount_rub,
+        crypto_amount=quote.amount_btc,
+        rate=quote.rate,
+        total_amount=quote.total_amount
     )
     operation_text = "Покупка" if direction == "rub_to_crypto" else "Продажа"
     text = (
         f"📊 <b>{operation_text} Bitcoin</b>\n\n"
-        f"💱 Курс: {btc_rate:,.0f} ₽\n"
-        f"💰 Сумма: {rub_amount:,.0f} ₽\n"
-        f"₿ Получите: {crypto_amount:.8f} BTC\n\n"
-        f"💸 <b>Итого: {total_amount:,.0f} ₽</b>\n\n"
+        f"💱 Курс: {quote.rate:,.0f} ₽\n"
+        f"💰 Сумма: {quote.amount_rub:,.0f} ₽\n"
+        f"₿ Получите: {quote.amount_btc:.8f} BTC\n\n"
+        f"💸 <b>Итого: {quote.total_amount:,.0f} ₽</b>\n"
+        f"{quote_ttl_text(quote)}\n\n"
         f"Выберите способ {'оплаты' if direction == 'rub_to_crypto' else 'получения'}:"
     )
     await message.answer(
@@ -396,29 +405,29 @@ async def btc_address_handler(message: Message, state: FSMContext):
         await message.answer("❌ Некорректный Bitcoin адрес. Попробуйте еще раз.")
         return
     data = await state.get_data()
-    btc_rate = await BitcoinAPI.get_btc_rate()
-    if not btc_rate:
+    quote, _ = await quote_service.ensure_fresh(data.get('quote_id'), message.from_user.id)
+    if quote is None:
+        quote = await quote_service.issue(message.from_user.id, "rub_to_crypto", data['rub_amount'])
+    if not quote:
         await message.answer("❌ Ошибка получения курса. Попробуйте позже.")
         return
-    rub_amount = data['rub_amount']
-    btc_amount = BitcoinAPI.calculate_btc_amount(rub_amount, btc_rate)
-    COMMISSION_PERCENT = await db.get_commission_percentage()
-    total_amount = rub_amount / (1 - COMMISSION_PERCENT / 100)
     text = (
         f"📊 <b>Предварительный расчет:</b>\n\n"
-        f"💱 Курс BTC: {btc_rate:,.0f} ₽\n"
-        f"💰 Сумма к обмену: {rub_amount:,.0f} ₽\n"
-        f"₿ Получите Bitcoin: {btc_amount:.8f} BTC\n\n"
-        f"💸 <b>К оплате: {total_amount:,.0f} ₽</b>\n\n"
+        f"💱 Курс BTC: {quote.rate:,.0f} ₽\n"
+        f"💰 Сумма к обмену: {quote.amount_rub:,.0f} ₽\n"
+        f"₿ Получите Bitcoin: {quote.amount_btc:.8f} BTC\n\n"
+        f"💸 <b>К оплате: {quote.total_amount:,.0f} ₽</b>\n"
+        f"{quote_ttl_text(quote)}\n\n"
         f"₿ Bitcoin адрес:\n<code>{btc_address}</code>\n\n"
         f"Выберите способ оплаты:"
     )
     await state.update_data(
         btc_address=btc_address,
-        rub_amount=rub_amount,
-        btc_amount=btc_amount,
-        btc_rate=btc_rate,
-        total_amount=total_amount
+        quote_id=quote.id,
+        rub_amount=quote.amount_rub,
+        btc_amount=quote.amount_btc,
+        btc_rate=quote.rate,
+        total_amount=quote.total_amount
     )
     await message.answer(text, reply_markup=ReplyKeyboards.payment_methods(), parse_mode="HTML")
 
@@ -441,6 +450,9 @@ async def address_input_handler(message: Message, state: FSMContext):
             return
     await state.update_data(address=address)
     order_id = await create_exchange_order(message.from_user.id, state)
+    if order_id is None:
+        await message.answer(RATE_UNAVAILABLE_TEXT)
+        return
     await show_order_confirmation(message, state, order_id)
 
 
@@ -448,16 +460,29 @@ async def address_input_handler(message: Message, state: FSMContext):
 
 
 
-async def create_exchange_order(user_id: int, state: FSMContext) -> int:
+async def create_exchange_order(user_id: int, state: FSMContext) -> Optional[int]:
     data = await state.get_data()
+    # Цифры берутся из котировки, а не из состояния: курс и комиссию повторно не запрашиваем
+    quote, requoted = await quote_service.ensure_fresh(data.get("quote_id"), user_id)
+    if quote is None:
+        return None
+    await state.update_data(
+        quote_id=quote.id,
+        rub_amount=quote.amount_rub,
+        crypto_amount=quote.amount_btc,
+        rate=quote.rate,
+        total_amount=quote.total_amount,
+        requoted=requoted
+    )
     order_id = await db.create_order(
         user_id=user_id,
-        amount_rub=data["rub_amount"],
-        amount_btc=data["crypto_amount"],
+        amount_rub=quote.amount_rub,
+        amount_btc=quote.amount_btc,
         btc_address=data["address"],
-        rate=data["rate"],
-        total_amount=data["total_amount"],
-        payment_type=data["payment_type"]
+        rate=quote.rate,
+        total_amount=quote.total_amount,
+        payment_type=data["payment_type"],
+        quote_id=quote.id
     )
     return order_id
 
@@ -466,6 +491,7 @@ async def show_order_confirmation(message: Message, state: FSMContext, order_id:
     order = await db.get_order(order_id)
     display_id = order.get('personal_id', order_id) if order else order_id
     operation_text = "Покупка" if data["direction"] == "rub_to_crypto" else "Продажа"
+    requote_note = "ℹ️ Котировка устарела, расчёт обновлён по текущему курсу.\n\n" if data.get("requoted") else ""
     text = (
         f"✅ <b>Заявка создана!</b>\n\n"
         f"📋 <b>{operation_text} Bitcoin</b>\n"
@@ -473,6 +499,7 @@ async def show_order_confirmation(message: Message, state: FSMContext, order_id:
         f"₿ Количество: {data['crypto_amount']:.8f} BTC\n"
         f"💸 К {'оплаты' if data['direction'] == 'rub_to_crypto' else 'получению'}: {data['total_amount']:,.0f} ₽\n\n"
         f"📝 Адрес/Реквизиты:\n<code>{data['address']}</code>\n\n"
+        f"{requote_note}"
         f"Подтвердите создание заявки:"
     )
     await message.answer(
@@ -482,149 +509,245 @@ async def show_order_confirmation(message: Message, state: FSMContext, order_id:
     )
     await state.clear()
 
-async def request_requisites_with_retries(order_id: int, user_id: int, payment_type: str, bot, max_attempts=3, delay_sec=60):
+async def requisites_sla() -> float:
+    return await db.get_setting("requisites_sla_seconds", config.REQUISITES_SLA_SECONDS)
+
+
+class RequisitesUnavailable(Exception):
+    """Провайдеры не выдали реквизиты - попытку повторит очередь задач"""
+
+
+async def request_requisites(order_id: int, user_id: int, payment_type: str, bot, deadline: Deadline,
+                             job: Optional[dict] = None) -> bool:
+    """Одна попытка получить реквизиты и отправить их клиенту; False - заявка больше не ждёт реквизитов.
+
+    job - задача очереди: если её аренду перехватили, пока шёл запрос к провайдеру,
+    созданный заказ отменяется, а клиенту ничего не отправляется.
+    """
     order = await db.get_order(order_id)
     if not order:
         logger.error(f"Order not found: {order_id}")
         return False
-
+    if order['status'] != 'waiting':
+        logger.info(f"Order {order_id} is '{order['status']}', requisites no longer needed")
+        return False
+    if order.get('requisites'):
+        logger.info(f"Order {order_id} already has requisites")
+        return False
     is_sell_order = not bool(order.get('btc_address'))
+    amount = int(await db.get_order_total_amount(order_id))
+    api_response = await payment_api_manager.create_order(
+        amount=amount,
+        payment_type=payment_type,
+        personal_id=str(order_id),
+        is_sell_order=is_sell_order,
+        deadline=deadline
+    )
 
-    for attempt in range(1, max_attempts + 1):
-        try:
-            amount = int(await db.get_order_total_amount(order_id))
-            api_response = await payment_api_manager.create_order(
-                amount=amount,
-                payment_type=payment_type,
-                personal_id=str(order_id),
-                is_sell_order=is_sell_order
-            )
+    if not (api_response.get('success') or api_response.get('resultCode') == '0000'):
+        err_msg = api_response.get('error') or api_response.get('resultDesc', 'Неизвестная ошибка')
+        await bot.send_message(user_id, f"Ошибка создания платежа: {err_msg}")
+        logger.warning(f"Ошибка создания платежа API: {api_response}")
+        raise RequisitesUnavailable(err_msg)
 
-            if api_response.get('success') or api_response.get('resultCode') == '0000':
-                payment_data = api_response.get('data', {})
-                api_name = api_response.get('api_name')
-                total_amount = order.get('total_amount') or amount
-                btc_amount = order.get('amount_btc', 0)
-                rate = order.get('rate', 0)
-                direction = "покупка" if order.get('btc_address') else "продажа"
-
-                if api_name == 'OnlyPays' or api_name == 'PSPWare' or api_name == 'Greengo':
-                    requisite = payment_data.get('requisite', '—')
-                    owner = payment_data.get('owner', '—')
-                    bank = payment_data.get('bank', '—')
-                    text = (
-                        f"💰 <b>Информация для оплаты ({api_name}):</b>\n\n"
-                        f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
-                        f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
-                        f"Получаете: <b>{btc_amount} BTC</b> ({direction})\n\n"
-                        f"🏦 Реквизиты оплаты:\n"
-                        f"💳 Карта: <b>{requisite}</b>\n"
-                        f"👤 Получатель: <b>{owner}</b>\n"
-                        f"🏛 Банк: <b>{bank}</b>\n\n"
-                        f"После оплаты подтвердите операцию"
-                    )
-                    update_fields = {
-                        'requisites': text,
-                        'status': 'waiting',
-                        'personal_id': payment_data.get('id')
-                    }
-                    if api_name == 'OnlyPays':
-                        update_fields['onlypays_id'] = payment_data.get('id')
-                    elif api_name == 'PSPWare':
-                        update_fields['pspware_id'] = payment_data.get('id')
-                    elif api_name == 'Greengo':
-                        update_fields['greengo_id'] = payment_data.get('id')
-                    await db.update_order(order_id, **update_fields)
-
-                elif api_name == 'NicePay':
-                    payment_url = payment_data.get('payment_url') or api_response.get('paymentUrl')
-                    text = (
-                        f"💰 <b>Информация для оплаты (NicePay):</b>\n\n"
-                        f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
-                        f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
-                        f"Получаете: <b>{btc_amount} BTC</b> ({direction})\n\n"
-                        f"Оплатите по ссылке:\n"
-                        f"{payment_url or 'ссылка недоступна'}\n\n"
-                        f"После оплаты подтвердите операцию"
-                    )
-                    await db.update_order(
-                        order_id,
-                        requisites=text,
-                        status='waiting',
-                        personal_id=str(order_id)
-                    )
-                else:
-                    text = (
-                        f"💰 <b>Реквизиты для оплаты:</b>\n"
-                        f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
-                        f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
-                        f"Получаете: <b>{btc_amount} BTC</b>\n\n"
-                        "Реквизиты не найдены, обратитесь в поддержку."
-                    )
-                    await db.update_order(order_id, requisites=text, status='waiting', personal_id=str(order_id))
-
-                await bot.send_message(
-                    user_id,
-                    text,
-                    reply_markup=InlineKeyboards.order_confirmation(order_id),
-                    parse_mode='HTML'
-                )
-                break
-            else:
-                err_msg = api_response.get('error') or api_response.get('resultDesc', 'Неизвестная ошибка')
-                await bot.send_message(user_id, f"Ошибка создания платежа: {err_msg}")
-                logger.warning(f"Ошибка создания платежа API: {api_response}")
+    if job is not None and not await job_queue.renew(job):
+        logger.warning(f"Order {order_id}: job {job['id']} lost its lease, {api_response.get('api_name')} order dropped")
+        await payment_api_manager.cancel_duplicate(api_response)
+        return False
 
-        except Exception as e:
-            logger.error(f"Исключение при создании платежа: {e}")
+    payment_data = api_response.get('data', {})
+    api_name = api_response.get('api_name')
+    total_amount = order.get('total_amount') or amount
+    btc_amount = order.get('amount_btc', 0)
+    rate = order.get('rate', 0)
+    direction = "покупка" if order.get('btc_address') else "продажа"
+
+    if api_name == 'OnlyPays' or api_name == 'PSPWare' or api_name == 'Greengo':
+        requisite = payment_data.get('requisite', '—')
+        owner = payment_data.get('owner', '—')
+        bank = payment_data.get('bank', '—')
+        text = (
+            f"💰 <b>Информация для оплаты ({api_name}):</b>\n\n"
+            f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
+            f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
+            f"Получаете: <b>{btc_amount} BTC</b> ({direction})\n\n"
+            f"🏦 Реквизиты оплаты:\n"
+            f"💳 Карта: <b>{requisite}</b>\n"
+            f"👤 Получатель: <b>{owner}</b>\n"
+            f"🏛 Банк: <b>{bank}</b>\n\n"
+            f"После оплаты подтвердите операцию"
+        )
+        update_fields = {
+            'requisites': text,
+            'personal_id': payment_data.get('id')
+        }
+        if api_name == 'OnlyPays':
+            update_fields['onlypays_id'] = payment_data.get('id')
+        elif api_name == 'PSPWare':
+            update_fields['pspware_id'] = payment_data.get('id')
+        elif api_name == 'Greengo':
+            update_fields['greengo_id'] = payment_data.get('id')
+        updated_order = await db.transition_order(order_id, 'waiting', **update_fields)
 
-        if attempt < max_attempts:
-            await asyncio.sleep(delay_sec)
+    elif api_name == 'NicePay':
+        payment_url = payment_data.get('payment_url') or api_response.get('paymentUrl')
+        text = (
+            f"💰 <b>Информация для оплаты (NicePay):</b>\n\n"
+            f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
+            f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
+            f"Получаете: <b>{btc_amount} BTC</b> ({direction})\n\n"
+            f"Оплатите по ссылке:\n"
+            f"{payment_url or 'ссылка недоступна'}\n\n"
+            f"После оплаты подтвердите операцию"
+        )
+        updated_order = await db.transition_order(
+            order_id,
+            'waiting',
+            requisites=text,
+            personal_id=str(order_id),
+            nicepay_id=payment_data.get('id') or str(order_id)
+        )
     else:
-        await bot.send_message(user_id, "Не удалось получить реквизиты оплаты. Попробуйте позже.")
+        text = (
+            f"💰 <b>Реквизиты для оплаты:</b>\n"
+            f"Сумма к оплате: <b>{total_amount} ₽</b>\n"
+            f"Курс: <b>{rate} ₽ за 1 BTC</b>\n"
+            f"Получаете: <b>{btc_amount} BTC</b>\n\n"
+            "Реквизиты не найдены, обратитесь в поддержку."
+        )
+        updated_order = await db.transition_order(order_id, 'waiting', requisites=text, personal_id=str(order_id))
 
+    if updated_order is None:
+        # Пока ждали провайдера, заявку отменили - реквизиты клиенту не нужны, заказ у провайдера тоже
+        logger.warning(f"Order {order_id} left 'waiting' before requisites arrived ({api_name})")
+        await payment_api_manager.cancel_duplicate(api_response)
+        return False
 
+    await bot.send_message(
+        user_id,
+        text,
+        reply_markup=InlineKeyboards.order_confirmation(order_id),
+        parse_mode='HTML'
+    )
+    return True
+
+
+REQUISITES_JOB = "requisites"
+
+
+async def run_requisites_job(bot, payload: dict, job: dict):
+    # SLA отсчитывается от подтверждения заявки и переживает перезапуск бота
+    remaining = payload['deadline_at'] - time.time()
+    if remaining <= 0:
+        raise PermanentJobError(f"SLA exceeded after {job['attempts'] - 1} attempts")
+    order_id = payload['order_id']
+    # Запрос к провайдеру не выходит за SLA: до его конца (с запасом) заявка закреплена за этой попыткой
+    until = payload['deadline_at'] + config.REQUISITES_CLAIM_MARGIN
+    if not await db.claim_order_requisites(order_id, job['id'], job['attempts'], until):
+        order = await db.get_order(order_id)
+        if order and order['status'] == 'waiting' and not order.get('requisites'):
+            # Прежняя попытка ещё может ждать провайдера - повторим после неё
+            raise RequisitesUnavailable(f"order {order_id} is claimed by attempt {order['requisites_attempt']}")
+        return
+    try:
+        await request_requisites(
+            order_id, payload['user_id'], payload['payment_type'], bot, Deadline(remaining), job=job
+        )
+    finally:
+        await db.release_order_requisites(order_id, job['id'], job['attempts'])
+
+
+async def requisites_job_dead(bot, payload: dict, error: str):
+    await bot.send_message(payload['user_id'], "Не удалось получить реквизиты оплаты. Попробуйте позже.")
 
 
+async def requisites_job_requeue(payload: dict) -> Optional[dict]:
+    """Повтор из админки: только для заявки, которая всё ещё ждёт реквизитов, и с новым SLA"""
+    order = await db.get_order(payload['order_id'])
+    if not order or order['status'] != 'waiting' or order.get('requisites'):
+        return None
+    return dict(payload, deadline_at=time.time() + await requisites_sla())
 
 
+class RequisitesClaim(NamedTuple):
+    # started - поставлена задача; attached - уже запрошены, ждём ту же попытку;
+    # delivered - реквизиты уже выданы; closed - заявки нет, она чужая или не ждёт оплаты
+    status: str
+    job_id: Optional[int]
+    order: Optional[dict]
 
-async def check_order_status(order_id: int, api_name: str):
-    status_response = await payment_api_manager.get_order_status(str(order_id), api_name)
-    if status_response.get('success') or status_response.get('resultCode') == "0000":
-        new_status = 'completed' if status_response.get('resultCode') == '0000' else 'pending'
-        await db.update_order(order_id, status=new_status)
-    return status_response
 
+# Реквизиты по заявке в полёте в этом процессе; между процессами - уникальный dedup_key задачи,
+# а запрос к провайдеру закрепляется за попыткой задачи в самой заявке до конца SLA (claim_order_requisites)
+requisites_flight = SingleFlight()
 
-async def cancel_order_payment(order_id: int, api_name: str):
-    cancel_response = await payment_api_manager.cancel_order(str(order_id), api_name)
-    if cancel_response.get('success') or cancel_response.get('resultCode') == "0000":
-        await db.update_order(order_id, status="canceled")
-    return cancel_response
 
+async def claim_requisites(order_id: int, user_id: int) -> RequisitesClaim:
+    """Единственный путь запроса реквизитов: повторное подтверждение присоединяется к текущей попытке.
+
+    Запросить и увидеть реквизиты может только владелец заявки.
+    """
+    claim, shared = await requisites_flight.do(
+        (order_id, user_id), lambda: _claim_requisites(order_id, user_id)
+    )
+    if shared and claim.status == 'started':
+        return claim._replace(status='attached')
+    return claim
 
 
+async def _claim_requisites(order_id: int, user_id: int) -> RequisitesClaim:
+    order = await db.get_order(order_id)
+    if not order or order['user_id'] != user_id:
+        return RequisitesClaim('closed', None, None)
+    if order['status'] != 'waiting':
+        return RequisitesClaim('closed', None, order)
+    if order.get('requisites'):
+        return RequisitesClaim('delivered', None, order)
+    payload = {
+        'order_id': order_id,
+        'user_id': order['user_id'],
+        'payment_type': order['payment_type'],
+        # Отсчёт SLA начинается с момента подтверждения
+        'deadline_at': time.time() + await requisites_sla(),
+    }
+    job_id, created = await job_queue.enqueue(
+        REQUISITES_JOB, payload, max_attempts=config.REQUISITES_MAX_ATTEMPTS,
+        dedup_key=f"{REQUISITES_JOB}:{order_id}"
+    )
+    if not created:
+        logger.info(f"Order {order_id}: requisites already requested (job {job_id})")
+    return RequisitesClaim('started' if created else 'attached', job_id, order)
+
+
+job_queue.register(
+    REQUISITES_JOB, run_requisites_job, on_dead=requisites_job_dead, retry_base=config.REQUISITES_RETRY_DELAY,
+    on_requeue=requisites_job_requeue
+)
 
 
 @router.callback_query(F.data.startswith(("confirm_order_", "cancel_order_")))
 async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext):
     action = "confirm" if callback.data.startswith("confirm") else "cancel"
     order_id = int(callback.data.split("_")[-1])
+    order = await db.get_order(order_id)
+    # Кнопки доступны клиентам: callback с чужим id заявки ничего не делает и ничего не раскрывает
+    if not order or order['user_id'] != callback.from_user.id:
+        await callback.answer("❌ Заявка не найдена", show_alert=True)
+        return
     if action == "confirm":
-        order = await db.get_order(order_id)
-        if not order:
-            await callback.message.edit_text("❌ Заявка не найдена")
-            return
-        user_id = order['user_id']
         payment_type = order.get('payment_type')
         if order['total_amount'] and payment_type:
-            await callback.message.edit_text(
-                "⏳ Ваш запрос принят. Реквизиты будут отправлены в следующем сообщении.\nВремя ожидания до 4-х минут..."
-            )
-            asyncio.create_task(
-                request_requisites_with_retries(order_id, user_id, payment_type, callback.bot)
-            )
+            # Повторное нажатие не создаёт второй заказ у провайдера, а ждёт уже идущий запрос
+            claim = await claim_requisites(order_id, callback.from_user.id)
+            if claim.status == 'started':
+                text = "⏳ Ваш запрос принят. Реквизиты будут отправлены в следующем сообщении.\nОбычно это занимает несколько секунд..."
+            elif claim.status == 'attached':
+                text = "⏳ Реквизиты по этой заявке уже запрошены и придут в следующем сообщении."
+            elif claim.status == 'delivered':
+                text = f"💳 Реквизиты по заявке уже выданы:\n\n{claim.order['requisites']}"
+            else:
+                text = f"❌ Заявка #{order.get('personal_id', order_id)} уже не ожидает оплаты."
+            await callback.message.edit_text(text, parse_mode="HTML")
             return
         else:
             text = (
@@ -633,10 +756,11 @@ async def order_confirmation_handler(callback: CallbackQuery, state: FSMContext)
                 f"Время обработки: 5-15 минут."
             )
     else:
-        await db.update_order(order_id, status='cancelled')
-        order = await db.get_order(order_id)
-        display_id = order.get('personal_id', order_id) if order else order_id
-        text = f"❌ Заявка #{display_id} отменена."
+        order = await db.transition_order(order_id, 'cancelled', expected=('waiting',))
+        if order:
+            text = f"❌ Заявка #{order.get('personal_id', order_id)} отменена."
+        else:
+            text = f"❌ Заявку #{order_id} уже нельзя отменить."
 
     await callback.message.edit_text(text, parse_mode="HTML")
     await asyncio.sleep(3)
@@ -659,21 +783,22 @@ async def payment_method_handler(message: Message, state: FSMContext):
     data = await state.get_data()
 
     # Проверка наличия данных для создания заказа
-    rub_amount = data.get('rub_amount')
-    btc_amount = data.get('btc_amount')
-    btc_rate = data.get('btc_rate')
+    quote, _ = await quote_service.ensure_fresh(data.get('quote_id'), message.from_user.id)
 
-    logger.debug(f"Данные из состояния: rub_amount={rub_amount}, btc_amount={btc_amount}, btc_rate={btc_rate}")
+    logger.debug(f"Котировка из состояния: {quote}")
 
-    if rub_amount is None or btc_amount is None or btc_rate is None:
-        logger.error(f"Недостаточно данных в состоянии пользователя {message.from_user.id}, прекращаю обработку.")
+    if quote is None:
+        logger.error(f"Нет действующей котировки у пользователя {message.from_user.id}, прекращаю обработку.")
         await message.answer(
             "❌ Ошибка внутренних данных. Попробуйте начать заново через главное меню."
         )
         await state.clear()
         return
     
-    total_amount = rub_amount / (1 - (await db.get_commission_percentage()) / 100)
+    rub_amount = quote.amount_rub
+    btc_amount = quote.amount_btc
+    btc_rate = quote.rate
+    total_amount = quote.total_amount
 
     logger.info(f"Создаём заказ: user_id={message.from_user.id}, rub_amount={rub_amount}, btc_amount={btc_amount}, "
                 f"btc_address={data.get('btc_address', data.get('address', ''))}, rate={btc_rate}, total_amount={total_amount}, payment_type={payment_type}")
@@ -685,7 +810,8 @@ async def payment_method_handler(message: Message, state: FSMContext):
         btc_address=data.get('btc_address', data.get('address', '')),
         rate=btc_rate,
         total_amount=total_amount,
-        payment_type=payment_type
+        payment_type=payment_type,
+        quote_id=quote.id
     )
     logger.info(f"Заказ создан с ID {order_id}")
 
@@ -701,75 +827,23 @@ async def payment_method_handler(message: Message, state: FSMContext):
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления операторам о новой заявке: {e}")
 
-    # Создаем заказ в платежной системе
-    is_sell_order = not order.get('btc_address')
-    logger.info(f"Создаём платёжный заказ в API. is_sell_order={is_sell_order}, order_id={order_id}")
-
-    try:
-        api_response = await payment_api_manager.create_order(
-            amount=int(total_amount),
-            payment_type=payment_type,
-            personal_id=str(order_id),
-            is_sell_order=is_sell_order
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при обращении к API платёжного сервиса: {e}")
-        await message.answer("❌ Ошибка связи с платёжным сервисом. Попробуйте позже.")
-        await state.clear()
-        return
-
-    if api_response.get('success'):
-        payment_data = api_response['data']
-        api_name = api_response.get('api_name')
-        requisites_text = (
-            f"{'💳 Карта' if payment_type == 'card' else '📱 Телефон'}: {payment_data['requisite']}\n"
-            f"👤 Получатель: {payment_data['owner']}\n"
-            f"🏛 Банк: {payment_data['bank']}"
-        )
-        
-        # Обновляем заказ с данными платежной системы
-        update_data = {
-            'requisites': requisites_text,
-            'personal_id': payment_data['id'],
-            'status': 'waiting'
-        }
-        if api_name == 'OnlyPays':
-            update_data['onlypays_id'] = payment_data['id']
-        elif api_name == 'PSPWare':
-            update_data['pspware_id'] = payment_data['id']
-        elif api_name == 'Greengo':
-            update_data['greengo_id'] = payment_data['id']
-
-        try:
-            await db.update_order(order_id, **update_data)
-            logger.info(f"Обновлены данные заказа ID {order_id} с реквизитами оплаты")
-        except Exception as e:
-            logger.error(f"Ошибка обновления заказа {order_id} в БД: {e}")
-
-        text = (
-            f"💳 <b>Заявка #{payment_data['id']} создана!</b>\n\n"
+    # Реквизиты запрашиваются тем же путём, что и при подтверждении заявки
+    claim = await claim_requisites(order_id, message.from_user.id)
+    if claim.status in ('started', 'attached'):
+        await message.answer(
+            f"💳 <b>Заявка #{order_id} создана!</b>\n\n"
             f"💰 Сумма к обмену: {rub_amount:,.0f} ₽\n"
             f"₿ Получите: {btc_amount:.8f} BTC\n"
             f"💸 К оплате: <b>{total_amount:,.0f} ₽</b>\n\n"
-            f"📋 <b>Реквизиты для оплаты:</b>\n"
-            f"{requisites_text}\n\n"
-            f"⚠️ <b>Важно:</b>\n"
-            f"• Переведите точную сумму\n"
-            f"• После оплаты ожидайте подтверждения\n"
-            f"• Bitcoin будет отправлен автоматически\n\n"
-            f"⏰ Заявка действительна 30 минут"
+            f"⏳ Реквизиты для оплаты придут в следующем сообщении.\n\n"
+            f"⏰ Заявка действительна 30 минут",
+            reply_markup=ReplyKeyboards.order_menu(),
+            parse_mode="HTML"
         )
-
-        try:
-            await message.answer(text, reply_markup=ReplyKeyboards.order_menu(), parse_mode="HTML")
-            logger.info(f"Пользователю {message.from_user.id} отправлена информация о реквизитах оплаты для заявки #{payment_data['id']}")
-        except Exception as e:
-            logger.error(f"Ошибка отправки пользователю {message.from_user.id} текста реквизитов: {e}")
     else:
-        error_msg = api_response.get('error', 'Неизвестная ошибка')
-        logger.error(f"Платёжный сервис вернул ошибку для заказа {order_id}: {error_msg}")
+        logger.error(f"Заказ {order_id} не ожидает реквизитов: {claim.status}")
         await message.answer(
-            f"❌ Ошибка создания заявки: {error_msg}\n\nПопробуйте позже или обратитесь в поддержку.",
+            "❌ Ошибка создания заявки. Попробуйте позже или обратитесь в поддержку.",
             reply_markup=ReplyKeyboards.main_menu()
         )
 
@@ -781,6 +855,7 @@ async def payment_method_handler(message: Message, state: FSMContext):
 
 @router.message(F.text == "🔄 Проверить статус")
 async def check_status_handler(message: Message):
+    # Статус у провайдера сверяет фоновый OrderReconciler; здесь только чтение из БД
     orders = await db.get_user_orders(message.from_user.id, 1)
     if not orders:
         await message.answer(
@@ -792,76 +867,26 @@ async def check_status_handler(message: Message):
     order = orders[0]
     display_id = order.get('personal_id', order['id'])
     
-    if order['status'] == 'waiting' and (order['onlypays_id'] or order['pspware_id'] or order['greengo_id']):
-        # Определяем какой API использовать
-        api_name = 'OnlyPays' if order['onlypays_id'] else 'PSPWare' if order['pspware_id'] else 'Greengo'
-        api_order_id = order['onlypays_id'] or order['pspware_id'] or order['greengo_id']
-        
-        api_response = await payment_api_manager.get_order_status(
-            order_id=api_order_id,
-            api_name=api_name
-        )
-        
-        if api_response and api_response.get('success'):
-            status_data = api_response['data']
-            if status_data['status'] == 'finished':
-                # Создаем данные webhook для обработки
-                webhook_data = {
-                    'id': api_order_id,
-                    'status': 'finished',
-                    'personal_id': str(order['id']),
-                    'received_sum': status_data.get('received_sum', order['total_amount'])
-                }
-                
-                # Обрабатываем как webhook в зависимости от API
-                if order['onlypays_id']:
-                    await process_onlypays_webhook(webhook_data, message.bot)
-                elif order['pspware_id']:
-                    await process_pspware_webhook(webhook_data, message.bot)
-                else:
-                    await process_greengo_webhook(webhook_data, message.bot)
-                
-                await message.answer(
-                    f"✅ <b>Заявка #{display_id} оплачена!</b>\n\n"
-                    f"Платеж получен и обрабатывается.\n"
-                    f"Bitcoin будет отправлен в течение 1 часа.",
-                    reply_markup=ReplyKeyboards.main_menu(),
-                    parse_mode="HTML"
-                )
-            elif status_data['status'] == 'cancelled':
-                await db.update_order(order['id'], status='cancelled')
-                await message.answer(
-                    f"❌ Заявка #{display_id} отменена.\n\n"
-                    f"Создайте новую заявку для обмена.",
-                    reply_markup=ReplyKeyboards.main_menu(),
-                    parse_mode="HTML"
-                )
-            else:
-                await message.answer(
-                    f"⏳ Заявка #{display_id} в обработке\n\n"
-                    f"Ожидаем поступления платежа...\n"
-                    f"Заявка действительна 30 минут.",
-                    reply_markup=ReplyKeyboards.order_menu()
-                )
-        else:
-            error_message = api_response.get('error', 'Неизвестная ошибка') if api_response else 'Не удалось проверить статус'
-            await message.answer(
-                f"❌ Ошибка проверки статуса: {error_message}\n"
-                f"Попробуйте позже или обратитесь в поддержку.",
-                reply_markup=ReplyKeyboards.main_menu()
-            )
-    else:
-        status_text = {
-            'waiting': '⏳ В обработке',
-            'paid_by_client': '💰 Оплачена, обрабатывается',
-            'completed': '✅ Завершена',
-            'cancelled': '❌ Отменена',
-            'problem': '⚠️ Проблемная'
-        }.get(order['status'], f"❓ {order['status']}")
+    if order['status'] == 'waiting':
         await message.answer(
-            f"📋 Статус заявки #{display_id}: {status_text}",
-            reply_markup=ReplyKeyboards.main_menu()
+            f"⏳ Заявка #{display_id} в обработке\n\n"
+            f"Ожидаем поступления платежа...\n"
+            f"Как только оплата поступит, мы пришлём уведомление.\n"
+            f"Заявка действительна 30 минут.",
+            reply_markup=ReplyKeyboards.order_menu()
         )
+        return
+    
+    status_text = {
+        'paid_by_client': '💰 Оплачена, обрабатывается',
+        'completed': '✅ Завершена',
+        'cancelled': '❌ Отменена',
+        'problem': '⚠️ Проблемная'
+    }.get(order['status'], f"❓ {order['status']}")
+    await message.answer(
+        f"📋 Статус заявки #{display_id}: {status_text}",
+        reply_markup=ReplyKeyboards.main_menu()
+    )
 
 
 
@@ -884,12 +909,18 @@ async def confirm_cancel_order_handler(message: Message):
                 api_name='OnlyPays' if order['onlypays_id'] else 'PSPWare' if order['pspware_id'] else 'Greengo'
             )
             if api_response and api_response.get('success'):
-                await db.update_order(order['id'], status='cancelled')
-                await message.answer(
-                    f"❌ Заявка #{display_id} отменена.\n\n"
-                    f"Создайте новую заявку для обмена.",
-                    reply_markup=ReplyKeyboards.main_menu()
-                )
+                # Пока ждали провайдера, заявка могла успеть стать оплаченной
+                if await db.transition_order(order['id'], 'cancelled', expected=('waiting',)):
+                    await message.answer(
+                        f"❌ Заявка #{display_id} отменена.\n\n"
+                        f"Создайте новую заявку для обмена.",
+                        reply_markup=ReplyKeyboards.main_menu()
+                    )
+                else:
+                    await message.answer(
+                        "Невозможно отменить эту заявку",
+                        reply_markup=ReplyKeyboards.main_menu()
+                    )
             else:
                 error_message = api_response.get('error', 'Неизвестная ошибка') if api_response else 'Не удалось отменить заказ'
                 await message.answer(
@@ -903,6 +934,14 @@ async def confirm_cancel_order_handler(message: Message):
                 reply_markup=ReplyKeyboards.main_menu()
             )
     else:
+        if order['status'] == 'waiting' and not order.get('requisites') and order.get('payment_type'):
+            claim = await claim_requisites(order['id'], message.from_user.id)
+            if claim.status in ('started', 'attached'):
+                await message.answer(
+                    f"⏳ Реквизиты по заявке #{display_id} запрошены и придут в следующем сообщении.",
+                    reply_markup=ReplyKeyboards.order_menu()
+                )
+                return
         await message.answer(
             "⏳ Проверяю статус заявки...",
             reply_markup=ReplyKeyboards.order_menu()
@@ -912,6 +951,7 @@ async def confirm_cancel_order_handler(message: Message):
 @router.message(F.text == "О сервисе ℹ️")
 async def about_handler(message: Message):
     btc_rate = await BitcoinAPI.get_btc_rate()
+    rate_text = f"{btc_rate:,.0f} ₽" if btc_rate else "временно недоступен"
     COMMISSION_PERCENT = await db.get_commission_percentage()
     text = (
         f"👑 {config.EXCHANGE_NAME} 👑\n\n"
@@ -925,7 +965,7 @@ async def about_handler(message: Message):
         f"⚙️ ОПЕРАТОР Тех.поддержка ➖ {config.SUPPORT_MANAGER}\n"
         f"📣 НОВОСТНОЙ КАНАЛ ➖ {config.NEWS_CHANNEL}\n\n"
         f"━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"💱 Текущий курс BTC: {btc_rate:,.0f} ₽\n"
+        f"💱 Текущий курс BTC: {rate_text}\n"
         f"🏛 Комиссия сервиса: {COMMISSION_PERCENT}%\n\n"
         f"💰 Лимиты: {config.MIN_AMOUNT:,} - {config.MAX_AMOUNT:,} ₽"
     )
@@ -1080,6 +1120,8 @@ async def my_orders_handler(message: Message):
 async def rates_handler(message: Message):
     try:
         btc_rate = await BitcoinAPI.get_btc_rate()
+        if not btc_rate:
+            raise ValueError("rate unavailable")
         text = (
             f"📈 <b>Актуальные курсы</b>\n\n"
             f"₿ Bitcoin: {btc_rate:,.0f} ₽\n\n"
@@ -1183,10 +1225,9 @@ async def contact_handler(message: Message, state: FSMContext):
 async def operator_sent_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='completed')
-        order = await db.get_order(order_id)
+        order = await db.transition_order(order_id, 'completed')
         if not order:
-            await callback.answer("Заявка не найдена")
+            await callback.answer("Заявка не найдена или уже в другом статусе")
             return
         display_id = order.get('personal_id', order_id)
         text_client = (
@@ -1220,10 +1261,9 @@ async def operator_sent_handler(callback: CallbackQuery):
 async def operator_problem_handler(callback: CallbackQuery, state: FSMContext):
     order_id = int(callback.data.split("_")[-1])
     try:
-        await db.update_order(order_id, status='problem')
-        order = await db.get_order(order_id)
+        order = await db.transition_order(order_id, 'problem')
         if not order:
-            await callback.answer("Заявка не найдена")
+            await callback.answer("Заявка не найдена или уже в другом статусе")
             return
         display_id = order.get('personal_id', order_id)
         text = (
@@ -1307,12 +1347,11 @@ async def operator_note_handler(callback: CallbackQuery, state: FSMContext):
 async def operator_handle_handler(callback: CallbackQuery):
     order_id = int(callback.data.split("_")[-1])
     try:
-        order = await db.get_order(order_id)
+        order = await db.transition_order(order_id, 'processing')
         if not order:
-            await callback.answer("Заявка не найдена")
+            await callback.answer("Заявка не найдена или уже в другом статусе")
             return
         display_id = order.get('personal_id', order_id)
-        await db.update_order(order_id, status='processing')
         text = (
             f"🔧 <b>Обработка заявки #{display_id}</b>\n\n"
             f"👤 Обработал: @{callback.from_user.username or callback.from_user.first_name}\n"
@@ -1344,7 +1383,10 @@ async def operator_cancel_handler(callback: CallbackQuery):
         if not api_response.get('success'):
             await callback.answer(f"❌ Ошибка отмены: {api_response.get('error', 'Неизвестная ошибка')}")
             return
-        await db.update_order(order_id, status='cancelled')
+        order = await db.transition_order(order_id, 'cancelled')
+        if not order:
+            await callback.answer("Заявка не найдена или уже в другом статусе")
+            return
         text = (
             f"❌ <b>Заявка #{display_id} отменена</b>\n\n"
             f"👤 Обработал: @{callback.from_user.username or callback.from_user.first_name}\n"
@@ -1354,7 +1396,7 @@ async def operator_cancel_handler(callback: CallbackQuery):
             text,
             parse_mode="HTML"
         )
-        await notify_client_order_cancelled(order)
+        await notify_client_order_cancelled(callback.bot, order)
         await callback.answer("❌ Заявка отменена")
     except Exception as e:
         logger.error(f"Operator cancel handler error: {e}")
@@ -1408,7 +1450,7 @@ async def review_reject_handler(callback: CallbackQuery):
         logger.error(f"Review reject handler error: {e}")
         await callback.answer("❌ Ошибка")
 
-@router.message(Command("broadcast"), F.from_user.id.in_(config.ADMIN_USER_ID))
+@router.message(Command("broadcast"), F.from_user.id == config.ADMIN_USER_ID)
 async def broadcast_handler(message: Message, state: FSMContext):
     try:
         await message.answer(
@@ -1428,24 +1470,15 @@ async def broadcast_message_handler(message: Message, state: FSMContext):
         await show_main_menu(message)
         return
     try:
-        users = await db.get_all_users()
-        broadcast_text = message.text
-        success_count = 0
-        for user in users:
-            try:
-                await message.bot.send_message(
-                    user['user_id'],
-                    broadcast_text,
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
-                success_count += 1
-                await asyncio.sleep(0.05)
-            except Exception as e:
-                logger.warning(f"Failed to send broadcast to {user['user_id']}: {e}")
+        broadcast_id = await broadcast_engine.start(
+            message.bot,
+            "all",
+            admin_chat_id=message.chat.id,
+            text=message.text
+        )
         await message.answer(
-            f"✅ <b>Рассылка завершена</b>\n\n"
-            f"Отправлено {success_count} из {len(users)} пользователям",
+            f"✅ <b>Рассылка #{broadcast_id} запущена</b>\n\n"
+            f"Отправка идёт в фоне, прогресс обновляется в сообщении выше",
             reply_markup=ReplyKeyboards.main_menu(),
             parse_mode="HTML"
         )
@@ -1468,10 +1501,10 @@ async def deep_link_start_handler(message: Message, state: FSMContext):
         if not user:
             captcha_enabled = await db.get_setting("captcha_enabled", config.CAPTCHA_ENABLED)
             if captcha_enabled:
-                image_buffer, answer = CaptchaGenerator.generate_image_captcha()
-                await db.create_captcha_session(message.from_user.id, answer.upper())
+                image_bytes, answer = await captcha_pool.get()
+                captcha_sessions.create(message.from_user.id, answer.upper())
                 captcha_photo = BufferedInputFile(
-                    image_buffer.read(),
+                    image_bytes,
                     filename="captcha.png"
                 )
                 await message.answer_photo(
@@ -1523,18 +1556,34 @@ async def admin_stats_handler(message: Message):
             reply_markup=ReplyKeyboards.main_menu()
         )
 
-@router.message(Command("health"), F.from_user.id.in_(config.ADMIN_USER_ID))
+@router.message(Command("health"), F.from_user.id == config.ADMIN_USER_ID)
 async def health_check_handler(message: Message):
     try:
         response = await payment_api_manager.health_check()
         text = ""
         for api_name, result in response.items():
             if result.get("success"):
-                text += f"✅ {api_name}: <b>{result['data']['status']}</b>\n"
+                text += f"✅ {api_name}: <b>{result.get('data', {}).get('status', 'ok')}</b>\n"
             else:
                 text += f"❌ {api_name}: {result.get('error', 'Неизвестная ошибка')}\n"
                 if "status_code" in result:
                     text += f"Код ошибки: {result['status_code']}\n"
+
+        scoreboard = payment_api_manager.router.scoreboard()
+        if scoreboard:
+            text += "\n📈 <b>Маршрутизация (окно замеров):</b>\n"
+            for row in scoreboard:
+                text += (
+                    f"{row['api_name']} / {row['payment_type']}: "
+                    f"успех {row['success_ratio'] * 100:.0f}%, "
+                    f"p50 {row['p50']:.1f}с, p90 {row['p90']:.1f}с, "
+                    f"ожидание ≈{row['expected']:.1f}с ({row['samples']} шт.)\n"
+                )
+            text += f"Разведочных запусков: {payment_api_manager.router.explorations}\n"
+
+        breakers = gateway_breakers.snapshot()
+        if breakers:
+            text += "\n🔌 <b>Автоматы провайдеров:</b>\n" + format_breakers(breakers)
         await message.answer(
             text,
             reply_markup=ReplyKeyboards.main_menu(),
@@ -1553,124 +1602,134 @@ async def health_check_handler(message: Message):
 
 
 
-async def process_pspware_webhook(webhook_data: dict, bot):
+PAYMENT_PROVIDER_TITLES = {
+    'onlypays': 'OnlyPays',
+    'pspware': 'PSPWare',
+    'greengo': 'Greengo',
+    'nicepay': 'NicePay',
+}
+
+
+async def process_payment_event(provider: str, webhook_data: dict, bot):
+    """Переход заявки по событию провайдера: finished -> paid_by_client, cancelled -> cancelled"""
+    title = PAYMENT_PROVIDER_TITLES[provider]
     try:
         order_id = webhook_data.get('personal_id')
         status = webhook_data.get('status')
         received_sum = webhook_data.get('received_sum')
 
         if not order_id:
-            logger.error(f"Webhook без personal_id: {webhook_data}")
+            logger.error(f"{title} webhook без personal_id: {webhook_data}")
             return
 
         order = await db.get_order(int(order_id))
         if not order:
             logger.error(f"Заказ не найден: {order_id}")
             return
+        if not order_owned_by(provider, order, webhook_data):
+            # Событие по чужому заказу: другой провайдер или не тот id у провайдера
+            logger.warning(f"{title}: заявка #{order['id']} ему не принадлежит, '{status}' "
+                           f"(id {webhook_data.get('id')}) пропущен")
+            return
 
-        if status == 'finished':
-            await db.update_order(
-                order['id'],
-                status='paid_by_client',
-                received_sum=received_sum
-            )
-            updated_order = await db.get_order(order['id'])  # Получаем обновлённый заказ
-            await notify_operators_paid_order(bot, updated_order, received_sum)
-            await notify_client_payment_received(bot, updated_order)
-        elif status == 'cancelled':
-            await db.update_order(order['id'], status='cancelled')
-            updated_order = await db.get_order(order['id'])
-            await notify_client_order_cancelled(bot, updated_order)
-    except Exception as e:
-        logger.error(f"Ошибка обработки webhook PSPWare: {e}")
-
-
-
-
-
-
-
-async def process_greengo_webhook(webhook_data: dict, bot):
-    try:
-        order_id = webhook_data.get('personal_id')
-        greengo_id = webhook_data.get('id')
-        status = webhook_data.get('status')
-        received_sum = webhook_data.get('received_sum')
-        
-        if not order_id:
-            logger.error(f"Greengo webhook without personal_id: {webhook_data}")
+        event = await payment_events.claim(provider, webhook_data)
+        if event is None:
+            logger.info(f"Повторное событие {provider} по заявке {order_id} ('{status}') пропущено")
             return
-        
-        order = await db.get_order(int(order_id))
-        if not order:
-            logger.error(f"Order not found: {order_id}")
+
+        try:
+            if status == 'finished':
+                # Заявку, которую уже взял оператор, поздний callback назад не переводит
+                updated_order = await db.transition_order(int(order_id), 'paid_by_client',
+                                                          expected=('waiting', 'cancelled'), received_sum=received_sum)
+            elif status == 'cancelled':
+                # Провайдер отменяет только неоплаченную заявку
+                updated_order = await db.transition_order(int(order_id), 'cancelled', expected=('waiting',))
+            else:
+                return
+        except Exception:
+            # Переход не записан - повтор от провайдера или сверки должен пройти
+            await payment_events.release(event)
+            raise
+        # Дальше ключ события не освобождается: переход уже записан, и повтор не отправил бы уведомления заново
+
+        if updated_order is None:
+            order = await db.get_order(int(order_id))
+            logger.info(f"Заявка #{order_id} в статусе {order['status'] if order else '-'}, "
+                        f"'{status}' от {title} пропущен")
             return
-        
+
+        display_id = updated_order.get('personal_id') or order_id
         if status == 'finished':
-            await db.update_order(
-                order['id'], 
-                status='paid_by_client',
-                received_sum=received_sum
-            )
-            updated_order = await db.get_order(order['id'])  # Получаем обновлённый заказ
             await notify_operators_paid_order(bot, updated_order, received_sum)
             await notify_client_payment_received(bot, updated_order)
-            logger.info(f"Greengo заявка #{order_id} успешно обработана")
-        elif status == 'cancelled':
-            await db.update_order(order['id'], status='cancelled')
-            updated_order = await db.get_order(order['id'])
+            logger.info(f"Заявка #{display_id} оплачена ({title})")
+        else:
             await notify_client_order_cancelled(bot, updated_order)
+            logger.info(f"Заявка #{display_id} отменена ({title})")
     except Exception as e:
-        logger.error(f"Greengo webhook processing error: {e}")
+        logger.error(f"Ошибка обработки {title} webhook: {e}")
 
 
+async def process_pspware_webhook(webhook_data: dict, bot):
+    await process_payment_event('pspware', webhook_data, bot)
 
 
+async def process_greengo_webhook(webhook_data: dict, bot):
+    await process_payment_event('greengo', webhook_data, bot)
 
 
 async def process_onlypays_webhook(webhook_data: dict, bot):
     """Обработка webhook от OnlyPays"""
-    try:
-        order_id = webhook_data.get('personal_id')
-        status = webhook_data.get('status')
-        received_sum = webhook_data.get('received_sum')
-
-        if not order_id:
-            logger.error(f"OnlyPays webhook без personal_id: {webhook_data}")
-            return
-
-        order = await db.get_order(int(order_id))
-        if not order:
-            logger.error(f"Заказ не найден: {order_id}")
-            return
+    await process_payment_event('onlypays', webhook_data, bot)
+
+
+async def process_nicepay_webhook(webhook_data: dict, bot):
+    """Обработка webhook от NicePay (personal_id - наш merchantOrderId)"""
+    await process_payment_event('nicepay', webhook_data, bot)
+
+
+async def apply_provider_status(bot, order: dict, api_name: str, status_data: dict):
+    """Переход заявки по статусу, найденному сверкой, через тот же путь, что и webhook провайдера"""
+    webhook_data = {
+        # Тот же ключ события, что и у callback-а провайдера - повтор отсеет payment_events
+        'id': order_provider(order)[1] or status_data.get('id'),
+        'status': status_data['status'],
+        'personal_id': str(order['id']),
+        'received_sum': status_data.get('received_sum', order['total_amount'])
+    }
+    if api_name == 'OnlyPays':
+        await process_onlypays_webhook(webhook_data, bot)
+    elif api_name == 'PSPWare':
+        await process_pspware_webhook(webhook_data, bot)
+    else:
+        await process_greengo_webhook(webhook_data, bot)
+
+
+order_reconciler = OrderReconciler(
+    db,
+    payment_api_manager,
+    apply_provider_status,
+    tick=config.RECONCILE_TICK,
+    min_interval=config.RECONCILE_MIN_INTERVAL,
+    max_interval=config.RECONCILE_MAX_INTERVAL,
+    batch_size=config.RECONCILE_BATCH_SIZE,
+    max_age=config.RECONCILE_MAX_AGE,
+)
 
-        if status == 'finished':
-            # Обновляем статус заказа на "оплачен"
-            await db.update_order(
-                order['id'],
-                status='paid_by_client',
-                received_sum=received_sum
-            )
-            
-            # Получаем обновленный заказ из БД
-            updated_order = await db.get_order(order['id'])
-            
-            # Отправляем уведомление операторам об оплаченной заявке
-            await notify_operators_paid_order(bot, updated_order, received_sum)
-            
-            # Уведомляем клиента о получении платежа
-            await notify_client_payment_received(bot, updated_order)
-            
-            logger.info(f"Заявка #{updated_order.get('personal_id', order_id)} успешно оплачена")
-            
-        elif status == 'cancelled':
-            await db.update_order(order['id'], status='cancelled')
-            updated_order = await db.get_order(order['id'])
-            await notify_client_order_cancelled(bot, updated_order)
-            logger.info(f"Заявка #{updated_order.get('personal_id', order_id)} отменена")
-            
-    except Exception as e:
-        logger.error(f"Ошибка обработки OnlyPays webhook: {e}")
+payment_ingestion = PaymentIngestion(
+    db,
+    {
+        'onlypays': process_onlypays_webhook,
+        'pspware': process_pspware_webhook,
+        'greengo': process_greengo_webhook,
+        'nicepay': process_nicepay_webhook,
+    },
+    queue_size=config.PAYMENT_QUEUE_SIZE,
+    workers=config.PAYMENT_WORKERS,
+    token=config.PAYMENT_WEBHOOK_TOKEN,
+    verifiers=configured_verifiers(),
+)
 
 
 
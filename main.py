@@ -1,6 +1,8 @@
 import asyncio
 import logging
 import os
+import signal
+from typing import Optional
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
@@ -9,7 +11,14 @@ from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_applicati
 
 from config import config
 from database.models import Database
+from database.fsm_storage import create_fsm_storage
+from api.transport import gateway_transport
+from utils.crypto_rates import rate_service
+from utils.captcha import captcha_pool, captcha_sessions
+from utils.broadcast import broadcast_engine
+from utils.jobs import job_queue
 from handlers import user, admin, operator, calculator
+from supervisor import run_supervisor
 from middlewares.chat_type import PrivateChatMiddleware
 
 logging.basicConfig(
@@ -24,31 +33,63 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=config.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+fsm_storage = create_fsm_storage()
+dp = Dispatcher(storage=fsm_storage)
 
 dp.include_router(admin.router)
 dp.include_router(user.router)
 dp.include_router(operator.router)
 dp.include_router(calculator.router)
 
-dp.message.middleware(PrivateChatMiddleware())
-dp.callback_query.middleware(PrivateChatMiddleware())
+db = Database(config.DATABASE_URL)
+
+private_chat_middleware = PrivateChatMiddleware(db)
+dp.message.middleware(private_chat_middleware)
+dp.callback_query.middleware(private_chat_middleware)
 
 async def init_database():
     try:
-        db = Database(config.DATABASE_URL)
         await db.init_db()
+        if config.IS_LEADER:
+            db.pool.start_checkpointer()
+        if config.CAPTCHA_SESSION_SPILL:
+            restored = await captcha_sessions.restore(db, config.WORKER_INDEX, config.WORKER_COUNT)
+            if restored:
+                logger.info(f"Restored {restored} captcha sessions")
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
 
+async def close_database():
+    try:
+        if config.CAPTCHA_SESSION_SPILL:
+            await captcha_sessions.spill(db)
+        await db.close()
+        logger.info("Database connections closed")
+    except Exception as e:
+        logger.error(f"Failed to close database: {e}")
+
+async def start_services():
+    await init_database()
+    await gateway_transport.start()
+    rate_service.start()
+    captcha_pool.start()
+    user.payment_ingestion.start(bot)
+    # Задачи разбирают все процессы: аренда в БД не даёт взять одну задачу дважды
+    job_queue.start(bot)
+    # В кластере фоновые задачи, которые должны идти в одном экземпляре, запускает лидер
+    if config.IS_LEADER:
+        await broadcast_engine.resume(bot)
+        user.order_reconciler.start(bot)
+
 async def on_startup():
     try:
-        await init_database()
+        await start_services()
         
         if config.USE_WEBHOOK:
             await bot.set_webhook(url=config.WEBHOOK_URL + config.WEBHOOK_PATH, 
+                                secret_token=config.WEBHOOK_SECRET or None,
                                 drop_pending_updates=True)
             logger.info("Webhook set successfully")
         
@@ -58,8 +99,14 @@ async def on_startup():
         raise
 
 async def on_shutdown():
+    # Рассылки останавливаем до закрытия сессии бота; продолжатся при следующем запуске
+    await broadcast_engine.stop()
+    await user.order_reconciler.stop()
+    await user.payment_ingestion.stop()
+    await job_queue.stop()
     try:
-        if config.USE_WEBHOOK:
+        # Вебхуком кластера управляет супервизор
+        if config.USE_WEBHOOK and config.BOT_MODE != "worker":
             await bot.delete_webhook()
             logger.info("Webhook deleted")
         
@@ -68,17 +115,41 @@ async def on_shutdown():
     except Exception as e:
         logger.error(f"Shutdown error: {e}")
 
+    await rate_service.stop()
+    await captcha_pool.stop()
+    await gateway_transport.close()
+    # Отложенные записи FSM сбрасываются до закрытия пула
+    await fsm_storage.close()
+    await close_database()
+
 def create_app() -> web.Application:
     app = web.Application()
-    webhook_requests_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+    webhook_requests_handler = SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=config.WEBHOOK_SECRET or None
+    )
     webhook_requests_handler.register(app, path=config.WEBHOOK_PATH)
+    # Callback-и платёжных провайдеров на том же приложении
+    user.payment_ingestion.register(app)
     setup_application(app, dp, bot=bot)
     return app
 
+async def start_payment_server() -> Optional[web.AppRunner]:
+    """В режиме polling callback-и провайдеров принимает отдельный небольшой HTTP-сервер"""
+    app = web.Application()
+    if not user.payment_ingestion.register(app):
+        return None
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=config.PAYMENT_WEBHOOK_HOST, port=config.PAYMENT_WEBHOOK_PORT).start()
+    logger.info(f"Payment callbacks server started on {config.PAYMENT_WEBHOOK_HOST}:{config.PAYMENT_WEBHOOK_PORT}")
+    return runner
+
 async def run_polling():
     logger.info("Starting bot in polling mode")
+    payment_runner = None
     try:
-        await init_database()
+        await start_services()
+        payment_runner = await start_payment_server()
         await bot.delete_webhook(drop_pending_updates=True)
         await dp.start_polling(bot, skip_updates=True)
     except KeyboardInterrupt:
@@ -87,35 +158,61 @@ async def run_polling():
         logger.error(f"Polling error: {e}")
         raise
     finally:
+        if payment_runner is not None:
+            await payment_runner.cleanup()
         await on_shutdown()
 
+async def serve_webhook(host: str, port: int):
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    
+    site = web.TCPSite(runner, host=host, port=port)
+    await site.start()
+    
+    logger.info(f"Webhook server started on {host}:{port}")
+    
+    # Ждем SIGTERM/SIGINT, чтобы корректно сбросить состояние перед выходом
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
 async def run_webhook():
     logger.info("Starting bot in webhook mode")
     try:
         await on_startup()
-        
-        app = create_app()
-        runner = web.AppRunner(app)
-        await runner.setup()
-        
-        site = web.TCPSite(runner, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT)
-        await site.start()
-        
-        logger.info(f"Webhook server started on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}")
-        
-        # Ждем завершения
-        await asyncio.Event().wait()
-        
+        await serve_webhook(config.WEBHOOK_HOST, config.WEBHOOK_PORT)
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         raise
     finally:
         await on_shutdown()
 
+async def run_worker():
+    """Воркер кластера: апдейты приходят от супервизора, вебхук он не ставит и не снимает"""
+    logger.info(f"Starting cluster worker {config.WORKER_INDEX}/{config.WORKER_COUNT}")
+    try:
+        await start_services()
+        await serve_webhook("127.0.0.1", config.CLUSTER_BASE_PORT + config.WORKER_INDEX)
+    except Exception as e:
+        logger.error(f"Worker {config.WORKER_INDEX} error: {e}")
+        raise
+    finally:
+        await on_shutdown()
+
 async def main():
     mode = os.getenv('BOT_MODE', 'polling').lower()
     
-    if mode == 'webhook' and config.USE_WEBHOOK:
+    if mode == 'cluster':
+        await run_supervisor()
+    elif mode == 'worker':
+        await run_worker()
+    elif mode == 'webhook' and config.USE_WEBHOOK:
         await run_webhook()
     else:
         await run_polling()
@@ -1,18 +1,115 @@
-from typing import Callable, Dict, Any, Awaitable
+import logging
+import re
+from typing import Callable, Dict, Any, Awaitable, FrozenSet, Iterable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 from aiogram.enums import ChatType
 from config import config
+from database.models import Database
+
+logger = logging.getLogger(__name__)
+
+ADMIN_COMMANDS = frozenset({
+    "/admin", "/grant_admin", "/grant_operator", "/revoke_admin",
+    "/revoke_operator", "/my_id", "/list_staff", "/get_my_id",
+    "/setup_admin_chat", "/set_percentage", "/toggle_captcha",
+    "/user_info", "/block_user", "/unblock_user", "/search_user",
+    "/recent_users", "/user_stats", "/send_message", "/check_captcha",
+    "/recent_orders", "/pending_orders", "/order_info",
+    "/complete_order", "/cancel_order", "/set_limits", "/set_welcome"
+})
+
+USER_COMMANDS = frozenset({"/start", "/help"})
+
+ADMIN_BUTTONS = frozenset({
+    "📊 Статистика", "⚙️ Настройки", "📋 Заявки",
+    "💰 Баланс", "👥 Персонал", "🔧 Управление",
+    "❌ Скрыть панель", "📢 Рассылка", "👥 Пользователи",
+    "◀️ Выйти из админки"
+})
+
+ADMIN_CALLBACK_PREFIXES = (
+    "admin_", "order_", "user_", "staff_", "settings_",
+    "op_", "confirm_", "cancel_"
+)
+
+# Подтверждение и отмена своей заявки доступны клиенту
+USER_CALLBACK_PREFIXES = ("confirm_order_", "cancel_order_")
+
+GROUP_CHAT_TYPES = frozenset({ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL})
+
+
+class CommandMatcher:
+    """Предкомпилированная проверка команд, кнопок и префиксов callback"""
+
+    def __init__(self, admin_commands: Iterable[str], user_commands: Iterable[str],
+                 admin_buttons: Iterable[str], admin_prefixes: Iterable[str],
+                 user_prefixes: Iterable[str] = ()):
+        self.admin_commands = frozenset(admin_commands)
+        self.user_commands = frozenset(user_commands)
+        self.admin_buttons = frozenset(admin_buttons)
+        allowed = "".join(f"(?!{re.escape(prefix)})" for prefix in user_prefixes)
+        prefixes = "|".join(re.escape(prefix) for prefix in admin_prefixes)
+        self._admin_callback = re.compile(f"^{allowed}(?:{prefixes})")
+
+    @staticmethod
+    def command_name(text: str) -> str:
+        # "/start@bot r-123" -> "/start"
+        return text.split(maxsplit=1)[0].split("@", 1)[0] if text else ""
+
+    def is_admin_command(self, text: str) -> bool:
+        return self.command_name(text) in self.admin_commands
+
+    def is_user_command(self, text: str) -> bool:
+        return self.command_name(text) in self.user_commands
+
+    def is_admin_button(self, text: str) -> bool:
+        return text in self.admin_buttons
+
+    def is_admin_callback(self, data: str) -> bool:
+        return self._admin_callback.match(data or "") is not None
+
+
+class StaffRoles:
+    """Замороженное множество персонала; пересчитывается при смене версии настроек"""
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._version = None
+        self._staff: FrozenSet[int] = frozenset()
+
+    def staff(self) -> FrozenSet[int]:
+        settings = self.db.settings
+        if settings.version != self._version:
+            self._staff = frozenset(
+                [config.ADMIN_USER_ID]
+                + settings.get("admin_users", [])
+                + settings.get("operator_users", [])
+            )
+            self._version = settings.version
+        return self._staff
+
+    def is_staff(self, user_id: int) -> bool:
+        return user_id in self.staff()
+
 
 class PrivateChatMiddleware(BaseMiddleware):
-    
+
+    def __init__(self, db: Database = None, matcher: CommandMatcher = None):
+        self.db = db or Database(config.DATABASE_URL)
+        self.roles = StaffRoles(self.db)
+        self.matcher = matcher or CommandMatcher(
+            ADMIN_COMMANDS, USER_COMMANDS, ADMIN_BUTTONS,
+            ADMIN_CALLBACK_PREFIXES, USER_CALLBACK_PREFIXES
+        )
+
     async def __call__(
         self,
         handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
         event: Message | CallbackQuery,
         data: Dict[str, Any]
     ) -> Any:
-        
+
         if isinstance(event, Message):
             chat = event.chat
             user_id = event.from_user.id
@@ -23,97 +120,68 @@ class PrivateChatMiddleware(BaseMiddleware):
             message_text = event.data or ""
         else:
             return await handler(event, data)
-        
-        super_admins = [config.ADMIN_USER_ID]
-        if user_id in super_admins:
-            return await handler(event, data)
-        
-        from database.models import Database
-        db = Database(config.DATABASE_URL)
-        
+
+        # Без I/O, пока кэш настроек загружен и свеж
         try:
-            admin_users = await db.get_setting("admin_users", [])
-            operator_users = await db.get_setting("operator_users", [])
-            is_staff = user_id in admin_users or user_id in operator_users
-        except:
-            is_staff = False
-        
-        if is_staff:
+            await self.db.ensure_settings()
+        except Exception as e:
+            # Сбой БД не должен останавливать апдейты: роли берём из последнего загруженного кэша
+            logger.warning(f"Settings reload failed, using cached staff roles: {e}")
+        if self.roles.is_staff(user_id):
             return await handler(event, data)
-        
-        admin_commands = [
-            "/admin", "/grant_admin", "/grant_operator", "/revoke_admin", 
-            "/revoke_operator", "/my_id", "/list_staff", "/get_my_id",
-            "/setup_admin_chat", "/set_percentage", "/toggle_captcha",
-            "/user_info", "/block_user", "/unblock_user", "/search_user",
-            "/recent_users", "/user_stats", "/send_message", "/check_captcha",
-            "/recent_orders", "/pending_orders", "/order_info", 
-            "/complete_order", "/cancel_order", "/set_limits", "/set_welcome"
-        ]
-        
-        admin_buttons = [
-            "📊 Статистика", "⚙️ Настройки", "📋 Заявки", 
-            "💰 Баланс", "👥 Персонал", "🔧 Управление",
-            "❌ Скрыть панель", "📢 Рассылка", "👥 Пользователи",
-            "◀️ Выйти из админки"
-        ]
-        
-        admin_callbacks = [
-            "admin_", "order_", "user_", "staff_", "settings_",
-            "op_", "confirm_", "cancel_"
-        ]
-        
-        if chat.type in [ChatType.GROUP, ChatType.SUPERGROUP, ChatType.CHANNEL]:
+
+        matcher = self.matcher
+
+        if chat.type in GROUP_CHAT_TYPES:
             if isinstance(event, CallbackQuery):
-                if any(event.data.startswith(prefix) for prefix in admin_callbacks):
+                if matcher.is_admin_callback(event.data):
                     await event.answer("❌ У вас нет прав", show_alert=True)
                     return
                 else:
                     await event.answer("❌ Кнопки недоступны в групповых чатах", show_alert=True)
                     return
-            
+
             if isinstance(event, Message):
                 if message_text.startswith("/"):
-                    if any(message_text.startswith(cmd) for cmd in admin_commands):
+                    if matcher.is_admin_command(message_text):
                         await event.answer("❌ У вас нет прав для выполнения этой команды")
                         return
                     else:
                         await event.answer("❌ В групповых чатах доступны только административные команды")
                         return
-                elif message_text in admin_buttons:
+                elif matcher.is_admin_button(message_text):
                     await event.answer("❌ У вас нет прав администратора")
                     return
                 else:
                     return
-            
+
             return
-        
+
         if isinstance(event, Message):
             if message_text.startswith("/"):
-                if any(message_text.startswith(cmd) for cmd in admin_commands):
+                if matcher.is_admin_command(message_text):
                     await event.answer("❌ У вас нет прав для выполнения этой команды")
                     return
-                
-                allowed_user_commands = ["/start", "/help"]
-                if any(message_text.startswith(cmd) for cmd in allowed_user_commands):
+
+                if matcher.is_user_command(message_text):
                     return await handler(event, data)
-                
+
                 await event.answer("❌ Команда недоступна")
                 return
-            
+
             if chat.type == ChatType.PRIVATE:
-                if message_text in admin_buttons:
+                if matcher.is_admin_button(message_text):
                     await event.answer("❌ У вас нет доступа к админ-панели")
                     return
-                
+
                 return await handler(event, data)
-        
+
         elif isinstance(event, CallbackQuery):
-            if any(event.data.startswith(prefix) for prefix in admin_callbacks):
+            if matcher.is_admin_callback(event.data):
                 await event.answer("❌ У вас нет прав", show_alert=True)
                 return
-            
+
             if chat.type == ChatType.PRIVATE:
                 return await handler(event, data)
-        
-        return await handler(event, data)
\ No newline at end of file
+
+        return await handler(event, data)
@@ -0,0 +1,194 @@
+"""Кластерный режим (BOT_MODE=cluster): один приёмник вебхука и N воркеров-процессов.
+
+Супервизор принимает апдейты Telegram на WEBHOOK_HOST:WEBHOOK_PORT и пересылает каждый
+воркеру chat_id % N на 127.0.0.1:CLUSTER_BASE_PORT + номер. Апдейты одного чата всегда
+попадают в один и тот же процесс, поэтому горячий кэш FSM и сессии капчи чата не
+расходятся между воркерами. Настройки воркеры перечитывают из БД по CLUSTER_SETTINGS_TTL,
+курс публикует лидер (воркер 0). Упавший воркер перезапускается.
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+from aiogram import Bot
+
+from config import config
+from database.models import Database
+from webhook import payment_callbacks_configured
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+FORWARD_HEADERS = (SECRET_HEADER, "Content-Type")
+
+
+def shard_for(update: Dict[str, Any], workers: int) -> int:
+    """Номер воркера для апдейта: по chat_id, а без чата - по id пользователя"""
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"] % workers
+        user = payload.get("from") or payload.get("user")
+        if user and "id" in user:
+            return user["id"] % workers
+    return 0
+
+
+class Supervisor:
+
+    def __init__(self, workers: int, base_port: int, path: str):
+        self.workers = max(1, workers)
+        self.base_port = base_port
+        self.path = path
+        self.forwarded = [0] * self.workers
+        self._processes: List[Optional[asyncio.subprocess.Process]] = [None] * self.workers
+        self._watchers: List[asyncio.Task] = []
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._stopping = False
+
+    def worker_env(self, index: int) -> Dict[str, str]:
+        env = dict(os.environ)
+        env.update({
+            "BOT_MODE": "worker",
+            "WORKER_INDEX": str(index),
+            "WORKER_COUNT": str(self.workers),
+        })
+        # Настройки меняются в любом воркере - остальные перечитывают их по TTL
+        if float(env.get("DB_SETTINGS_TTL") or 0) <= 0:
+            env["DB_SETTINGS_TTL"] = str(config.CLUSTER_SETTINGS_TTL)
+        return env
+
+    async def _watch(self, index: int):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        backoff = 1.0
+        while not self._stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, script, env=self.worker_env(index))
+            self._processes[index] = process
+            logger.info(f"Worker {index} started (pid {process.pid}, port {self.base_port + index})")
+            code = await process.wait()
+            if self._stopping:
+                break
+            logger.error(f"Worker {index} exited with code {code}, restarting in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    async def _proxy(self, request: web.Request, shard: int, body: bytes) -> web.Response:
+        headers = {name: request.headers[name] for name in FORWARD_HEADERS if name in request.headers}
+        try:
+            async with self._session.post(
+                f"http://127.0.0.1:{self.base_port + shard}{request.path_qs}", data=body, headers=headers
+            ) as response:
+                self.forwarded[shard] += 1
+                return web.Response(status=response.status, body=await response.read(),
+                                    content_type=response.content_type)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Не 2xx - отправитель повторит доставку, когда воркер поднимется
+            logger.warning(f"Worker {shard} unavailable for {request.path}: {e}")
+            return web.Response(status=503)
+
+    async def forward(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        return await self._proxy(request, shard_for(update, self.workers), body)
+
+    async def forward_payment(self, request: web.Request) -> web.Response:
+        # Callback-и провайдеров обрабатывает лидер
+        return await self._proxy(request, 0, await request.read())
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "workers": [
+                {
+                    "index": index,
+                    "pid": process.pid if process else None,
+                    "alive": process is not None and process.returncode is None,
+                    "forwarded": self.forwarded[index],
+                }
+                for index, process in enumerate(self._processes)
+            ]
+        })
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.forward)
+        if payment_callbacks_configured():
+            app.router.add_post("/{provider}/notification", self.forward_payment)
+        app.router.add_get("/cluster/stats", self.stats)
+        return app
+
+    async def start(self):
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=60),
+            connector=aiohttp.TCPConnector(limit=0, keepalive_timeout=30)
+        )
+        self._watchers = [asyncio.create_task(self._watch(index)) for index in range(self.workers)]
+
+    async def stop(self, timeout: float = 15):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        for process in self._processes:
+            if process is None:
+                continue
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker pid {process.pid} did not stop in {timeout}s, killing")
+                process.kill()
+        for watcher in self._watchers:
+            watcher.cancel()
+        await asyncio.gather(*self._watchers, return_exceptions=True)
+        if self._session is not None:
+            await self._session.close()
+
+
+async def run_supervisor():
+    supervisor = Supervisor(config.CLUSTER_WORKERS, config.CLUSTER_BASE_PORT, config.WEBHOOK_PATH)
+    logger.info(f"Starting cluster: {supervisor.workers} workers behind {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Миграции применяются один раз до запуска воркеров, а не наперегонки в каждом
+    db = Database(config.DATABASE_URL)
+    await db.init_db()
+    await db.close()
+
+    await supervisor.start()
+    runner = web.AppRunner(supervisor.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT).start()
+
+    # Вебхук ставит только супервизор; воркеры его не трогают
+    bot = Bot(token=config.BOT_TOKEN)
+    try:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL + config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET or None,
+            drop_pending_updates=True
+        )
+        logger.info("Webhook set successfully")
+        await stop.wait()
+    finally:
+        logger.info("Stopping cluster")
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            logger.error(f"Failed to delete webhook: {e}")
+        await bot.session.close()
+        await runner.cleanup()
+        await supervisor.stop()
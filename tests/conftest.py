@@ -0,0 +1,30 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config читает окружение при импорте: модули-синглтоны не должны трогать рабочую БД
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ["DATABASE_URL"] = os.path.join(tempfile.mkdtemp(prefix="exchanger-tests-"), "bot.db")
+
+from database.models import Database  # noqa: E402
+
+
+@pytest.fixture
+def with_db(tmp_path):
+    """Запускает async-сценарий с чистой мигрированной БД в одном event loop"""
+    def run(scenario):
+        async def main():
+            db = Database(str(tmp_path / "bot.db"))
+            await db.init_db()
+            try:
+                return await scenario(db)
+            finally:
+                await db.close()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,52 @@
+import asyncio
+
+from api.api_manager import PaymentAPIManager
+
+
+class FakeAPI:
+    def __init__(self, order_id, delay):
+        self.order_id = order_id
+        self.delay = delay
+        self.cancelled = []
+
+    async def create_order(self, amount, personal_id, deadline=None, **kwargs):
+        await asyncio.sleep(self.delay)
+        return {'success': True, 'data': {'id': self.order_id}}
+
+    async def cancel_order(self, order_id):
+        self.cancelled.append(order_id)
+        return {'success': True}
+
+
+def make_manager(*delays):
+    apis = [FakeAPI(f"order-{i}", delay) for i, delay in enumerate(delays)]
+    manager = PaymentAPIManager([
+        {'name': name, 'api': api} for name, api in zip(('OnlyPays', 'PSPWare'), apis)
+    ])
+    return manager, apis
+
+
+def test_hedge_loser_is_cancelled_at_provider():
+    async def main():
+        manager, (fast, slow) = make_manager(0.05, 0.1)
+        response = await manager.create_order(1000, 'card', '1', hedge_delay=0.01)
+        assert response['api_name'] == 'OnlyPays'
+        await asyncio.gather(*manager._background)
+        assert fast.cancelled == []
+        assert slow.cancelled == ['order-1']
+    asyncio.run(main())
+
+
+def test_cancelled_create_order_drains_pending_hedges():
+    async def main():
+        manager, apis = make_manager(0.1, 0.1)
+        task = asyncio.create_task(manager.create_order(1000, 'card', '1', hedge_delay=0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert task.cancelled()
+
+        # Оба заказа у провайдеров создадутся, но клиенту не достались - оба отменяются
+        await asyncio.gather(*manager._background)
+        assert [api.cancelled for api in apis] == [['order-0'], ['order-1']]
+    asyncio.run(main())
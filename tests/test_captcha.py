@@ -0,0 +1,48 @@
+import pytest
+
+from utils import captcha
+from utils.captcha import CaptchaSessionStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(captcha.time, "time", lambda: now[0])
+    return now
+
+
+def test_session_expires_after_ttl(clock):
+    store = CaptchaSessionStore(ttl=60)
+    store.create(1, "ABCDE")
+    clock[0] += 59
+    assert store.increment(1) == 1
+    clock[0] += 1
+    assert store.get(1) is None
+    assert store.increment(1) is None
+    assert len(store) == 0
+
+
+def test_rotate_extends_session_and_keeps_attempts(clock):
+    store = CaptchaSessionStore(ttl=60)
+    store.create(1, "ABCDE")
+    store.increment(1)
+    clock[0] += 50
+    store.rotate(1, "FGHIJ")
+    clock[0] += 50
+    session = store.get(1)
+    assert (session.answer, session.attempts) == ("FGHIJ", 1)
+
+
+def test_expired_sessions_are_purged_in_order(clock):
+    store = CaptchaSessionStore(ttl=60, max_sessions=2)
+    store.create(1, "A")
+    clock[0] += 30
+    store.create(2, "B")
+    clock[0] += 30
+    # Сессия 1 истекла и убирается при создании новой; лимит вытесняет самую старую из живых
+    store.create(3, "C")
+    assert store.get(1) is None
+    assert store.get(2) is not None and store.get(3) is not None
+    store.create(4, "D")
+    assert store.get(2) is None
+    assert len(store) == 2
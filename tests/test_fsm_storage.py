@@ -0,0 +1,71 @@
+import asyncio
+
+from aiogram.fsm.storage.base import StorageKey
+
+from database import queries
+from database.fsm_storage import SQLiteStorage
+
+
+def key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def stored(db, storage, user_id):
+    async with db.reader() as conn:
+        async with conn.execute(queries.FSM_STATE, (storage._key(key(user_id)),)) as cursor:
+            row = await cursor.fetchone()
+    return row['state'] if row else None
+
+
+def test_changes_are_written_behind_in_one_batch(with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db, flush_interval=0.05)
+        await storage.set_state(key(1), "form:amount")
+        await storage.update_data(key(1), {"amount": 1000})
+        await storage.set_state(key(2), "form:address")
+        assert await stored(db, storage, 1) is None
+
+        await asyncio.sleep(0.2)
+        assert await stored(db, storage, 1) == "form:amount"
+        assert await stored(db, storage, 2) == "form:address"
+        assert storage.flushes == 1
+
+        await storage.set_state(key(1), None)
+        await storage.close()
+        assert await stored(db, storage, 1) is None
+    with_db(scenario)
+
+
+def test_only_flushed_keys_are_evicted(with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db, flush_interval=60, max_cached=2)
+        for user_id in (1, 2, 3):
+            await storage.set_state(key(user_id), f"state:{user_id}")
+        # Несброшенные ключи не вытесняются даже сверх лимита
+        assert len(storage._entries) == 3
+
+        await storage.flush()
+        await storage.get_state(key(4))
+        assert len(storage._entries) == 2
+        assert storage._key(key(1)) not in storage._entries
+        # Вытесненный ключ читается из БД
+        assert await storage.get_state(key(1)) == "state:1"
+        await storage.close()
+    with_db(scenario)
+
+
+def test_unserializable_data_does_not_break_flush(with_db):
+    async def scenario(db):
+        storage = SQLiteStorage(db, flush_interval=0.05)
+        await storage.set_data(key(1), {"callback": object()})
+        await storage.set_state(key(2), "form:amount")
+        await asyncio.sleep(0.2)
+        assert await stored(db, storage, 2) == "form:amount"
+        assert not storage._dirty
+
+        # Фоновый сброс продолжает работать
+        await storage.set_state(key(3), "form:address")
+        await asyncio.sleep(0.2)
+        assert await stored(db, storage, 3) == "form:address"
+        await storage.close()
+    with_db(scenario)
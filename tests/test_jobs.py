@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+
+from handlers import user
+from utils.jobs import JobQueue
+
+
+async def noop(bot, payload, job):
+    pass
+
+
+async def make_dead(db, payload, dedup_key=None):
+    job_id, _ = await db.enqueue_job('k', payload, 1, 0, dedup_key)
+    [job] = await db.claim_jobs(['k'], 1, 60)
+    assert job['id'] == job_id
+    assert await db.bury_job(job_id, job['attempts'], 'boom')
+    return job_id
+
+
+def test_expired_lease_is_taken_over_and_fences_the_old_attempt(with_db):
+    async def scenario(db):
+        job_id, _ = await db.enqueue_job('k', {}, 3, 0, None)
+        [first] = await db.claim_jobs(['k'], 10, 0.05)
+        # Пока аренда жива, задачу никто не берёт
+        assert await db.claim_jobs(['k'], 10, 60) == []
+
+        await asyncio.sleep(0.1)
+        [second] = await db.claim_jobs(['k'], 10, 60)
+        assert (second['id'], second['attempts']) == (job_id, first['attempts'] + 1)
+        # Исполнитель с просроченной арендой ничего не может записать
+        assert not await db.renew_job(job_id, first['attempts'], time.time() + 60)
+        assert not await db.finish_job(job_id, first['attempts'])
+        assert await db.finish_job(job_id, second['attempts'])
+    with_db(scenario)
+
+
+def test_claim_skips_delayed_and_foreign_jobs(with_db):
+    async def scenario(db):
+        await db.enqueue_job('k', {}, 3, 60, None)
+        await db.enqueue_job('other', {}, 3, 0, None)
+        assert await db.claim_jobs(['k'], 10, 60) == []
+    with_db(scenario)
+
+
+def test_requeue_refreshes_payload_and_skips_active_duplicates(with_db):
+    async def scenario(db):
+        async def refresh(payload):
+            return None if payload.get('stale') else dict(payload, deadline_at=123)
+
+        queue = JobQueue(db)
+        queue.register('k', noop, on_requeue=refresh)
+        refreshed = await make_dead(db, {'n': 1}, dedup_key='a')
+        duplicate = await make_dead(db, {'n': 2}, dedup_key='b')
+        stale = await make_dead(db, {'stale': True})
+        # По ключу 'b' уже есть незавершённая задача - её dead-копию возвращать нельзя
+        active, created = await db.enqueue_job('k', {}, 1, 0, 'b')
+        assert created
+
+        assert await queue.requeue_dead() == (1, 2)
+        jobs = {job['id']: job for job in await db.get_jobs('pending', -1)}
+        assert set(jobs) == {refreshed, active}
+        assert json.loads(jobs[refreshed]['payload']) == {'n': 1, 'deadline_at': 123}
+        assert jobs[refreshed]['attempts'] == 0
+        assert {job['id'] for job in await db.get_jobs('dead', -1)} == {duplicate, stale}
+    with_db(scenario)
+
+
+def test_requisites_requeue_only_for_waiting_orders_with_fresh_sla(with_db, monkeypatch):
+    async def sla():
+        return 60
+
+    monkeypatch.setattr(user, "requisites_sla", sla)
+
+    async def scenario(db):
+        monkeypatch.setattr(user, "db", db)
+        waiting = await db.create_order(1, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+        cancelled = await db.create_order(1, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+        await db.transition_order(cancelled, 'cancelled')
+        payload = {'order_id': waiting, 'user_id': 1, 'payment_type': 'card', 'deadline_at': 0}
+
+        refreshed = await user.requisites_job_requeue(payload)
+        assert refreshed['deadline_at'] > time.time() + 50
+        assert await user.requisites_job_requeue(dict(payload, order_id=cancelled)) is None
+    with_db(scenario)
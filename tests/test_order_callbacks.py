@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+from handlers import user
+
+OWNER_ID = 1001
+STRANGER_ID = 2002
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeMessage:
+    def __init__(self, chat_id):
+        self.chat = FakeChat(chat_id)
+        self.edits = []
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+
+
+class FakeCallback:
+    def __init__(self, data, user_id):
+        self.data = data
+        self.from_user = FakeUser(user_id)
+        self.message = FakeMessage(user_id)
+        self.bot = FakeBot()
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False):
+        self.answers.append(text)
+
+
+@pytest.fixture
+def handler_db(with_db, monkeypatch):
+    claims = []
+
+    async def fake_claim(order_id, user_id):
+        claims.append(order_id)
+        return user.RequisitesClaim('started', 1, None)
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(user, "claim_requisites", fake_claim)
+    monkeypatch.setattr(user.asyncio, "sleep", no_sleep)
+
+    def run(scenario):
+        async def patched(db):
+            monkeypatch.setattr(user, "db", db)
+            order_id = await db.create_order(OWNER_ID, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+            return await scenario(db, order_id, claims)
+        return with_db(patched)
+    return run
+
+
+def test_forged_cancel_does_not_touch_foreign_order(handler_db):
+    async def scenario(db, order_id, claims):
+        callback = FakeCallback(f"cancel_order_{order_id}", STRANGER_ID)
+        await user.order_confirmation_handler(callback, None)
+        assert callback.answers == ["❌ Заявка не найдена"]
+        assert (await db.get_order(order_id))['status'] == 'waiting'
+    handler_db(scenario)
+
+
+def test_forged_confirm_neither_requests_nor_reveals_requisites(handler_db):
+    async def scenario(db, order_id, claims):
+        await db.transition_order(order_id, 'waiting', requisites="💳 Карта: 1234")
+        callback = FakeCallback(f"confirm_order_{order_id}", STRANGER_ID)
+        await user.order_confirmation_handler(callback, None)
+        assert claims == []
+        assert callback.message.edits == []
+        assert callback.answers == ["❌ Заявка не найдена"]
+    handler_db(scenario)
+
+
+def test_owner_can_confirm_and_cancel(handler_db):
+    async def scenario(db, order_id, claims):
+        confirm = FakeCallback(f"confirm_order_{order_id}", OWNER_ID)
+        await user.order_confirmation_handler(confirm, None)
+        assert claims == [order_id]
+
+        cancel = FakeCallback(f"cancel_order_{order_id}", OWNER_ID)
+        await user.order_confirmation_handler(cancel, None)
+        assert (await db.get_order(order_id))['status'] == 'cancelled'
+    handler_db(scenario)
+
+
+def test_requisites_claim_is_closed_for_strangers(with_db, monkeypatch):
+    async def scenario(db):
+        monkeypatch.setattr(user, "db", db)
+        order_id = await db.create_order(OWNER_ID, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+        await db.transition_order(order_id, 'waiting', requisites="💳 Карта: 1234")
+
+        stranger = await user.claim_requisites(order_id, STRANGER_ID)
+        assert stranger == user.RequisitesClaim('closed', None, None)
+
+        owner = await user.claim_requisites(order_id, OWNER_ID)
+        assert owner.status == 'delivered'
+        assert owner.order['requisites'] == "💳 Карта: 1234"
+    with_db(scenario)
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+
+async def new_order(db):
+    return await db.create_order(1001, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+
+
+def test_transition_follows_the_table(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        # Из waiting сразу в completed нельзя
+        assert await db.transition_order(order_id, 'completed') is None
+        order = await db.transition_order(order_id, 'paid_by_client', received_sum=990.0)
+        assert (order['status'], order['received_sum']) == ('paid_by_client', 990.0)
+        order = await db.transition_order(order_id, 'completed')
+        assert order['status'] == 'completed' and order['completed_at']
+        assert await db.transition_order(order_id, 'cancelled') is None
+        assert await db.transition_order(404, 'cancelled') is None
+    with_db(scenario)
+
+
+def test_expected_narrows_allowed_sources(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        await db.transition_order(order_id, 'paid_by_client')
+        assert await db.transition_order(order_id, 'cancelled', expected=('waiting',)) is None
+        assert (await db.get_order(order_id))['status'] == 'paid_by_client'
+        with pytest.raises(ValueError):
+            await db.transition_order(order_id, 'completed', expected=('waiting',))
+        with pytest.raises(ValueError):
+            await db.transition_order(order_id, 'refunded')
+    with_db(scenario)
+
+
+def test_concurrent_transitions_have_one_winner(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        results = await asyncio.gather(
+            db.transition_order(order_id, 'paid_by_client', expected=('waiting',)),
+            db.transition_order(order_id, 'cancelled', expected=('waiting',)),
+        )
+        winners = [order for order in results if order is not None]
+        assert len(winners) == 1
+        assert (await db.get_order(order_id))['status'] == winners[0]['status']
+    with_db(scenario)
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+
+from handlers import user
+from webhook import PaymentEventLog
+
+PROVIDER_ORDER_ID = "op-1"
+
+
+@pytest.fixture
+def payment_db(with_db, monkeypatch):
+    notified = []
+
+    async def notify(bot, order, *args):
+        notified.append(order['id'])
+
+    monkeypatch.setattr(user, "notify_operators_paid_order", notify)
+    monkeypatch.setattr(user, "notify_client_payment_received", notify)
+    monkeypatch.setattr(user, "notify_client_order_cancelled", notify)
+
+    def run(scenario):
+        async def patched(db):
+            monkeypatch.setattr(user, "db", db)
+            monkeypatch.setattr(user, "payment_events", PaymentEventLog(db))
+            order_id = await db.create_order(1001, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+            await db.update_order(order_id, onlypays_id=PROVIDER_ORDER_ID)
+            return await scenario(db, order_id, notified)
+        return with_db(patched)
+    return run
+
+
+def paid_event(order_id):
+    return {'id': PROVIDER_ORDER_ID, 'status': 'finished', 'personal_id': str(order_id), 'received_sum': 1000.0}
+
+
+def test_repeated_event_is_processed_once(payment_db):
+    async def scenario(db, order_id, notified):
+        event = paid_event(order_id)
+        await asyncio.gather(*(user.process_payment_event('onlypays', dict(event), None) for _ in range(3)))
+        # Повтор после перезапуска: кэша в памяти нет, отсеивает уникальный индекс в БД
+        user.payment_events._recent.clear()
+        await user.process_payment_event('onlypays', dict(event), None)
+
+        assert (await db.get_order(order_id))['status'] == 'paid_by_client'
+        assert notified == [order_id, order_id]
+        assert user.payment_events.duplicates == 3
+    payment_db(scenario)
+
+
+def test_failed_notification_keeps_event_key(payment_db, monkeypatch):
+    async def scenario(db, order_id, notified):
+        async def broken(bot, order, *args):
+            raise RuntimeError("telegram is down")
+
+        monkeypatch.setattr(user, "notify_operators_paid_order", broken)
+        await user.process_payment_event('onlypays', paid_event(order_id), None)
+        assert (await db.get_order(order_id))['status'] == 'paid_by_client'
+        # Переход записан - ключ события остаётся, повтор отсеивается как дубликат
+        assert not await db.record_payment_event('onlypays', PROVIDER_ORDER_ID, 'finished')
+    payment_db(scenario)
+
+
+def test_failed_transition_releases_event_key(payment_db, monkeypatch):
+    async def scenario(db, order_id, notified):
+        transition_order = db.transition_order
+
+        async def broken(*args, **kwargs):
+            raise RuntimeError("database is locked")
+
+        monkeypatch.setattr(db, "transition_order", broken)
+        await user.process_payment_event('onlypays', paid_event(order_id), None)
+        assert (await db.get_order(order_id))['status'] == 'waiting'
+
+        # Повтор от провайдера проходит и переводит заявку
+        monkeypatch.setattr(db, "transition_order", transition_order)
+        await user.process_payment_event('onlypays', paid_event(order_id), None)
+        assert (await db.get_order(order_id))['status'] == 'paid_by_client'
+        assert notified == [order_id, order_id]
+    payment_db(scenario)
@@ -0,0 +1,76 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+
+from utils.crypto_rates import SOURCE_PARSERS, RateAggregator, RateService, RateSource
+from utils.rate_fixture_server import create_fixture_app
+
+RATE = 6_500_000.0
+
+
+def run_with_fixture(scenario, rate=RATE):
+    async def main():
+        app = create_fixture_app(rate)
+        async with TestServer(app) as server:
+            sources = [
+                RateSource(name, str(server.make_url(f"/{name}")), parser)
+                for name, parser in SOURCE_PARSERS.items()
+            ]
+            aggregator = RateAggregator(sources, timeout=2, outlier_pct=3, min_sources=2)
+            service = RateService(aggregator, refresh_interval=30, max_age=300, timeout=5)
+            try:
+                await scenario(app["fixture"], aggregator, service)
+            finally:
+                await service.stop()
+    asyncio.run(main())
+
+
+def test_median_with_outlier_rejected():
+    async def scenario(fixture, aggregator, service):
+        fixture.outliers = {"binance": 9_000_000.0, "cryptocompare": 6_600_000.0}
+        rate = await service.refresh()
+        # 9 000 000 отброшен как выброс, медиана считается по оставшимся трём
+        assert rate == RATE
+        assert aggregator.last_rejected == ["binance"]
+    run_with_fixture(scenario)
+
+
+def test_no_rate_without_quorum():
+    async def scenario(fixture, aggregator, service):
+        fixture.down = {"coingecko", "blockchain", "cryptocompare"}
+        assert await service.refresh() is None
+        assert service.failures == 1
+    run_with_fixture(scenario)
+
+
+def test_concurrent_misses_share_one_request():
+    async def scenario(fixture, aggregator, service):
+        fixture.delay = 0.2
+        rates = await asyncio.gather(*(service.get_rate() for _ in range(20)))
+        assert rates == [RATE] * 20
+        assert fixture.hits == {name: 1 for name in SOURCE_PARSERS}
+    run_with_fixture(scenario)
+
+
+def test_stale_rate_served_while_revalidating():
+    async def scenario(fixture, aggregator, service):
+        assert await service.get_rate() == RATE
+        service.refresh_interval = 0
+        fixture.rate = 6_400_000.0
+        fixture.delay = 0.2
+
+        # Старый курс отдаётся сразу, обновление идёт в фоне
+        assert await asyncio.wait_for(service.get_rate(), 0.1) == RATE
+        await service._inflight
+        assert service.peek() == 6_400_000.0
+    run_with_fixture(scenario)
+
+
+def test_rate_older_than_max_age_is_not_served():
+    async def scenario(fixture, aggregator, service):
+        assert await service.get_rate() == RATE
+        service.updated_at -= service.max_age + 1
+        fixture.rate = 6_400_000.0
+        assert service.peek() is None
+        assert await service.get_rate() == 6_400_000.0
+    run_with_fixture(scenario)
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from handlers import user
+
+
+async def new_order(db):
+    return await db.create_order(1001, 1000, 0.001, 'bc1x', 6e6, 1000, 'card')
+
+
+def test_claim_holds_after_lease_takeover_until_released(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        until = time.time() + 60
+        assert await db.claim_order_requisites(order_id, 1, 1, until)
+        # Аренду перехватила попытка 2, а попытка 1 ещё ждёт провайдера
+        assert not await db.claim_order_requisites(order_id, 1, 2, until)
+        # Чужая попытка снять захват не может
+        await db.release_order_requisites(order_id, 1, 2)
+        assert not await db.claim_order_requisites(order_id, 1, 2, until)
+
+        await db.release_order_requisites(order_id, 1, 1)
+        assert await db.claim_order_requisites(order_id, 1, 2, until)
+    with_db(scenario)
+
+
+def test_expired_claim_can_be_taken_over(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        assert await db.claim_order_requisites(order_id, 1, 1, time.time() - 1)
+        assert await db.claim_order_requisites(order_id, 1, 2, time.time() + 60)
+    with_db(scenario)
+
+
+def test_claim_refused_once_requisites_are_stored(with_db):
+    async def scenario(db):
+        order_id = await new_order(db)
+        await db.transition_order(order_id, 'waiting', requisites='x')
+        assert not await db.claim_order_requisites(order_id, 1, 1, time.time() + 60)
+    with_db(scenario)
+
+
+def test_job_does_not_call_provider_while_order_is_claimed(with_db, monkeypatch):
+    calls = []
+
+    async def create_order(**kwargs):
+        calls.append(kwargs)
+        return {'success': False, 'error': 'unexpected'}
+
+    monkeypatch.setattr(user.payment_api_manager, "create_order", create_order)
+
+    async def scenario(db):
+        monkeypatch.setattr(user, "db", db)
+        order_id = await new_order(db)
+        payload = {'order_id': order_id, 'user_id': 1001, 'payment_type': 'card',
+                   'deadline_at': time.time() + 60}
+        assert await db.claim_order_requisites(order_id, 7, 1, time.time() + 60)
+
+        with pytest.raises(user.RequisitesUnavailable):
+            await user.run_requisites_job(None, payload, {'id': 7, 'attempts': 2})
+        assert calls == []
+        # Захват прежней попытки не снят чужим release
+        assert not await db.claim_order_requisites(order_id, 7, 3, time.time() + 60)
+    with_db(scenario)
@@ -1,28 +1,18 @@
-import aiohttp
 import logging
 from typing import Optional
 
+from utils.crypto_rates import rate_service
+
 logger = logging.getLogger(__name__)
 
+RATE_UNAVAILABLE_TEXT = "❌ Курс временно недоступен. Попробуйте через минуту."
+
 class BitcoinAPI:
     
     @staticmethod
     async def get_btc_rate() -> Optional[float]:
-        """Получение текущего курса BTC/RUB"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                # Используем CoinGecko API
-                async with session.get(
-                    'https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=rub'
-                ) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data['bitcoin']['rub']
-        except Exception as e:
-            logger.error(f"Error fetching BTC rate: {e}")
-        
-        # Заглушка - примерный курс
-        return 2800000.0
+        """Получение текущего курса BTC/RUB из кэша RateService; None, если свежего курса нет"""
+        return await rate_service.get_rate()
 
     @staticmethod
     def validate_btc_address(address: str) -> bool:
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from config import config
+from database.models import Database
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Токены пополняются со скоростью rate в секунду, запас не больше capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        # RetryAfter от Telegram касается всего бота: останавливаем всех отправителей
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + max(0.0, now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат"""
+
+    def __init__(self, interval: float = 1.0, max_chats: int = 10000):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._next: Dict[int, float] = {}
+
+    async def wait(self, chat_id: int):
+        now = time.monotonic()
+        allowed_at = self._next.get(chat_id, now)
+        self._next[chat_id] = max(now, allowed_at) + self.interval
+        if len(self._next) > self.max_chats:
+            self._next = {chat: at for chat, at in self._next.items() if at > now}
+        if allowed_at > now:
+            await asyncio.sleep(allowed_at - now)
+
+
+def progress_text(broadcast: Dict, sent: int, failed: int, total: int, status: str = "running") -> str:
+    done = sent + failed
+    percent = done * 100 // total if total else 100
+    title = {
+        "running": f"📤 <b>Рассылка #{broadcast['id']}</b>",
+        "done": f"✅ <b>Рассылка #{broadcast['id']} завершена</b>",
+        "failed": f"❌ <b>Рассылка #{broadcast['id']} прервана</b>",
+    }[status]
+    return (
+        f"{title}\n\n"
+        f"📊 Прогресс: {done}/{total} ({percent}%)\n"
+        f"📤 Отправлено: {sent}\n"
+        f"❌ Ошибок: {failed}"
+    )
+
+
+class BroadcastEngine:
+    """Фоновые рассылки: общий лимит скорости, ограниченный параллелизм и контрольные точки в БД"""
+
+    def __init__(self, db: Database, rate: float = 25, chat_interval: float = 1.0, concurrency: int = 10,
+                 chunk_size: int = 100, progress_interval: float = 5, max_retries: int = 3):
+        self.db = db
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(chat_interval)
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    @property
+    def running(self) -> List[int]:
+        return list(self._tasks)
+
+    async def start(self, bot: Bot, audience: str, admin_chat_id: int, from_chat_id: Optional[int] = None,
+                    message_id: Optional[int] = None, text: Optional[str] = None) -> int:
+        """Запускает рассылку: копию сообщения message_id или текст text (HTML)"""
+        progress = await bot.send_message(admin_chat_id, "📤 Рассылка запускается...")
+        broadcast_id = await self.db.create_broadcast(
+            audience, admin_chat_id, from_chat_id, message_id, text, progress.message_id
+        )
+        self._spawn(bot, broadcast_id)
+        logger.info(f"Broadcast {broadcast_id} started for audience '{audience}'")
+        return broadcast_id
+
+    async def resume(self, bot: Bot) -> int:
+        """Продолжает рассылки, прерванные остановкой бота, с последней контрольной точки"""
+        broadcasts = await self.db.get_unfinished_broadcasts()
+        for broadcast in broadcasts:
+            if broadcast['id'] not in self._tasks:
+                logger.info(f"Resuming broadcast {broadcast['id']} after user {broadcast['last_user_id']}")
+                self._spawn(bot, broadcast['id'])
+        return len(broadcasts)
+
+    async def stop(self):
+        # Статус остаётся running - при следующем запуске рассылка продолжится
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def _spawn(self, bot: Bot, broadcast_id: int):
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _run(self, bot: Bot, broadcast_id: int):
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        if broadcast is None:
+            return
+        sent, failed, total = broadcast['sent'], broadcast['failed'], broadcast['total']
+        try:
+            last_user_id = broadcast['last_user_id']
+            total = sent + failed + await self.db.count_recipients(broadcast['audience'], last_user_id)
+            reported_at = 0.0
+            async for chunk in self.db.iter_recipients(broadcast['audience'], last_user_id, self.chunk_size):
+                results = await asyncio.gather(*(self._deliver(bot, broadcast, user_id) for user_id in chunk))
+                delivered = sum(results)
+                sent += delivered
+                failed += len(chunk) - delivered
+                last_user_id = chunk[-1]
+                # Новые пользователи во время рассылки тоже попадают в выборку
+                total = max(total, sent + failed)
+                # Чанк обработан целиком - можно сдвинуть контрольную точку
+                await self.db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, total)
+                if time.monotonic() - reported_at >= self.progress_interval:
+                    reported_at = time.monotonic()
+                    await self._report(bot, broadcast, progress_text(broadcast, sent, failed, total))
+            total = sent + failed
+            await self.db.save_broadcast_progress(broadcast_id, last_user_id, sent, failed, total)
+            await self.db.finish_broadcast(broadcast_id, "done")
+            await self._report(bot, broadcast, progress_text(broadcast, sent, failed, total, "done"))
+            logger.info(f"Broadcast {broadcast_id} done: sent {sent}, failed {failed}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {broadcast_id} failed: {e}")
+            await self.db.finish_broadcast(broadcast_id, "failed")
+            await self._report(bot, broadcast, progress_text(broadcast, sent, failed, max(total, sent + failed), "failed"))
+
+    async def _deliver(self, bot: Bot, broadcast: Dict, user_id: int) -> bool:
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                await self.chats.wait(user_id)
+                try:
+                    if broadcast['text'] is not None:
+                        await bot.send_message(
+                            user_id, broadcast['text'], parse_mode="HTML", disable_web_page_preview=True
+                        )
+                    else:
+                        await bot.copy_message(
+                            chat_id=user_id,
+                            from_chat_id=broadcast['from_chat_id'],
+                            message_id=broadcast['message_id']
+                        )
+                    return True
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Broadcast {broadcast['id']}: flood limit, retry after {e.retry_after}s")
+                    self.bucket.pause(e.retry_after)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    # Бот заблокирован или чат недоступен - повтор не поможет
+                    logger.info(f"Broadcast {broadcast['id']}: skip {user_id}: {e}")
+                    return False
+                except Exception as e:
+                    logger.warning(f"Failed to send broadcast to {user_id}: {e}")
+                    return False
+            return False
+
+    async def _report(self, bot: Bot, broadcast: Dict, text: str):
+        if not broadcast['progress_message_id']:
+            return
+        try:
+            await self.bucket.acquire()
+            await bot.edit_message_text(
+                text,
+                chat_id=broadcast['admin_chat_id'],
+                message_id=broadcast['progress_message_id'],
+                parse_mode="HTML"
+            )
+        except TelegramRetryAfter as e:
+            self.bucket.pause(e.retry_after)
+        except Exception as e:
+            logger.debug(f"Broadcast {broadcast['id']} progress update skipped: {e}")
+
+
+broadcast_engine = BroadcastEngine(
+    Database(config.DATABASE_URL),
+    rate=config.BROADCAST_RATE,
+    chat_interval=config.BROADCAST_CHAT_INTERVAL,
+    concurrency=config.BROADCAST_CONCURRENCY,
+    chunk_size=config.BROADCAST_CHUNK_SIZE,
+    progress_interval=config.BROADCAST_PROGRESS_INTERVAL,
+    max_retries=config.BROADCAST_MAX_RETRIES,
+)
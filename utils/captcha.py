@@ -1,9 +1,28 @@
+import asyncio
+import logging
+import multiprocessing
 import random
 import string
 import io
-from typing import Tuple
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Deque, Optional, Tuple
 from captcha.image import ImageCaptcha
 
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+def render_captcha(length: int = 5) -> Tuple[bytes, str]:
+    """PNG капчи и ответ; функция уровня модуля, чтобы её можно было выполнить в другом процессе"""
+    text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+    image = ImageCaptcha(width=200, height=80, fonts=['arial.ttf'])
+    return image.generate(text).getvalue(), text
+
+
 class CaptchaGenerator:
 
 
@@ -11,14 +30,184 @@ class CaptchaGenerator:
     @staticmethod
     def generate_image_captcha() -> Tuple[io.BytesIO, str]:
         """Генерация капчи с картинкой"""
-        text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=5))
-        
-        image = ImageCaptcha(width=200, height=80, fonts=['arial.ttf'])
-        
-        data = image.generate(text)
-        
-        image_buffer = io.BytesIO()
-        image_buffer.write(data.read())
+        data, text = render_captcha()
+
+        image_buffer = io.BytesIO(data)
         image_buffer.seek(0)
-        
+
         return image_buffer, text
+
+
+class CaptchaPool:
+    """Кольцо заранее отрисованных капч; отрисовка идёт в пуле процессов, вне event loop"""
+
+    def __init__(self, size: int = 32, workers: int = 2):
+        self.size = size
+        self.workers = workers
+        self.served = 0
+        self.misses = 0
+        self._ring: Deque[Tuple[bytes, str]] = deque(maxlen=size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wanted = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._ring)
+
+    async def _render(self) -> Tuple[bytes, str]:
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            # Пул не запущен (скрипты, отладка) - хотя бы не блокируем loop
+            return await asyncio.to_thread(render_captcha)
+        return await loop.run_in_executor(self._executor, render_captcha)
+
+    async def get(self) -> Tuple[bytes, str]:
+        self._wanted.set()
+        if self._ring:
+            self.served += 1
+            return self._ring.popleft()
+        self.misses += 1
+        return await self._render()
+
+    async def _refill(self):
+        while True:
+            while len(self._ring) < self.size:
+                batch = min(self.workers, self.size - len(self._ring))
+                try:
+                    rendered = await asyncio.gather(*(self._render() for _ in range(batch)))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Captcha rendering failed: {e}")
+                    await asyncio.sleep(5)
+                    continue
+                self._ring.extend(rendered)
+            self._wanted.clear()
+            await self._wanted.wait()
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        # spawn: форк процесса с потоками aiosqlite и открытыми сокетами небезопасен
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._task = asyncio.create_task(self._refill())
+        logger.info(f"Captcha pool started ({self.size} slots, {self.workers} workers)")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class CaptchaSession:
+    __slots__ = ("answer", "attempts", "expires_at")
+
+    def __init__(self, answer: str, attempts: int, expires_at: float):
+        self.answer = answer
+        self.attempts = attempts
+        self.expires_at = expires_at
+
+
+class CaptchaSessionStore:
+    """Сессии капчи в памяти с TTL; в БД попадают только при остановке бота (если включено)"""
+
+    def __init__(self, ttl: float = 600, max_sessions: int = 100000):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # Порядок вставки совпадает с порядком истечения: TTL у всех одинаковый
+        self._sessions: "OrderedDict[int, CaptchaSession]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        purged = 0
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.expires_at > now:
+                break
+            del self._sessions[user_id]
+            purged += 1
+        return purged
+
+    def _put(self, user_id: int, session: CaptchaSession):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def create(self, user_id: int, answer: str) -> CaptchaSession:
+        self.purge_expired()
+        session = CaptchaSession(answer, 0, time.time() + self.ttl)
+        self._put(user_id, session)
+        return session
+
+    def get(self, user_id: int) -> Optional[CaptchaSession]:
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if session.expires_at <= time.time():
+            del self._sessions[user_id]
+            return None
+        return session
+
+    def increment(self, user_id: int) -> Optional[int]:
+        session = self.get(user_id)
+        if session is None:
+            return None
+        session.attempts += 1
+        return session.attempts
+
+    def rotate(self, user_id: int, answer: str) -> Optional[CaptchaSession]:
+        # Новая картинка - новый ответ и новый срок, счётчик попыток сохраняется
+        session = self.get(user_id)
+        if session is None:
+            return None
+        session.answer = answer
+        session.expires_at = time.time() + self.ttl
+        self._put(user_id, session)
+        return session
+
+    def delete(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+    async def spill(self, db) -> int:
+        """Сбрасывает живые сессии в captcha_sessions, чтобы пережить перезапуск"""
+        self.purge_expired()
+        rows = [
+            (
+                user_id, session.answer, session.attempts,
+                datetime.fromtimestamp(session.expires_at - self.ttl, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            )
+            for user_id, session in self._sessions.items()
+        ]
+        if rows:
+            await db.save_captcha_sessions(rows)
+        return len(rows)
+
+    async def restore(self, db, shard: Optional[int] = None, shards: int = 1) -> int:
+        restored = 0
+        for row in await db.take_captcha_sessions(self.ttl, shard, shards):
+            created_at = datetime.strptime(row['created_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+            expires_at = created_at.timestamp() + self.ttl
+            if expires_at > time.time():
+                self._put(row['user_id'], CaptchaSession(row['answer'], row['attempts'] or 0, expires_at))
+                restored += 1
+        # После загрузки из БД порядок может не совпадать со сроками
+        self._sessions = OrderedDict(sorted(self._sessions.items(), key=lambda item: item[1].expires_at))
+        return restored
+
+
+captcha_sessions = CaptchaSessionStore(ttl=config.CAPTCHA_SESSION_TTL)
+
+captcha_pool = CaptchaPool(size=config.CAPTCHA_POOL_SIZE, workers=config.CAPTCHA_POOL_WORKERS)
@@ -1,33 +1,264 @@
-from asyncio.log import logger
-import datetime
-from typing import Dict
+import asyncio
+import logging
+import statistics
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
 
 import aiohttp
 
+from config import config
+from database.models import Database
 
-@classmethod
-async def get_crypto_rates(cls) -> Dict[str, float]:
-    # Оставляем только BTC
-    try:
-        async with aiohttp.ClientSession() as session:
-            url = "https://api.coingecko.com/api/v3/simple/price"
-            params = {
-                'ids': 'bitcoin',
-                'vs_currencies': 'rub'
-            }
-            
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    cls._rates_cache = {
-                        'BTC': data.get('bitcoin', {}).get('rub', 2800000)
-                    }
-                    cls._cache_time = datetime.now()
-                    
-                    return cls._rates_cache
-    
-    except Exception as e:
-        logger.error(f"Error fetching crypto rates: {e}")
-    
-    return {'BTC': 2800000.0}
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+
+class RateSource:
+    """Один источник курса: URL, разбор ответа и статистика опросов"""
+
+    def __init__(self, name: str, url: str, parse: Callable[[Any], Any]):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.last_rate: Optional[float] = None
+        self.last_ok_at: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.errors = 0
+        self.last_error: Optional[str] = None
+
+    async def fetch(self, session: aiohttp.ClientSession, timeout: float) -> Optional[float]:
+        started = time.monotonic()
+        try:
+            async with session.get(self.url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status != 200:
+                    raise ValueError(f"HTTP {response.status}")
+                rate = float(self.parse(await response.json(content_type=None)))
+                if rate <= 0:
+                    raise ValueError(f"bad rate {rate}")
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e) or type(e).__name__
+            logger.warning(f"Rate source {self.name} failed: {self.last_error}")
+            return None
+        finally:
+            self.latency = time.monotonic() - started
+        self.last_rate = rate
+        self.last_ok_at = time.monotonic()
+        return rate
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'rate': self.last_rate,
+            'latency': self.latency,
+            'staleness': time.monotonic() - self.last_ok_at if self.last_ok_at is not None else None,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+# Разбор ответов поддерживаемых источников курса BTC/RUB
+SOURCE_PARSERS: Dict[str, Callable[[Any], Any]] = {
+    'coingecko': lambda data: data['bitcoin']['rub'],
+    'blockchain': lambda data: data['RUB']['last'],
+    'cryptocompare': lambda data: data['RUB'],
+    'binance': lambda data: data['price'],
+}
+
+
+def default_sources() -> List[RateSource]:
+    urls = {
+        'coingecko': config.RATE_COINGECKO_URL,
+        'blockchain': config.RATE_BLOCKCHAIN_URL,
+        'cryptocompare': config.RATE_CRYPTOCOMPARE_URL,
+        'binance': config.RATE_BINANCE_URL,
+    }
+    return [
+        RateSource(name, urls[name], SOURCE_PARSERS[name])
+        for name in config.RATE_SOURCES if name in SOURCE_PARSERS and urls.get(name)
+    ]
+
+
+def robust_median(values: List[float], outlier_pct: float) -> Tuple[Optional[float], List[float], List[float]]:
+    """Медиана после отбрасывания значений дальше outlier_pct % от исходной медианы"""
+    if not values:
+        return None, [], []
+    center = statistics.median(values)
+    kept = [value for value in values if abs(value - center) / center * 100 <= outlier_pct]
+    rejected = [value for value in values if value not in kept]
+    return (statistics.median(kept) if kept else None), kept, rejected
+
+
+class RateAggregator:
+    """Опрашивает все источники параллельно и сводит их в один курс"""
+
+    def __init__(self, sources: List[RateSource], timeout: float = 5, outlier_pct: float = 3.0,
+                 min_sources: int = 2):
+        self.sources = sources
+        self.timeout = timeout
+        self.outlier_pct = outlier_pct
+        # Нужно столько согласных между собой источников; иначе курс не обновляется
+        self.min_sources = min(min_sources, len(sources)) if sources else min_sources
+        self.last_rejected: List[str] = []
+
+    async def __call__(self, session: aiohttp.ClientSession) -> Optional[float]:
+        rates = await asyncio.gather(*(source.fetch(session, self.timeout) for source in self.sources))
+        quotes = {source.name: rate for source, rate in zip(self.sources, rates) if rate is not None}
+        median, kept, rejected = robust_median(list(quotes.values()), self.outlier_pct)
+        self.last_rejected = [name for name, rate in quotes.items() if rate in rejected]
+        if self.last_rejected:
+            logger.warning(f"Rate outliers rejected: {', '.join(self.last_rejected)} (median {median})")
+        if median is None or len(kept) < self.min_sources:
+            logger.error(f"Rate quorum not reached: {len(kept)} of {self.min_sources} sources agree ({quotes})")
+            return None
+        return median
+
+    def stats(self) -> List[Dict[str, Any]]:
+        rows = [source.stats() for source in self.sources]
+        for row in rows:
+            row['rejected'] = row['name'] in self.last_rejected
+        return rows
+
+
+class RateService:
+    """Курс BTC/RUB в памяти: фоновое обновление, один запрос на все промахи, stale-while-revalidate"""
+
+    def __init__(self, fetch: Callable[[aiohttp.ClientSession], Awaitable[Optional[float]]],
+                 refresh_interval: float = 30, max_age: float = 300, timeout: float = 10):
+        self._fetch = fetch
+        self.refresh_interval = refresh_interval
+        # Старше max_age курс не отдаётся: лучше отказ, чем неверная цена
+        self.max_age = max_age
+        self.timeout = timeout
+        self.rate: Optional[float] = None
+        self.updated_at: Optional[float] = None
+        self.refreshes = 0
+        self.failures = 0
+        self._inflight: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def age(self) -> Optional[float]:
+        if self.updated_at is None:
+            return None
+        return time.monotonic() - self.updated_at
+
+    def peek(self) -> Optional[float]:
+        """Курс из памяти без ожидания сети; None, если его нет или он старше max_age"""
+        age = self.age
+        if age is None or age > self.max_age:
+            return None
+        return self.rate
+
+    async def get_rate(self) -> Optional[float]:
+        rate = self.peek()
+        if rate is not None:
+            if self.age >= self.refresh_interval:
+                self._refresh_in_background()
+            return rate
+        return await self.refresh()
+
+    async def refresh(self) -> Optional[float]:
+        # Все одновременные промахи ждут один и тот же запрос к источнику
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._refresh_once())
+        await asyncio.shield(self._inflight)
+        return self.peek()
+
+    def _refresh_in_background(self):
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._refresh_once())
+
+    async def _refresh_once(self):
+        try:
+            rate = await self._fetch(await self._get_session())
+        except Exception as e:
+            rate = None
+            logger.error(f"Error fetching BTC rate: {e}")
+        if rate and rate > 0:
+            self.rate = rate
+            self.updated_at = time.monotonic()
+            self.refreshes += 1
+        else:
+            self.failures += 1
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Rate refresh loop error: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Rate service started (interval {self.refresh_interval}s, max age {self.max_age}s)")
+
+    async def stop(self):
+        for task in (self._task, self._inflight):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._inflight = None
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class SharedRate:
+    """Курс через таблицу cluster_state: лидер кластера публикует, остальные воркеры только читают"""
+
+    KEY = "btc_rate"
+
+    def __init__(self, db: Database, max_age: float = 300):
+        self.db = db
+        self.max_age = max_age
+
+    def publishing(self, fetch: Callable[[aiohttp.ClientSession], Awaitable[Optional[float]]]):
+        async def fetch_and_publish(session: aiohttp.ClientSession) -> Optional[float]:
+            rate = await fetch(session)
+            if rate:
+                await self.db.set_cluster_value(self.KEY, rate)
+            return rate
+        return fetch_and_publish
+
+    async def read(self, session: aiohttp.ClientSession = None) -> Optional[float]:
+        row = await self.db.get_cluster_value(self.KEY)
+        if row is None or time.time() - row['updated_at'] > self.max_age:
+            return None
+        return float(row['value'])
+
+
+rate_aggregator = RateAggregator(
+    default_sources(),
+    timeout=config.RATE_SOURCE_TIMEOUT,
+    outlier_pct=config.RATE_OUTLIER_PCT,
+    min_sources=config.RATE_MIN_SOURCES,
+)
+
+shared_rate = SharedRate(Database(config.DATABASE_URL), max_age=config.RATE_MAX_AGE)
+
+if config.WORKER_COUNT > 1:
+    # Источники опрашивает только лидер; иначе каждый воркер умножал бы запросы к API курсов
+    rate_fetch = shared_rate.publishing(rate_aggregator) if config.IS_LEADER else shared_rate.read
+else:
+    rate_fetch = rate_aggregator
+
+rate_service = RateService(
+    rate_fetch,
+    refresh_interval=config.RATE_REFRESH_INTERVAL,
+    max_age=config.RATE_MAX_AGE,
+    timeout=config.RATE_FETCH_TIMEOUT,
+)
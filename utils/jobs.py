@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Set, Tuple
+
+from aiogram import Bot
+
+from config import config
+from database.models import Database
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentJobError(Exception):
+    """Повтор не поможет - задача сразу уходит в dead-letter"""
+
+
+class JobKind(NamedTuple):
+    # handler(bot, payload, job); исключение - попытка не удалась
+    handler: Callable[[Bot, Dict[str, Any], Dict[str, Any]], Awaitable[None]]
+    # on_dead(bot, payload, error) - все попытки исчерпаны
+    on_dead: Optional[Callable[[Bot, Dict[str, Any], str], Awaitable[None]]]
+    retry_base: float
+    # on_requeue(payload) -> новый payload или None, если задачу повторять уже незачем
+    on_requeue: Optional[Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]] = None
+
+
+class JobQueue:
+    """Задачи в таблице jobs: аренда, ограниченный параллелизм, повторы с backoff и dead-letter"""
+
+    def __init__(self, db: Database, workers: int = 4, poll_interval: float = 2, lease: float = 120,
+                 retry_base: float = 10, retry_max: float = 300):
+        self.db = db
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._kinds: Dict[str, JobKind] = {}
+        self._running: Set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler, on_dead=None, retry_base: Optional[float] = None, on_requeue=None):
+        self._kinds[kind] = JobKind(handler, on_dead, retry_base or self.retry_base, on_requeue)
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any], max_attempts: int = 5, delay: float = 0,
+                      dedup_key: Optional[str] = None) -> Tuple[int, bool]:
+        """(id задачи, создана ли новая); с dedup_key повторная постановка вернёт незавершённую задачу"""
+        job_id, created = await self.db.enqueue_job(kind, payload, max_attempts, delay, dedup_key)
+        if created:
+            # Свободный исполнитель в этом процессе возьмёт задачу сразу, не дожидаясь опроса
+            self._wakeup.set()
+        return job_id, created
+
+    async def requeue_dead(self) -> Tuple[int, int]:
+        """Возвращает dead-задачи в очередь: (возвращено, пропущено)"""
+        requeued = skipped = 0
+        for job in await self.db.get_jobs('dead', -1):
+            kind = self._kinds.get(job['kind'])
+            payload = json.loads(job['payload'])
+            if kind is not None and kind.on_requeue is not None:
+                payload = await kind.on_requeue(payload)
+            if payload is not None and await self.db.requeue_dead_job(job['id'], payload):
+                requeued += 1
+            else:
+                skipped += 1
+        if requeued:
+            self._wakeup.set()
+        return requeued, skipped
+
+    def backoff(self, kind: str, attempts: int) -> float:
+        # Экспоненциальная задержка со случайной половиной: повторы разных задач не идут залпом
+        delay = min(self.retry_max, self._kinds[kind].retry_base * 2 ** max(0, attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def _run(self, bot: Bot):
+        while True:
+            # Будят новая задача в этом процессе и освободившийся исполнитель; иначе - опрос БД
+            self._wakeup.clear()
+            try:
+                free = self.workers - len(self._running)
+                jobs = await self.db.claim_jobs(list(self._kinds), free, self.lease) if free > 0 else []
+                for job in jobs:
+                    task = asyncio.create_task(self._execute(bot, job))
+                    self._running.add(task)
+                    task.add_done_callback(self._job_done)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Job queue loop error: {e}")
+            await self._wait()
+
+    async def _wait(self):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    def _job_done(self, task: asyncio.Task):
+        self._running.discard(task)
+        self._wakeup.set()
+
+    async def renew(self, job: Dict[str, Any]) -> bool:
+        """Продлевает аренду задачи; False - её перехватил другой исполнитель и побочные эффекты делать нельзя"""
+        return await self.db.renew_job(job['id'], job['attempts'], time.time() + self.lease)
+
+    async def _heartbeat(self, job: Dict[str, Any]):
+        # Аренда продлевается, пока обработчик работает: долгая задача не уйдёт второму исполнителю
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await self.renew(job):
+                    logger.warning(f"Job {job['id']} ({job['kind']}) lost its lease")
+                    return
+            except Exception as e:
+                logger.error(f"Job {job['id']} lease renewal failed: {e}")
+
+    async def _execute(self, bot: Bot, job: Dict[str, Any]):
+        kind = self._kinds[job['kind']]
+        payload = json.loads(job['payload'])
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            await kind.handler(bot, payload, job)
+        except asyncio.CancelledError:
+            # Остановка бота - не неудача: задача вернётся в очередь без траты попытки
+            await self.db.release_job(job['id'], job['attempts'])
+            raise
+        except Exception as e:
+            error = f"{e.__class__.__name__}: {e}"
+            if isinstance(e, PermanentJobError) or job['attempts'] >= job['max_attempts']:
+                logger.error(f"Job {job['id']} ({job['kind']}) dead after {job['attempts']} attempts: {error}")
+                if await self.db.bury_job(job['id'], job['attempts'], error) and kind.on_dead is not None:
+                    try:
+                        await kind.on_dead(bot, payload, error)
+                    except Exception as dead_error:
+                        logger.error(f"Job {job['id']} dead handler failed: {dead_error}")
+            else:
+                delay = self.backoff(job['kind'], job['attempts'])
+                logger.warning(f"Job {job['id']} ({job['kind']}) attempt {job['attempts']} failed, "
+                               f"retry in {delay:.0f}s: {error}")
+                await self.db.retry_job(job['id'], job['attempts'], time.time() + delay, error)
+        else:
+            if not await self.db.finish_job(job['id'], job['attempts']):
+                logger.warning(f"Job {job['id']} finished after its lease was taken over")
+        finally:
+            heartbeat.cancel()
+
+    def start(self, bot: Bot):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+            logger.info(f"Job queue started ({self.workers} workers, kinds: {', '.join(self._kinds)})")
+
+    async def stop(self, timeout: float = 10):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Текущим задачам даём доработать; прерванные вернутся в очередь
+        if self._running:
+            _, pending = await asyncio.wait(set(self._running), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+job_queue = JobQueue(
+    Database(config.DATABASE_URL),
+    workers=config.JOB_WORKERS,
+    poll_interval=config.JOB_POLL_INTERVAL,
+    lease=config.JOB_LEASE,
+    retry_max=config.JOB_RETRY_MAX,
+)
@@ -0,0 +1,110 @@
+import logging
+import time
+import uuid
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional, Tuple
+
+from utils.bitcoin import BitcoinAPI
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Quote:
+    """Зафиксированная котировка: курс, комиссия и итоги не меняются до expires_at"""
+    id: str
+    user_id: int
+    direction: str
+    rate: float
+    commission_percentage: float
+    amount_rub: float
+    amount_btc: float
+    total_amount: float
+    expires_at: float
+
+    @property
+    def expired(self) -> bool:
+        return time.time() >= self.expires_at
+
+    @property
+    def seconds_left(self) -> int:
+        return max(0, int(self.expires_at - time.time()))
+
+    def as_row(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "Quote":
+        return cls(**{field: row[field] for field in cls.__dataclass_fields__})
+
+
+def price(direction: str, amount: float, rate: float, commission_percentage: float) -> Tuple[float, float, float]:
+    """(сумма в рублях, сумма в BTC, итого с комиссией) для введённой пользователем суммы"""
+    if direction == "rub_to_crypto":
+        amount_rub = amount
+        amount_btc = BitcoinAPI.calculate_btc_amount(amount_rub, rate)
+    else:
+        amount_btc = amount
+        amount_rub = amount_btc * rate
+    total_amount = amount_rub / (1 - commission_percentage / 100)
+    return amount_rub, amount_btc, total_amount
+
+
+class QuoteService:
+    """Выдаёт котировки с TTL и переоценивает просроченные без лишних запросов"""
+
+    def __init__(self, db, ttl: float = 300):
+        self.db = db
+        self.ttl = ttl
+
+    async def issue(self, user_id: int, direction: str, amount: float) -> Optional[Quote]:
+        # Курс и комиссия читаются из памяти (RateService и кэш настроек)
+        rate = await BitcoinAPI.get_btc_rate()
+        if not rate:
+            return None
+        commission_percentage = float(await self.db.get_commission_percentage())
+        amount_rub, amount_btc, total_amount = price(direction, amount, rate, commission_percentage)
+        quote = Quote(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            direction=direction,
+            rate=rate,
+            commission_percentage=commission_percentage,
+            amount_rub=amount_rub,
+            amount_btc=amount_btc,
+            total_amount=total_amount,
+            expires_at=time.time() + self.ttl,
+        )
+        await self.db.create_quote(**quote.as_row())
+        return quote
+
+    async def get(self, quote_id: Optional[str], user_id: int) -> Optional[Quote]:
+        if not quote_id:
+            return None
+        row = await self.db.get_quote(quote_id)
+        if not row or row['user_id'] != user_id:
+            return None
+        return Quote.from_row(row)
+
+    async def requote(self, quote: Quote) -> Optional[Quote]:
+        # Пользователь вводил рубли или BTC - переоцениваем от той же величины
+        amount = quote.amount_rub if quote.direction == "rub_to_crypto" else quote.amount_btc
+        fresh = await self.issue(quote.user_id, quote.direction, amount)
+        if fresh:
+            logger.info(f"Quote {quote.id} expired, requoted as {fresh.id}: {quote.rate:,.0f} -> {fresh.rate:,.0f}")
+        return fresh
+
+    async def ensure_fresh(self, quote_id: Optional[str], user_id: int) -> Tuple[Optional[Quote], bool]:
+        """(действующая котировка, была ли переоценка); None, если котировки нет или курс недоступен"""
+        quote = await self.get(quote_id, user_id)
+        if quote is None:
+            return None, False
+        if not quote.expired:
+            return quote, False
+        return await self.requote(quote), True
+
+
+def quote_ttl_text(quote: Quote) -> str:
+    minutes, seconds = divmod(quote.seconds_left, 60)
+    return f"⏳ Курс зафиксирован на {minutes}:{seconds:02d}"
+
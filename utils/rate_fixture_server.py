@@ -0,0 +1,84 @@
+"""Локальная подмена источников курса для разработки и проверок.
+
+Запуск: python -m utils.rate_fixture_server --port 8765 --rate 6500000
+Затем направить бота на фикстуры через RATE_*_URL (скрипт печатает готовые строки для .env).
+Курс и выбросы меняются на лету: POST /fixture {"rate": 6400000, "outliers": {"binance": 9000000}, "delay": 0.5}
+"""
+import argparse
+import asyncio
+
+from aiohttp import web
+
+
+class RateFixture:
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.outliers = {}
+        self.down = set()
+        self.delay = 0.0
+        # Число запросов к каждому источнику - для проверок single-flight
+        self.hits = {}
+
+    def rate_for(self, source: str) -> float:
+        return self.outliers.get(source, self.rate)
+
+    async def respond(self, source: str, payload) -> web.Response:
+        self.hits[source] = self.hits.get(source, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if source in self.down:
+            return web.json_response({"error": "fixture: source down"}, status=503)
+        return web.json_response(payload)
+
+    async def coingecko(self, request: web.Request) -> web.Response:
+        return await self.respond("coingecko", {"bitcoin": {"rub": self.rate_for("coingecko")}})
+
+    async def blockchain(self, request: web.Request) -> web.Response:
+        rate = self.rate_for("blockchain")
+        return await self.respond("blockchain", {"RUB": {"15m": rate, "last": rate, "buy": rate, "sell": rate, "symbol": "RUB"}})
+
+    async def cryptocompare(self, request: web.Request) -> web.Response:
+        return await self.respond("cryptocompare", {"RUB": self.rate_for("cryptocompare")})
+
+    async def binance(self, request: web.Request) -> web.Response:
+        return await self.respond("binance", {"symbol": "BTCRUB", "price": f"{self.rate_for('binance'):.2f}"})
+
+    async def update(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        self.rate = float(data.get("rate", self.rate))
+        self.outliers = {name: float(value) for name, value in data.get("outliers", self.outliers).items()}
+        self.down = set(data.get("down", self.down))
+        self.delay = float(data.get("delay", self.delay))
+        return web.json_response({
+            "rate": self.rate, "outliers": self.outliers, "down": sorted(self.down), "delay": self.delay
+        })
+
+
+def create_fixture_app(rate: float) -> web.Application:
+    fixture = RateFixture(rate)
+    app = web.Application()
+    app["fixture"] = fixture
+    app.router.add_get("/coingecko", fixture.coingecko)
+    app.router.add_get("/blockchain", fixture.blockchain)
+    app.router.add_get("/cryptocompare", fixture.cryptocompare)
+    app.router.add_get("/binance", fixture.binance)
+    app.router.add_post("/fixture", fixture.update)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fixture server for BTC/RUB rate sources")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=6500000.0)
+    args = parser.parse_args()
+
+    base = f"http://{args.host}:{args.port}"
+    for name in ("coingecko", "blockchain", "cryptocompare", "binance"):
+        print(f"RATE_{name.upper()}_URL={base}/{name}")
+    web.run_app(create_fixture_app(args.rate), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import Bot
+
+logger = logging.getLogger(__name__)
+
+# Колонка с id заявки у провайдера
+PROVIDER_COLUMNS = {
+    'OnlyPays': 'onlypays_id',
+    'PSPWare': 'pspware_id',
+    'Greengo': 'greengo_id',
+}
+
+TERMINAL_STATUSES = {'finished', 'cancelled'}
+
+
+def normalize_status(status: Optional[str]) -> Optional[str]:
+    if status == 'canceled':
+        return 'cancelled'
+    return status
+
+
+def order_provider(order: Dict[str, Any]):
+    """(провайдер, id у провайдера) заявки; (None, None), если заявка ещё не ушла провайдеру"""
+    for api_name, column in PROVIDER_COLUMNS.items():
+        if order.get(column):
+            return api_name, str(order[column])
+    return None, None
+
+
+def greengo_statuses(response: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Ответ check_order по списку id -> {id: данные заявки}"""
+    data = response.get('data')
+    items = data if isinstance(data, list) else [data] if isinstance(data, dict) else []
+    statuses = {}
+    for item in items:
+        order_id = item.get('order_id') or item.get('id')
+        if order_id is not None:
+            statuses[str(order_id)] = item
+    return statuses
+
+
+class TrackedOrder:
+    __slots__ = ("order", "api_name", "provider_id", "next_at", "interval", "checks")
+
+    def __init__(self, order: Dict[str, Any], api_name: str, provider_id: str, interval: float):
+        self.order = order
+        self.api_name = api_name
+        self.provider_id = provider_id
+        self.interval = interval
+        self.next_at = time.monotonic()
+        self.checks = 0
+
+
+class OrderReconciler:
+    """Фоновая сверка ожидающих оплаты заявок с провайдерами пачками и с растущим интервалом"""
+
+    def __init__(self, db, manager, apply: Callable[[Bot, Dict[str, Any], str, Dict[str, Any]], Awaitable[None]],
+                 tick: float = 5, min_interval: float = 15, max_interval: float = 120,
+                 batch_size: int = 20, max_age: float = 86400):
+        self.db = db
+        self.manager = manager
+        # apply(bot, order, api_name, status_data) - переход заявки по статусу провайдера
+        self.apply = apply
+        self.tick = tick
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.polls = 0
+        self.applied = 0
+        self._tracked: Dict[int, TrackedOrder] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def tracked(self) -> int:
+        return len(self._tracked)
+
+    async def sync(self):
+        """Сверяет набор отслеживаемых заявок с БД: новые добавляет, ушедшие из waiting убирает"""
+        waiting = {order['id']: order for order in await self.db.get_waiting_orders(self.max_age)}
+        for order_id in list(self._tracked):
+            if order_id not in waiting:
+                del self._tracked[order_id]
+        for order_id, order in waiting.items():
+            if order_id in self._tracked:
+                continue
+            api_name, provider_id = order_provider(order)
+            if api_name is not None:
+                self._tracked[order_id] = TrackedOrder(order, api_name, provider_id, self.min_interval)
+
+    async def run_once(self, bot: Bot):
+        await self.sync()
+        now = time.monotonic()
+        due: Dict[str, List[TrackedOrder]] = {}
+        for tracked in self._tracked.values():
+            if tracked.next_at <= now:
+                due.setdefault(tracked.api_name, []).append(tracked)
+        for api_name, orders in due.items():
+            for start in range(0, len(orders), self.batch_size):
+                await self._poll_batch(bot, api_name, orders[start:start + self.batch_size])
+
+    async def _poll_batch(self, bot: Bot, api_name: str, batch: List[TrackedOrder]):
+        self.polls += 1
+        if api_name == 'Greengo':
+            # check_order принимает список id - одна заявка к провайдеру на всю пачку
+            response = await self.manager.get_order_statuses([t.provider_id for t in batch], api_name)
+            statuses = greengo_statuses(response) if response.get('success') else {}
+            results = [statuses.get(t.provider_id) for t in batch]
+        else:
+            responses = await asyncio.gather(
+                *(self.manager.get_order_status(t.provider_id, api_name) for t in batch)
+            )
+            results = [response.get('data') if response.get('success') else None for response in responses]
+
+        for tracked, status_data in zip(batch, results):
+            status = normalize_status((status_data or {}).get('status'))
+            if status in TERMINAL_STATUSES:
+                self._tracked.pop(tracked.order['id'], None)
+                try:
+                    await self.apply(bot, tracked.order, api_name, dict(status_data, status=status))
+                    self.applied += 1
+                except Exception as e:
+                    logger.error(f"Reconcile apply failed for order {tracked.order['id']}: {e}")
+                continue
+            # Статус не изменился (или провайдер не ответил) - проверяем реже
+            tracked.checks += 1
+            tracked.next_at = time.monotonic() + tracked.interval
+            tracked.interval = min(self.max_interval, tracked.interval * 2)
+
+    async def _run(self, bot: Bot):
+        while True:
+            try:
+                await self.run_once(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Order reconcile loop error: {e}")
+            await asyncio.sleep(self.tick)
+
+    def start(self, bot: Bot):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+            logger.info(f"Order reconciler started (tick {self.tick}s, interval {self.min_interval}-{self.max_interval}s)")
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
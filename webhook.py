@@ -1,39 +1,326 @@
 # webhook.py
+"""Приём callback-ов платёжных провайдеров: POST /{provider}/notification.
+
+Callback принимается только от провайдера, для которого настроена проверка: общий токен
+(?token=PAYMENT_WEBHOOK_TOKEN) и/или подпись провайдера. Без проверок маршрут не регистрируется.
+
+Запрос только разбирается и кладётся в ограниченную очередь - провайдер получает ответ
+за миллисекунды. Обновление заявки и уведомления в Telegram выполняет пул воркеров,
+поэтому медленная отправка сообщений не вызывает повторных доставок от провайдера.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
 import logging
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
 from aiohttp import web
+from aiogram import Bot
+
 from database.models import Database
 from config import config
+from utils.reconciler import PROVIDER_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Поля callback-а каждого провайдера в порядке приоритета
+PROVIDER_FIELDS: Dict[str, Dict[str, tuple]] = {
+    'onlypays': {'id': ('id',), 'personal_id': ('personal_id',), 'received_sum': ('received_sum',)},
+    'pspware': {'id': ('id',), 'personal_id': ('personal_id', 'order_id'), 'received_sum': ('received_sum', 'sum')},
+    'greengo': {'id': ('order_id', 'id'), 'personal_id': ('personal_id',), 'received_sum': ('received_sum', 'from_amount')},
+    'nicepay': {'id': ('paymentId', 'id'), 'personal_id': ('merchantOrderId',), 'received_sum': ('amount',)},
+}
+
+# Колонка orders с id заявки у провайдера - если callback не несёт наш id
+PROVIDER_ID_COLUMNS = {api_name.lower(): column for api_name, column in PROVIDER_COLUMNS.items()}
+
+
+def order_owned_by(provider: str, order: Dict[str, Any], data: Dict[str, Any]) -> bool:
+    """Заявка ушла этому провайдеру, и callback о том же заказе у него"""
+    if provider == 'nicepay':
+        # У NicePay в заявке хранится наш merchantOrderId
+        column, field = 'nicepay_id', 'personal_id'
+    else:
+        column, field = PROVIDER_ID_COLUMNS[provider], 'id'
+    stored_id = order.get(column)
+    if not stored_id:
+        # Проигравший параллельный запрос или заявка, для которой провайдер ещё не записан
+        return False
+    return not data.get(field) or str(stored_id) == str(data[field])
+
+
+STATUS_ALIASES = {
+    'canceled': 'cancelled',
+    'success': 'finished',
+    'paid': 'finished',
+    'completed': 'finished',
+    'expired': 'cancelled',
+    'failed': 'cancelled',
+}
+
+
+def _first(payload: Dict[str, Any], keys: tuple) -> Any:
+    for key in keys:
+        if payload.get(key) not in (None, ""):
+            return payload[key]
+    return None
 
-async def handle_payment_notification(request):
+
+def normalize_payment_event(provider: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Callback провайдера -> формат process_*_webhook: id, status, personal_id, received_sum"""
+    fields = PROVIDER_FIELDS[provider]
+    status = str(payload.get('status') or '').lower()
+    received_sum = _first(payload, fields['received_sum'])
     try:
-        data = await request.json()
-        order_id = data.get("id")
-        status = data.get("status")
-        personal_id = data.get("personal_id")
-        received_sum = data.get("received_sum")
-
-        db = Database(config.DATABASE_URL)
-        if status == "finished":
-            await db.update_order(personal_id, status="finished", received_sum=received_sum)
-            order = await db.get_order(personal_id)
-            if order:
-                await bot.send_message(
-                    order["user_id"],
-                    f"✅ Заявка #{personal_id} выполнена!\n"
-                    f"Получено: {received_sum:,.0f} ₽\n"
-                    f"Bitcoin {'отправлен на адрес' if order['direction'] == 'rub_to_crypto' else 'получен'}.",
-                    parse_mode="HTML"
-                )
+        received_sum = float(received_sum) if received_sum is not None else None
+    except (TypeError, ValueError):
+        received_sum = None
+    personal_id = _first(payload, fields['personal_id'])
+    provider_id = _first(payload, fields['id'])
+    return {
+        'id': str(provider_id) if provider_id is not None else None,
+        'status': STATUS_ALIASES.get(status, status),
+        'personal_id': str(personal_id) if personal_id is not None else None,
+        'received_sum': received_sum,
+    }
+
+
+# verifier(request, raw_body, payload) -> подпись callback-а верна
+CallbackVerifier = Callable[[web.Request, bytes, Dict[str, Any]], bool]
+
+
+def hmac_verifier(secret: str, header: str) -> CallbackVerifier:
+    """HMAC-SHA256 тела запроса (hex) в заголовке header"""
+    def verify(request: web.Request, body: bytes, payload: Dict[str, Any]) -> bool:
+        signature = request.headers.get(header, "")
+        expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+        return bool(signature) and hmac.compare_digest(signature.lower(), expected)
+    return verify
+
+
+def nicepay_verifier(merchant_key: str, token_key: str) -> CallbackVerifier:
+    """merchantToken = sha256(merchantKey + merchantOrderId + amount + merchantTokenKey), как в запросах к NicePay"""
+    def verify(request: web.Request, body: bytes, payload: Dict[str, Any]) -> bool:
+        if str(payload.get("merchantKey", "")) != merchant_key:
+            return False
+        token_string = (
+            str(payload.get("merchantKey", "")) +
+            str(payload.get("merchantOrderId", "")) +
+            str(payload.get("amount", "")) +
+            token_key
+        )
+        expected = hashlib.sha256(token_string.encode("utf-8")).hexdigest()
+        return hmac.compare_digest(str(payload.get("merchantToken", "")), expected)
+    return verify
+
+
+def configured_verifiers() -> Dict[str, CallbackVerifier]:
+    """Проверки подписи провайдеров, для которых заданы ключи"""
+    verifiers: Dict[str, CallbackVerifier] = {}
+    for provider, secret in (
+        ('onlypays', config.ONLYPAYS_CALLBACK_SECRET),
+        ('pspware', config.PSPWARE_CALLBACK_SECRET),
+        ('greengo', config.GREENGO_CALLBACK_SECRET),
+    ):
+        if secret:
+            verifiers[provider] = hmac_verifier(secret, config.PAYMENT_SIGNATURE_HEADER)
+    if config.NICEPAY_MERCHANT_KEY and config.NICEPAY_MERCHANT_TOKEN_KEY:
+        verifiers['nicepay'] = nicepay_verifier(config.NICEPAY_MERCHANT_KEY, config.NICEPAY_MERCHANT_TOKEN_KEY)
+    return verifiers
+
+
+def payment_callbacks_configured() -> bool:
+    return bool(config.PAYMENT_WEBHOOK_TOKEN or configured_verifiers())
+
+
+def parse_callback_body(content_type: str, body: bytes) -> Any:
+    if content_type == 'application/json':
+        return json.loads(body or b'null')
+    return dict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+
+
+class PaymentEventKey(NamedTuple):
+    provider: str
+    provider_order_id: str
+    status: str
+
+
+class PaymentEventLog:
+    """Отсев повторных событий провайдера: недавние ключи в памяти, остальные по уникальному индексу в БД"""
+
+    def __init__(self, db: Database, max_recent: int = 10000):
+        self.db = db
+        self.max_recent = max_recent
+        self.duplicates = 0
+        self._recent: "OrderedDict[PaymentEventKey, None]" = OrderedDict()
+
+    @staticmethod
+    def key(provider: str, data: Dict[str, Any]) -> Optional[PaymentEventKey]:
+        provider_order_id = data.get('id') or data.get('personal_id')
+        if not provider_order_id or not data.get('status'):
+            return None
+        return PaymentEventKey(provider, str(provider_order_id), str(data['status']))
+
+    def _remember(self, key: PaymentEventKey):
+        self._recent[key] = None
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+
+    async def claim(self, provider: str, data: Dict[str, Any]) -> Optional[PaymentEventKey]:
+        """Ключ события, если оно новое и его нужно обработать; None - повтор"""
+        key = self.key(provider, data)
+        if key is None:
+            return None
+        if key in self._recent:
+            self.duplicates += 1
+            return None
+        # Запоминаем до записи в БД: параллельный повтор отсеется уже здесь
+        self._remember(key)
+        try:
+            order_id = int(data['personal_id']) if data.get('personal_id') else None
+        except (TypeError, ValueError):
+            order_id = None
+        try:
+            is_new = await self.db.record_payment_event(*key, order_id=order_id, received_sum=data.get('received_sum'))
+        except Exception:
+            self._recent.pop(key, None)
+            raise
+        if not is_new:
+            self.duplicates += 1
+            return None
+        return key
+
+    async def release(self, key: Optional[PaymentEventKey]):
+        """Переход по событию не записан - повтор от провайдера или сверки должен пройти"""
+        if key is None:
+            return
+        self._recent.pop(key, None)
+        try:
+            await self.db.delete_payment_event(*key)
+        except Exception as e:
+            logger.error(f"Failed to release payment event {key}: {e}")
+
+
+class PaymentEvent(NamedTuple):
+    provider: str
+    data: Dict[str, Any]
+    received_at: float
+
+
+class PaymentIngestion:
+
+    def __init__(self, db: Database, processors: Dict[str, Callable[[dict, Bot], Awaitable[None]]],
+                 queue_size: int = 1000, workers: int = 4, token: str = "",
+                 verifiers: Optional[Dict[str, CallbackVerifier]] = None):
+        self.db = db
+        self.processors = processors
+        self.workers = workers
+        self.token = token
+        self.verifiers = verifiers or {}
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._bot: Optional[Bot] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def enabled(self) -> List[str]:
+        """Провайдеры, callback-и которых можно проверить"""
+        return [provider for provider in self.processors if self.token or provider in self.verifiers]
+
+    def register(self, app: web.Application) -> bool:
+        if not self.enabled:
+            logger.warning("Payment callbacks disabled: set PAYMENT_WEBHOOK_TOKEN or provider callback secrets")
+            return False
+        app.router.add_post("/{provider}/notification", self.handle)
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        provider = request.match_info['provider']
+        if provider not in self.enabled:
+            raise web.HTTPNotFound()
+        if self.token and not hmac.compare_digest(request.query.get('token', ''), self.token):
+            return web.json_response({"success": False, "error": "forbidden"}, status=403)
+        body = await request.read()
+        try:
+            payload = parse_callback_body(request.content_type, body)
+        except (ValueError, UnicodeDecodeError):
+            return web.json_response({"success": False, "error": "invalid body"}, status=400)
+        if not isinstance(payload, dict):
+            return web.json_response({"success": False, "error": "invalid body"}, status=400)
+        verifier = self.verifiers.get(provider)
+        if verifier is not None and not verifier(request, body, payload):
+            logger.warning(f"{provider} callback with invalid signature from {request.remote}")
+            return web.json_response({"success": False, "error": "forbidden"}, status=403)
+
+        data = normalize_payment_event(provider, payload)
+        if not data['personal_id'] and not data['id']:
+            return web.json_response({"success": False, "error": "order id required"}, status=400)
+        try:
+            self.queue.put_nowait(PaymentEvent(provider, data, time.monotonic()))
+        except asyncio.QueueFull:
+            # Лучше повтор от провайдера, чем неограниченный рост очереди
+            self.rejected += 1
+            logger.warning(f"Payment queue full, {provider} callback for {data['personal_id'] or data['id']} rejected")
+            return web.json_response({"success": False, "error": "busy"}, status=503)
+        self.accepted += 1
         return web.json_response({"success": True})
-    except Exception as e:
-        logging.error(f"Notification error: {e}")
-        return web.json_response({"success": False, "error": str(e)}, status=400)
-
-app = web.Application()
-app.add_routes([web.post("/onlypays/notification", handle_payment_notification)])
-
-async def start_webhook():
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", 8080)
-    await site.start()
\ No newline at end of file
+
+    async def _resolve(self, event: PaymentEvent) -> Optional[Dict[str, Any]]:
+        data = event.data
+        if data['personal_id']:
+            return data
+        column = PROVIDER_ID_COLUMNS.get(event.provider)
+        order_id = await self.db.find_order_id(column, data['id']) if column else None
+        if order_id is None:
+            logger.error(f"{event.provider} callback for unknown order {data['id']}: {data}")
+            return None
+        return dict(data, personal_id=str(order_id))
+
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                data = await self._resolve(event)
+                if data is not None:
+                    await self.processors[event.provider](data, self._bot)
+                    lag = time.monotonic() - event.received_at
+                    if lag > 5:
+                        logger.warning(f"{event.provider} callback processed {lag:.1f}s after receipt")
+            except Exception as e:
+                logger.error(f"Payment event processing error ({event.provider}): {e}")
+            finally:
+                self.processed += 1
+                self.queue.task_done()
+
+    def start(self, bot: Bot):
+        self._bot = bot
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            logger.info(f"Payment ingestion started ({self.workers} workers, queue {self.queue.maxsize})")
+
+    async def stop(self, timeout: float = 10):
+        # Даём дообработать принятые события: провайдер уже получил ответ и повторять не будет
+        if self._tasks and not self.queue.empty():
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Payment queue not drained, {self.queue.qsize()} events left")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'queued': self.queue.qsize(),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+        }